@@ -0,0 +1,221 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Per-context metrics for a whole context tree in a single pass.
+
+The tree is flattened by an Euler tour so that every subtree is a contiguous
+range of rows. Each context's own points are reduced to one row of per-segment
+values and a cumulative sum over the rows then gives every subtree's total with
+one subtraction, rather than pruning and rescanning the graph per context.
+
+Results match all_frequencies, all_quality and all_variance in quality.py.
+The per-context rows are kept between calls and only rebuilt for contexts
+passed to invalidate(), so an instance can be reused while the tree is unchanged.
+'''
+
+import numpy as np
+
+from quality import points_frequency, quality_result, variance_result
+
+class ContextAggregates(object):
+    def __init__(self, graph):
+        self.graph = graph
+        self.point_store = graph.get_point_store()
+
+        # Preorder context IDs, and the row range [begin, end) of each subtree
+        self.order = []
+        self.ranges = {}
+        self.depths = []
+
+        self.tour(graph.get_root().get_id())
+
+        # Contexts not reachable from the root are toured as their own trees
+        for context_id in graph.contexts.keys():
+            if context_id not in self.ranges:
+                self.tour(context_id)
+
+        # Metric parameters -> (rows, indexes of rows to rebuild)
+        self.row_cache = {}
+
+    def tour(self, root_context_id):
+        contexts = self.graph.contexts
+        stack = [(root_context_id, 1, False)]
+
+        while stack:
+            context_id, depth, done = stack.pop()
+            if done:
+                self.ranges[context_id] = (self.ranges[context_id], len(self.order))
+                continue
+
+            if context_id in self.ranges:
+                continue
+
+            self.ranges[context_id] = len(self.order)
+            self.order.append(context_id)
+            self.depths.append(depth)
+
+            stack.append((context_id, depth, True))
+            for child_id in contexts[context_id].outV('down', ids_only=True):
+                if child_id in contexts and child_id not in self.ranges:
+                    stack.append((child_id, depth + 1, False))
+
+    def invalidate(self, context_id):
+        'Rebuild the context\'s rows on next use, after its points have changed'
+        if context_id not in self.ranges:
+            return
+
+        row = self.ranges[context_id][0]
+        for rows, dirty in self.row_cache.values():
+            dirty.add(row)
+
+    def rows(self, key, width, fill_row):
+        'Per-context rows for the metric parameters in key, filling any that are missing or stale'
+        if key not in self.row_cache:
+            self.row_cache[key] = (np.zeros((len(self.order), width), dtype=np.int64), set(range(len(self.order))))
+
+        rows, dirty = self.row_cache[key]
+        for row in dirty:
+            rows[row] = 0
+
+            series = self.point_store.get_series(self.order[row])
+            if series:
+                fill_row(series, rows[row])
+        dirty.clear()
+
+        return rows
+
+    def subtree_sums(self, rows, context_ids):
+        'Sum the rows of each context subtree, one output row per context'
+        totals = np.zeros((len(rows) + 1, rows.shape[1]), dtype=rows.dtype)
+        np.cumsum(rows, axis=0, out=totals[1:])
+
+        begins, ends = zip(*[self.ranges[context_id] for context_id in context_ids])
+        return totals[list(ends)] - totals[list(begins)]
+
+    def select(self, contexts, context_ids):
+        'IDs of the passed contexts, limited to context_ids when given'
+        return [c.get_id() for c in contexts if context_ids is None or c.get_id() in context_ids]
+
+    def frequencies(self, anchor_time, window, num_segments, context_ids=None):
+        result = {}
+        for context_id in self.select(self.graph.get_leaves(), context_ids):
+            points = [int(t) for t in self.point_store.get_times([context_id], anchor_time - window, anchor_time)]
+
+            context_result = points_frequency(points, anchor_time, window, num_segments)
+            if context_result:
+                result[context_id] = context_result
+
+        return result
+
+    def quality(self, anchor_time, num_segments, segment_length=86400, context_ids=None):
+        interior_ids = self.select(self.graph.get_interior(), context_ids)
+        if not interior_ids:
+            return {}
+
+        # Summed point detail per context and segment
+        def fill_row(series, row):
+            # Slightly wider than the segments, which are then matched exactly
+            begin, end = series.bounds(anchor_time - (segment_length * (num_segments + 1)), anchor_time + segment_length)
+            if begin == end:
+                return
+
+            times, durations, point_details, point_ids = series.arrays()
+            segment_idxs = np.ceil((anchor_time - np.asarray(times[begin:end], dtype=np.float64)) / segment_length).astype(np.int64)
+            valid = (segment_idxs >= 0) & (segment_idxs < num_segments)
+
+            np.add.at(row, segment_idxs[valid], np.asarray(point_details[begin:end], dtype=np.int64)[valid])
+
+        details = self.rows(('Quality', anchor_time, num_segments, segment_length), num_segments, fill_row)
+
+        # A point scores its depth below the scored context, counting from 1
+        depths = np.array(self.depths, dtype=np.int64)
+        depth_details = self.subtree_sums(details * depths[:, np.newaxis], interior_ids)
+        detail_totals = self.subtree_sums(details, interior_ids)
+
+        result = {}
+        for i, context_id in enumerate(interior_ids):
+            relative_depth = depths[self.ranges[context_id][0]] - 1
+            segment_scores = depth_details[i] - (relative_depth * detail_totals[i])
+            result[context_id] = quality_result(segment_scores.tolist())
+
+        return result
+
+    def variance(self, anchor_time, window, rolling_window, segment_size, context_ids=None):
+        interior_ids = self.select(self.graph.get_interior(), context_ids)
+        if not interior_ids:
+            return {}
+
+        num_segments = window / segment_size
+        far_end_time = anchor_time - window - rolling_window
+
+        # Accumulated as point_variance does, so the boundaries are identical
+        bucket_begins = []
+        chunk_ends = []
+        bucket_begin = far_end_time
+        chunk_end = far_end_time + rolling_window
+        for i in range(num_segments + 1):
+            bucket_begins.append(bucket_begin)
+            chunk_ends.append(chunk_end)
+            bucket_begin += segment_size
+            chunk_end += segment_size
+
+        bucket_begins = np.array(bucket_begins[:-1], dtype=np.float64)
+        chunk_begins = np.array(chunk_ends[:-1], dtype=np.float64)
+        chunk_ends = np.array(chunk_ends[1:], dtype=np.float64)
+
+        # Per segment: whether the context has a point in the segment's chunk,
+        # followed by whether it has one in the rolling window before it
+        def fill_row(series, row):
+            begin, end = series.bounds(far_end_time, anchor_time)
+            if begin == end:
+                return
+
+            times = np.asarray(series.arrays()[0][begin:end], dtype=np.float64)
+
+            chunk_counts = np.searchsorted(times, chunk_ends, 'right') - np.searchsorted(times, chunk_begins, 'right')
+            bucket_counts = np.searchsorted(times, chunk_begins, 'right') - np.searchsorted(times, bucket_begins, 'left')
+
+            row[:num_segments] = chunk_counts > 0
+            row[num_segments:] = bucket_counts > 0
+
+        rows = self.rows(('Variance', anchor_time, window, rolling_window, segment_size), num_segments * 2, fill_row)
+        in_chunk = rows[:, :num_segments]
+        in_bucket = rows[:, num_segments:]
+
+        # Contexts that only have a point in the chunk
+        is_new = in_chunk & (1 - in_bucket)
+
+        chunk_contexts = self.subtree_sums(in_chunk, interior_ids).tolist()
+        bucket_contexts = self.subtree_sums(in_bucket, interior_ids).tolist()
+        new_contexts = self.subtree_sums(is_new, interior_ids).tolist()
+
+        result = {}
+        for i, context_id in enumerate(interior_ids):
+            context_result = []
+            for num_chunk, bucket_size, num_diff in zip(chunk_contexts[i], bucket_contexts[i], new_contexts[i]):
+                if not num_chunk:
+                    perc = 0
+                else:
+                    perc = 0.0
+                    if bucket_size > 0:
+                        perc = min(100, (num_diff / float(bucket_size)) * 100)
+                context_result.append(perc)
+
+            # Newest to oldest
+            context_result.reverse()
+            result[context_id] = variance_result(context_result)
+
+        return result
@@ -0,0 +1,130 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Connections to a graph DB: one writer and a pool of read-only readers.
+
+The DB is put in WAL mode, so readers see the last committed state and
+neither block nor are blocked by the writer.
+'''
+
+import sqlite3
+import threading
+from Queue import Queue, Empty
+from contextlib import contextmanager
+
+# Applied to every connection. In WAL mode synchronous=NORMAL only syncs at
+# checkpoints: commits survive a crash of the process, but the last of them
+# can be lost on power failure. FULL syncs every commit.
+PRAGMAS = (
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),         # KB
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'MEMORY')
+)
+
+# Read-only connections kept open per DB
+READ_POOL_SIZE = 4
+
+# Prepared statements kept per connection by sqlite3
+STATEMENT_CACHE_SIZE = 200
+
+class ConnectionManager(object):
+    def __init__(self, db_path, pool_size=READ_POOL_SIZE, pragmas=PRAGMAS):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.pragmas = pragmas
+
+        # Persistent in the DB file, so only needs setting from one connection
+        self.writer = self.connect()
+        journal_mode = self.writer.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            print 'WAL not available for %s, using %s journal' % (db_path, journal_mode)
+
+        self.pool = Queue()
+        self.num_readers = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # Reader held by each thread, so nested reads share one connection
+        self.local = threading.local()
+
+    def connect(self, read_only=False):
+        db = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        for name, value in self.pragmas:
+            db.execute('PRAGMA %s = %s' % (name, value))
+
+        if read_only:
+            db.execute('PRAGMA query_only = 1')
+
+        return db
+
+    def acquire(self):
+        'Take a reader from the pool, opening one while below the pool size'
+        try:
+            return self.checked(self.pool.get(False))
+        except Empty:
+            pass
+
+        with self.lock:
+            if self.num_readers < self.pool_size and not self.closed:
+                self.num_readers += 1
+                return self.connect(read_only=True)
+
+        return self.checked(self.pool.get())
+
+    def checked(self, db):
+        # None is left in the pool on closing, waking anyone waiting for a reader
+        if db is None:
+            self.pool.put(None)
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return db
+
+    def release(self, db):
+        # Held through close() by a read running without the exec lock
+        with self.lock:
+            if self.closed:
+                db.close()
+            else:
+                self.pool.put(db)
+
+    @contextmanager
+    def reader(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            yield db
+            return
+
+        db = self.acquire()
+        self.local.db = db
+        try:
+            yield db
+        finally:
+            self.local.db = None
+            self.release(db)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            while True:
+                try:
+                    db = self.pool.get(False)
+                except Empty:
+                    break
+                if db is not None:
+                    db.close()
+            self.pool.put(None)
+
+        self.writer.close()
@@ -15,4 +15,17 @@
 # along with Benome. If not, see http://www.gnu.org/licenses/.
 
 from pydispatch import dispatcher
+
+# Sent by Graph with point_id, context_id and epoch_days, the UTC days whose
+# rollups the write changed
 POINT_ADDED = 'PointAdded'
+POINT_UPDATED = 'PointUpdated'
+POINT_DELETED = 'PointDeleted'
+
+# Contexts or associations added or removed
+STRUCTURE_CHANGED = 'StructureChanged'
+
+# A user's container started on a port, or stopped or became unreachable.
+# Sent by ContainerManager with user_id and port.
+CONTAINER_STARTED = 'ContainerStarted'
+CONTAINER_STOPPED = 'ContainerStopped'
@@ -0,0 +1,228 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+from bisect import bisect_left, bisect_right
+from heapq import merge
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class ContextSeries(object):
+    '''Points of a single context as parallel columns sorted by time.
+
+    Writes insert into the columns in place. arrays() exposes them as contiguous
+    NumPy arrays, rebuilt only after the series has changed.
+    '''
+
+    def __init__(self, context_id):
+        self.context_id = context_id
+
+        self.times = []
+        self.point_ids = []
+        self.durations = []
+        self.details = []
+
+        self.array_cache = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def insert(self, point_id, timestamp, duration, detail):
+        # After any points with the same time, so insertion order breaks ties
+        idx = bisect_right(self.times, timestamp)
+
+        self.times.insert(idx, timestamp)
+        self.point_ids.insert(idx, point_id)
+        self.durations.insert(idx, duration)
+        self.details.insert(idx, detail)
+
+        self.array_cache = None
+
+    def remove(self, point_id, timestamp):
+        idx = bisect_left(self.times, timestamp)
+        end = bisect_right(self.times, timestamp)
+
+        while idx < end:
+            if self.point_ids[idx] == point_id:
+                del self.times[idx]
+                del self.point_ids[idx]
+                del self.durations[idx]
+                del self.details[idx]
+
+                self.array_cache = None
+                return True
+            idx += 1
+
+        return False
+
+    def extend_unsorted(self, rows):
+        'Bulk load (point_id, time, duration, detail) rows, sorting once'
+        rows = sorted(zip(self.point_ids, self.times, self.durations, self.details) + list(rows), key=lambda r: r[1])
+
+        self.point_ids = [r[0] for r in rows]
+        self.times = [r[1] for r in rows]
+        self.durations = [r[2] for r in rows]
+        self.details = [r[3] for r in rows]
+
+        self.array_cache = None
+
+    def bounds(self, begin_time=None, end_time=None):
+        'Index range of the points with begin_time <= time <= end_time'
+        begin = 0
+        if begin_time is not None:
+            begin = bisect_left(self.times, begin_time)
+
+        end = len(self.times)
+        if end_time is not None:
+            end = bisect_right(self.times, end_time)
+
+        return begin, end
+
+    def arrays(self):
+        'Return (times, durations, details, point_ids), as NumPy arrays when available'
+        if np is None:
+            return self.times, self.durations, self.details, self.point_ids
+
+        if self.array_cache is None:
+            self.array_cache = (
+                np.array(self.times, dtype=np.float64),
+                np.array(self.durations, dtype=np.int64),
+                np.array(self.details, dtype=np.int64),
+                np.array(self.point_ids, dtype=np.int64)
+            )
+
+        return self.array_cache
+
+
+class PointStore(object):
+    '''In-memory time series of a graph's points, kept per context.
+
+    Loaded once from the DB and then kept current by the Graph's point
+    mutations, so analytics don't need to go back to SQL.
+    '''
+
+    def __init__(self):
+        self.series = {}
+
+        # PointID -> (ContextID, Time)
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def point_values(point):
+        'Extract the stored columns from a point as produced by Graph.generate_points'
+        timestamp = float(point['1__Time'])
+        duration = int(float(point.get('1__Duration') or 0))
+
+        # All points have at least 3 attributes which count as 1
+        detail = len(point.keys()) - 2
+
+        return point['1__ContextID'], timestamp, duration, detail
+
+    def load(self, rows):
+        'Bulk load (PointID, ContextID, Time, Duration, Detail) rows'
+        context_rows = {}
+        for point_id, context_id, timestamp, duration, detail in rows:
+            if point_id in self.index:
+                continue
+
+            self.index[point_id] = (context_id, timestamp)
+
+            if context_id not in context_rows:
+                context_rows[context_id] = []
+            context_rows[context_id].append((point_id, timestamp, duration, detail))
+
+        for context_id, context_rows in context_rows.items():
+            self.get_series(context_id, create=True).extend_unsorted(context_rows)
+
+    def load_sorted(self, context_id, point_ids, times, durations, details):
+        'Load the columns of a context that are already sorted by time'
+        series = self.get_series(context_id, create=True)
+        if len(series):
+            series.extend_unsorted(zip(point_ids, times, durations, details))
+        else:
+            series.point_ids = point_ids
+            series.times = times
+            series.durations = durations
+            series.details = details
+            series.array_cache = None
+
+        for point_id, timestamp in zip(point_ids, times):
+            self.index[point_id] = (context_id, timestamp)
+
+    def put(self, point):
+        'Add or replace a point'
+        point_id = point['ID']
+        context_id, timestamp, duration, detail = self.point_values(point)
+
+        self.remove(point_id)
+        self.get_series(context_id, create=True).insert(point_id, timestamp, duration, detail)
+        self.index[point_id] = (context_id, timestamp)
+
+    def remove(self, point_id):
+        existing = self.index.pop(point_id, None)
+        if not existing:
+            return False
+
+        context_id, timestamp = existing
+        series = self.series.get(context_id)
+        if series:
+            series.remove(point_id, timestamp)
+
+        return True
+
+    def get_series(self, context_id, create=False):
+        series = self.series.get(context_id)
+        if series is None and create:
+            series = ContextSeries(context_id)
+            self.series[context_id] = series
+
+        return series
+
+    def get_times(self, context_ids, begin_time=None, end_time=None):
+        'Sorted times of all points in the passed contexts, within the range'
+        streams = []
+        for context_id in context_ids:
+            series = self.series.get(context_id)
+            if not series:
+                continue
+
+            begin, end = series.bounds(begin_time, end_time)
+            if begin < end:
+                streams.append(series.times[begin:end])
+
+        if len(streams) == 1:
+            return streams[0]
+
+        return list(merge(*streams))
+
+    def get_points(self, context_ids, begin_time=None, end_time=None):
+        'Sorted (Time, ContextID) of all points in the passed contexts, within the range'
+        streams = []
+        for context_id in context_ids:
+            series = self.series.get(context_id)
+            if not series:
+                continue
+
+            begin, end = series.bounds(begin_time, end_time)
+            if begin < end:
+                streams.append([(t, context_id) for t in series.times[begin:end]])
+
+        return list(merge(*streams))
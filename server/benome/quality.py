@@ -20,6 +20,10 @@ import math
 import simplejson
 import datetime
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 '''Depth and complexity of data points per day over time'''
 def quality(graph, anchor_time=None, segment_length=86400, num_segments=30, points=None):
@@ -45,27 +49,38 @@ def quality(graph, anchor_time=None, segment_length=86400, num_segments=30, poin
     root_context = graph.get_root()
     traverse(root_context)
 
-    # TODO: Limit to window
-    if not points:
-        points = graph.get_points()
+    def point_details():
+        # TODO: Limit to window
+        if not points:
+            point_store = graph.get_point_store()
+            for context_id, depth in context_depths.items():
+                series = point_store.get_series(context_id)
+                if series:
+                    for t, detail in zip(series.times, series.details):
+                        yield depth, detail, t
+            return
 
-    segments = {}
-    for point in points:
-        context_id = point['1__ContextID']
-        depth = context_depths.get(context_id, 0)
-        if not depth:
-            continue
+        for point in points:
+            context_id = point['1__ContextID']
+            depth = context_depths.get(context_id, 0)
+            if not depth:
+                continue
+
+            # All points have at least 3 attributes which count as 1
+            detail = len(point.keys()) - 2
+
+            try:
+                t = float(point['1__Time'])
+            except:
+                continue
 
-        # All points have at least 3 attributes which count as 1
-        detail = len(point.keys()) - 2
+            yield depth, detail, t
+
+    segments = {}
+    for depth, detail, t in point_details():
         score = depth * detail
 
         # Calculate bucket index
-        try:
-            t = float(point['1__Time'])
-        except:
-            continue
-
         segment_idx = int(math.ceil((anchor_time - t) / increment))
         if segment_idx not in segments:
             segments[segment_idx] = [0, 0]
@@ -356,6 +371,8 @@ def viz_process_feedback(context_id, points, anchor_time, target_interval, windo
     }
 
 class PointsChunker(object):
+    'Consumes time-sorted (Time, ContextID) points in consecutive time chunks'
+
     def __init__(self, points, begin_time=None):
         self.points = points
 
@@ -368,7 +385,7 @@ class PointsChunker(object):
             return []
 
         if not self.last_time:
-            self.last_time = self.points[0]['1__Time']
+            self.last_time = self.points[0][0]
             self.begin_time = self.last_time
         end_time = self.last_time + size
         self.last_time = end_time
@@ -376,7 +393,7 @@ class PointsChunker(object):
         result = []
         while self.i < len(self.points):
             point = self.points[self.i]
-            t = point['1__Time']
+            t = point[0]
 
             if t > end_time:
 
@@ -396,8 +413,8 @@ class Bucket(object):
 
     def merge_new(self, new_points, interval):
         # Compute which of those points are new
-        current_contexts = set([p['1__ContextID'] for p in self.points])
-        new_contexts = set([p['1__ContextID'] for p in new_points])
+        current_contexts = set([p[1] for p in self.points])
+        new_contexts = set([p[1] for p in new_points])
         additions = new_contexts.difference(current_contexts)
 
         # Add the points to the bucket
@@ -405,7 +422,7 @@ class Bucket(object):
         self.begin_time += interval
 
         # Trim the bucket to the window
-        self.points = filter(lambda x: x['1__Time'] >= self.begin_time, self.points)
+        self.points = filter(lambda x: x[0] >= self.begin_time, self.points)
 
         return tuple(additions)
 
@@ -413,21 +430,19 @@ class Bucket(object):
         return len(self.points)
 
     def num_unique_points(self):
-        return len(set([p['1__ContextID'] for p in self.points]))
+        return len(set([p[1] for p in self.points]))
 
 def point_variance(graph, anchor_time, window, rolling_window, segment_size):
     end_time = anchor_time - window
     far_end_time = end_time - rolling_window
 
     # Start the window off the far end
-    points = graph.get_points(anchor_time=anchor_time, end_time=far_end_time)
+    # Oldest to newest
+    points = graph.get_point_store().get_points(graph.contexts.keys(), far_end_time, anchor_time)
     num_segments = window / segment_size
     if not points:
         return [0] * num_segments
 
-    # Oldest to newest
-    points.sort(key=lambda p: p['1__Time'], reverse=False)
-
     pc = PointsChunker(points, far_end_time)
 
     # Fill the bucket by grabbing a rolling_window-sized chunk from the end
@@ -550,6 +565,55 @@ def calc_target_interval(points, anchor_time):
     return avg_interval
 
 def frequency_decay(points, target_interval, anchor_time, window, num_segments, decrease_immed=False):
+    if np is None or not target_interval:
+        return frequency_decay_py(points, target_interval, anchor_time, window, num_segments, decrease_immed=decrease_immed)
+
+    return frequency_decay_np(points, target_interval, anchor_time, window, num_segments, decrease_immed=decrease_immed)
+
+def frequency_decay_np(points, target_interval, anchor_time, window, num_segments, decrease_immed=False):
+    '''Same result as frequency_decay_py without the per-point walk over segments.
+
+    A point's score falls off with segment age, so each segment ends up with the score
+    of the newest point that reaches it. Points reach back from their own segment, so
+    that point is a running maximum of the point times taken from the oldest segment down.
+    '''
+    increment = window / float(num_segments)
+    max_score = 100
+
+    points = np.asarray(points)
+    if not len(points):
+        return [0] * num_segments
+
+    segment_idxs = np.ceil((anchor_time - points) / increment).astype(np.int64)
+
+    for segment_idx in segment_idxs[segment_idxs >= num_segments]:
+        print 'SegmentIdx too large: %s' % segment_idx
+
+    valid = (segment_idxs >= 0) & (segment_idxs < num_segments)
+    if not valid.any():
+        return [0] * num_segments
+
+    # Newest point starting in each segment, then newest reaching each segment
+    newest = np.full(num_segments, -np.inf)
+    np.maximum.at(newest, segment_idxs[valid], points[valid].astype(np.float64))
+    newest = np.maximum.accumulate(newest[::-1])[::-1]
+
+    reached = np.isfinite(newest)
+    segment_idxs = np.arange(num_segments)[reached]
+
+    segment_ages = anchor_time - (segment_idxs * increment) - newest[reached]
+    if not decrease_immed:
+        segment_ages -= target_interval
+
+    scores = np.maximum(0, target_interval - segment_ages) / float(target_interval)
+    scores = np.minimum(max_score, (scores * max_score).astype(np.int64))
+
+    segments = np.zeros(num_segments, dtype=np.int64)
+    segments[reached] = scores
+
+    return segments.tolist()
+
+def frequency_decay_py(points, target_interval, anchor_time, window, num_segments, decrease_immed=False):
     increment = window / float(num_segments)
     max_score = 100
     segments = [0] * num_segments
@@ -580,7 +644,11 @@ def frequency_decay(points, target_interval, anchor_time, window, num_segments,
     return segments
 
 def frequency(graph, anchor_time, window, num_segments, decrease_immed=False):
-    points = [int(float(p['1__Time'])) for p in graph.get_points(anchor_time, anchor_time - window)]
+    point_store = graph.get_point_store()
+    points = [int(t) for t in point_store.get_times(graph.contexts.keys(), anchor_time - window, anchor_time)]
+    return points_frequency(points, anchor_time, window, num_segments, decrease_immed=decrease_immed)
+
+def points_frequency(points, anchor_time, window, num_segments, decrease_immed=False):
     if len(points) <= 1:
         return None
 
@@ -597,11 +665,27 @@ def frequency(graph, anchor_time, window, num_segments, decrease_immed=False):
         'TargetInterval': target_interval
     }
 
-def all_frequencies(graph, anchor_time, window, num_segments):
+def context_aggregates(graph):
+    'Single-pass metrics for every context of the graph, or None without numpy'
+    if np is None:
+        return None
+
+    from aggregate import ContextAggregates
+    return ContextAggregates(graph)
+
+def all_frequencies(graph, anchor_time, window, num_segments, aggregates=None, context_ids=None):
+    if aggregates is None:
+        aggregates = context_aggregates(graph)
+    if aggregates:
+        return aggregates.frequencies(anchor_time, window, num_segments, context_ids=context_ids)
+
     leaf_contexts = graph.get_leaves()
     result = {}
     for context in leaf_contexts:
         context_id = context.get_id()
+        if context_ids is not None and context_id not in context_ids:
+            continue
+
         g2 = graph.prune_to_root(context_id)
         context_result = frequency(g2, anchor_time, window, num_segments)
         if context_result:
@@ -609,32 +693,38 @@ def all_frequencies(graph, anchor_time, window, num_segments):
 
     return result
 
-def all_quality(graph, anchor_time, num_segments):
+def quality_result(segment_scores):
+    'Segment scores as a percentage of the highest one'
+    max_val = max(1, max(segment_scores))
+
+    return {
+        'Data': [int(round((score / float(max_val)) * 100)) for score in segment_scores],
+        'Target': None
+    }
+
+def all_quality(graph, anchor_time, num_segments, aggregates=None, context_ids=None):
+    if aggregates is None:
+        aggregates = context_aggregates(graph)
+    if aggregates:
+        return aggregates.quality(anchor_time, num_segments, context_ids=context_ids)
+
     interior_contexts = graph.get_interior()
     result = {}
 
-    points = graph.get_points()
     for context in interior_contexts:
         context_id = context.get_id()
-        g2 = graph.prune_to_root(context_id)
-
-        quality_result = quality(g2, anchor_time=anchor_time, num_segments=num_segments, points=points)
+        if context_ids is not None and context_id not in context_ids:
+            continue
 
-        context_result = {
-            'Data': None,
-            'Target': None
-        }
+        g2 = graph.prune_to_root(context_id)
 
-        max_val = max(1, quality_result['MaxScore'])
-        p = [int(round((p[1] / float(max_val)) * 100)) for p in quality_result['Points']]
-        context_result['Data'] = p
-        result[context_id] = context_result
+        quality_data = quality(g2, anchor_time=anchor_time, num_segments=num_segments)
+        result[context_id] = quality_result([p[1] for p in quality_data['Points']])
 
     return result
 
-def all_variance(graph, anchor_time, window, rolling_window, segment_size):
-    import random
-    
+def variance_result(context_result):
+    'Scale point_variance output against its typical value'
     def target_transform(target, values):
         if not target:
             target = 1
@@ -650,27 +740,36 @@ def all_variance(graph, anchor_time, window, rolling_window, segment_size):
             result.append(v)
         return result
 
+    target = None
+    if any(context_result):
+        tmp_result = filter(lambda x: x > 0, context_result)
+        avg = mean(tmp_result)
+        stdev = pstdev(tmp_result)
+        filtered_outliers = filter(lambda x: x <= avg + stdev, context_result)
+        target = mean(filtered_outliers)
+        context_result = target_transform(target, context_result)
+
+    return {
+        'Data': context_result,
+        'Target': target
+    }
+
+def all_variance(graph, anchor_time, window, rolling_window, segment_size, aggregates=None, context_ids=None):
+    if aggregates is None:
+        aggregates = context_aggregates(graph)
+    if aggregates:
+        return aggregates.variance(anchor_time, window, rolling_window, segment_size, context_ids=context_ids)
+
     interior_contexts = graph.get_interior()
     result = {}
-    i = 1
     for context in interior_contexts:
         context_id = context.get_id()
+        if context_ids is not None and context_id not in context_ids:
+            continue
+
         g2 = graph.prune_to_root(context_id)
         context_result = point_variance(g2, anchor_time, window, rolling_window, segment_size)
-
-        target = None
-        if any(context_result):
-            tmp_result = filter(lambda x: x > 0, context_result)
-            avg = mean(tmp_result)
-            stdev = pstdev(tmp_result)
-            filtered_outliers = filter(lambda x: x <= avg + stdev, context_result)
-            target = mean(filtered_outliers)
-            context_result = target_transform(target, context_result)
-
-        result[context_id] = {
-            'Data': context_result,
-            'Target': target
-        }
+        result[context_id] = variance_result(context_result)
 
     return result
 
@@ -0,0 +1,179 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Binary snapshot of a loaded Graph and its point store.
+
+Layout, all little-endian:
+
+    header      MAGIC, format version, array item size, DB change counter, user ID,
+                length of the graph section, length of the series index
+    graph       marshal of (namespaces, contexts, associations)
+    index       marshal of [(context ID, number of points), ...]
+    arrays      per indexed context: times (double), then point IDs, durations
+                and details (native long), each array padded to 8 bytes
+
+A snapshot only applies while the DB change counter is the one it was written at.
+'''
+
+import gc
+import os
+import time
+import mmap
+import struct
+import marshal
+from array import array
+
+MAGIC = 'BNSNAP'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<6sHHqqQQ')
+
+# Typecode for the integer columns, as array has no fixed 64-bit type here
+INT_TYPECODE = 'l'
+
+def pad(length):
+    return (8 - length % 8) % 8
+
+def save_snapshot(graph, path, namespaces):
+    'Write the graph atomically to path, returning the change counter it was written at'
+    t = time.time()
+
+    change_counter = graph.get_change_counter()
+    point_store = graph.get_point_store()
+
+    contexts = [(c.get_id(), c.label, c.attributes) for c in graph.contexts.values()]
+    associations = [(a.get_id(), a.src.get_id(), a.dest.get_id(), a.key) for a in graph.associations.values()]
+    graph_section = marshal.dumps((list(namespaces), contexts, associations))
+
+    series_list = [s for s in point_store.series.values() if len(s)]
+    index_section = marshal.dumps([(s.context_id, len(s)) for s in series_list])
+
+    item_size = array(INT_TYPECODE).itemsize
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, item_size, change_counter, graph.user_id,
+                    len(graph_section), len(index_section))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for section in (graph_section, index_section):
+            f.write(section)
+            f.write('\0' * pad(len(section)))
+
+        for series in series_list:
+            for typecode, values in (('d', series.times), (INT_TYPECODE, series.point_ids),
+                                        (INT_TYPECODE, series.durations), (INT_TYPECODE, series.details)):
+                data = array(typecode, values).tostring()
+                f.write(data)
+                f.write('\0' * pad(len(data)))
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(tmp_path, path)
+
+    print 'Snapshot written at change %s, %d contexts and %d points in %.2fs' % (
+                change_counter, len(contexts), len(point_store), time.time() - t)
+    return change_counter
+
+def load_snapshot(graph, path, user_id, namespaces):
+    '''Populate an empty graph and its point store from the snapshot at path.
+
+    Returns the change counter of the snapshot, or None when it is missing,
+    unreadable or stale, in which case the graph must be loaded from the DB.
+    '''
+    if not os.path.exists(path):
+        return None
+
+    # Collections triggered by the many small objects built here would
+    # repeatedly walk everything loaded so far
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _load_snapshot(graph, path, user_id, namespaces)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _load_snapshot(graph, path, user_id, namespaces):
+    from point_store import PointStore
+
+    t = time.time()
+
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError), e:
+            print 'Snapshot not readable: %s' % e
+            return None
+
+    try:
+        if len(mm) < HEADER.size:
+            return None
+
+        magic, version, item_size, change_counter, snapshot_user_id, graph_len, index_len = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION or item_size != array(INT_TYPECODE).itemsize:
+            print 'Snapshot format not supported'
+            return None
+
+        if snapshot_user_id != user_id or change_counter != graph.get_change_counter():
+            print 'Snapshot is stale'
+            return None
+
+        offset = HEADER.size
+        snapshot_namespaces, contexts, associations = marshal.loads(mm[offset:offset + graph_len])
+        offset += graph_len + pad(graph_len)
+
+        if snapshot_namespaces != list(namespaces):
+            print 'Snapshot is for other namespaces'
+            return None
+
+        index = marshal.loads(mm[offset:offset + index_len])
+        offset += index_len + pad(index_len)
+
+        point_store = PointStore()
+        for context_id, num_points in index:
+            columns = []
+            for typecode in ('d', INT_TYPECODE, INT_TYPECODE, INT_TYPECODE):
+                length = num_points * array(typecode).itemsize
+
+                values = array(typecode)
+                values.fromstring(mm[offset:offset + length])
+                columns.append(values.tolist())
+
+                offset += length + pad(length)
+
+            times, point_ids, durations, details = columns
+            point_store.load_sorted(context_id, point_ids, times, durations, details)
+
+    except (struct.error, ValueError, EOFError, TypeError), e:
+        print 'Snapshot not readable: %s' % e
+        return None
+
+    finally:
+        mm.close()
+
+    for context_id, label, attributes in contexts:
+        graph.init_context(context_id, label, attributes=attributes)
+
+    for assoc_id, source_id, dest_id, key in associations:
+        graph.init_assoc(assoc_id, source_id, dest_id, key)
+
+    graph.point_store = point_store
+    graph.load_args = (user_id, namespaces)
+
+    print 'Snapshot loaded at change %s, %d contexts and %d points in %.3fs' % (
+                change_counter, len(contexts), len(point_store), time.time() - t)
+    return change_counter
@@ -17,10 +17,307 @@
 import sys
 import os
 import time
+import math
 import simplejson
 import sqlite3
+import threading
+from itertools import count
+from contextlib import contextmanager
 from pdb import set_trace as bp
 
+from events import dispatcher, POINT_ADDED, POINT_UPDATED, POINT_DELETED, STRUCTURE_CHANGED
+from connections import ConnectionManager, READ_POOL_SIZE
+
+# Schema changes applied to existing DBs on open, tracked by PRAGMA user_version.
+# Each entry is the list of statements that bring the schema to that version.
+MIGRATIONS = (
+    # 1: Time-ordered point lookups
+    (
+        '''CREATE INDEX IF NOT EXISTS 'Nodes_UserID_Type_TimeStamp' ON
+                'Nodes' ('UserID' ASC, 'Type' ASC, 'TimeStamp' ASC)''',
+        '''CREATE INDEX IF NOT EXISTS 'Associations_SourceID_Key_DestID' ON
+                'Associations' ('SourceID' ASC, 'Key' ASC, 'DestID' ASC)''',
+        'ANALYZE'
+    ),
+
+    # 2: Change counter, bumped by every write to the graph tables.
+    # Tells whether a snapshot of the graph is still current.
+    (
+        '''CREATE TABLE IF NOT EXISTS Meta (
+            Name TEXT PRIMARY KEY,
+            Value INTEGER
+        )''',
+        "INSERT OR IGNORE INTO Meta (Name, Value) VALUES ('ChangeCounter', 0)",
+        '''CREATE TRIGGER IF NOT EXISTS 'Nodes_Insert_Change' AFTER INSERT ON 'Nodes'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Nodes_Update_Change' AFTER UPDATE ON 'Nodes'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Nodes_Delete_Change' AFTER DELETE ON 'Nodes'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Attributes_Insert_Change' AFTER INSERT ON 'Attributes'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Attributes_Update_Change' AFTER UPDATE ON 'Attributes'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Attributes_Delete_Change' AFTER DELETE ON 'Attributes'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Associations_Insert_Change' AFTER INSERT ON 'Associations'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Associations_Update_Change' AFTER UPDATE ON 'Associations'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS 'Associations_Delete_Change' AFTER DELETE ON 'Associations'
+                BEGIN UPDATE Meta SET Value = Value + 1 WHERE Name = 'ChangeCounter'; END''',
+    ),
+
+    # 3: Totals of each context's points by UTC day, kept by point writes so
+    # reports read a row per day and context rather than every point.
+    # NoteIDs lists the points with text, comma separated.
+    (
+        '''CREATE TABLE IF NOT EXISTS DayRollups (
+            UserID INTEGER,
+            EpochDay INTEGER,
+            ContextID INTEGER,
+            Duration INTEGER,
+            Count INTEGER,
+            NoteIDs TEXT,
+            PRIMARY KEY (UserID, EpochDay, ContextID)
+        )''',
+        '''INSERT OR REPLACE INTO DayRollups (UserID, EpochDay, ContextID, Duration, Count, NoteIDs)
+            SELECT UserID, EpochDay, ContextID, SUM(Duration), COUNT(*), GROUP_CONCAT(NoteID)
+            FROM (
+                SELECT
+                    Nodes.UserID AS UserID,
+                    CAST(CAST(IFNULL(TimeAttr.Value, Nodes.TimeStamp) AS REAL) / 86400 AS INTEGER) AS EpochDay,
+                    Associations.DestID AS ContextID,
+                    CAST(CAST(IFNULL(DurationAttr.Value, 0) AS REAL) AS INTEGER) AS Duration,
+                    CASE WHEN TextAttr.Value != '' THEN Nodes.ID END AS NoteID
+                FROM
+                    Nodes
+                        INNER JOIN Associations ON Nodes.ID = Associations.SourceID
+                        LEFT OUTER JOIN Attributes AS TimeAttr ON Nodes.ID = TimeAttr.NodeID
+                            AND IFNULL(TimeAttr.NameSpaceID, 1) = 1 AND TimeAttr.Name = 'Time'
+                        LEFT OUTER JOIN Attributes AS DurationAttr ON Nodes.ID = DurationAttr.NodeID
+                            AND IFNULL(DurationAttr.NameSpaceID, 1) = 1 AND DurationAttr.Name = 'Duration'
+                        LEFT OUTER JOIN Attributes AS TextAttr ON Nodes.ID = TextAttr.NodeID
+                            AND IFNULL(TextAttr.NameSpaceID, 1) = 1 AND TextAttr.Name = 'Text'
+                WHERE
+                    Nodes.Type = 'Point'
+                    AND
+                    Associations.Key = 'up'
+            )
+            GROUP BY UserID, EpochDay, ContextID''',
+    ),
+)
+
+def migrate_schema(db):
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+
+    for version, statements in enumerate(MIGRATIONS[version:], version + 1):
+        for statement in statements:
+            db.execute(statement)
+
+        db.execute('PRAGMA user_version = %d' % version)
+        print 'Schema migrated to version %d' % version
+
+    db.commit()
+    return version
+
+# Rows fetched per batch when streaming large result sets
+LOAD_ARRAYSIZE = 2000
+
+def iter_rows(cursor, arraysize=LOAD_ARRAYSIZE):
+    'Stream the rows of an executed cursor, fetching them in batches'
+    cursor.arraysize = arraysize
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+
+        for row in rows:
+            yield row
+
+def memory_usage():
+    'Resident set size of this process in KB'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+    except (IOError, OSError, ValueError):
+        # Peak rather than current, where /proc isn't available
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Most IDs bound as placeholders in one statement, below SQLite's default
+# limit of 999 parameters
+MAX_LIST_PARAMS = 512
+
+def has_json1(db):
+    try:
+        db.execute('SELECT value FROM json_each(?)', ('[]',)).fetchall()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+class PointQueries(object):
+    '''The fixed set of parameterized statements used to retrieve points.
+
+    Statement text never depends on the argument values, so sqlite3's statement
+    cache can reuse the prepared statements across calls. ID lists are bound as
+    a single JSON parameter through json_each or, when the SQLite build lacks
+    JSON1, as IN (?, ...) placeholders padded to a power of two, so few
+    statements cover all list lengths.
+    '''
+
+    # Range scan over Nodes_UserID_Type_TimeStamp, with the attributes of each
+    # matching point fetched by NodeID index lookups.
+    points_query = '''
+        SELECT
+            Nodes.ID, Nodes.TimeStamp, Associations.DestID, Attributes.NameSpaceID,
+            Attributes.Name, Attributes.Value
+        FROM
+            Nodes
+                INNER JOIN Associations ON Nodes.ID = Associations.SourceID
+                LEFT OUTER JOIN Attributes ON Nodes.ID = Attributes.NodeID
+                    %(namespace_filter)s
+        WHERE
+            Nodes.UserID = ?
+            AND
+            Nodes.Type = 'Point'
+            AND
+            Associations.Key = 'up'
+            %(anchor_filter)s
+            %(end_filter)s
+            %(context_filter)s
+    '''
+
+    # Left out when unbounded, so points without a TimeStamp aren't dropped
+    anchor_filter = '''
+            AND
+            Nodes.TimeStamp <= ?
+    '''
+
+    end_filter = '''
+            AND
+            Nodes.TimeStamp >= ?
+    '''
+
+    namespace_filter = '''
+                    AND
+                    (
+                        Attributes.NameSpaceID IS NULL
+                        OR
+                        Attributes.NameSpaceID IN (%s)
+                    )
+    '''
+
+    context_filter = '''
+            AND
+            Associations.DestID IN (%s)
+    '''
+
+    # Time, duration and text of points by ID, for the notes of reports
+    notes_query = '''
+        SELECT
+            Nodes.ID, IFNULL(TimeAttr.Value, Nodes.TimeStamp), DurationAttr.Value, TextAttr.Value
+        FROM
+            Nodes
+                LEFT OUTER JOIN Attributes AS TimeAttr ON Nodes.ID = TimeAttr.NodeID
+                    AND IFNULL(TimeAttr.NameSpaceID, 1) = 1 AND TimeAttr.Name = 'Time'
+                LEFT OUTER JOIN Attributes AS DurationAttr ON Nodes.ID = DurationAttr.NodeID
+                    AND IFNULL(DurationAttr.NameSpaceID, 1) = 1 AND DurationAttr.Name = 'Duration'
+                LEFT OUTER JOIN Attributes AS TextAttr ON Nodes.ID = TextAttr.NodeID
+                    AND IFNULL(TextAttr.NameSpaceID, 1) = 1 AND TextAttr.Name = 'Text'
+        WHERE
+            Nodes.ID IN (%s)
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self.json1 = has_json1(db)
+
+        # (namespace list size, context list size, anchor bound, end bound) ->
+        # statement, a size being 0 without the filter and None for a JSON list
+        self.statements = {}
+        self.notes_statements = {}
+
+    def list_sql(self, size):
+        if size is None:
+            return 'SELECT value FROM json_each(?)'
+        return ', '.join(['?'] * size)
+
+    def list_size(self, values):
+        'Placeholders the list is bound to'
+        if not values:
+            return 0
+        if self.json1:
+            return None
+
+        size = 1
+        while size < len(values):
+            size *= 2
+        return size
+
+    def bind_list(self, values, size):
+        values = [int(v) for v in values]
+
+        if size is None:
+            return [simplejson.dumps(values)]
+
+        # Padded with repeats, which IN ignores
+        return values + [values[-1]] * (size - len(values))
+
+    def list_chunks(self, values):
+        'Lists of at most MAX_LIST_PARAMS, queried in turn when bound as placeholders'
+        values = list(values or [])
+        if self.json1 or len(values) <= MAX_LIST_PARAMS:
+            return [values]
+        return [values[i:i + MAX_LIST_PARAMS] for i in range(0, len(values), MAX_LIST_PARAMS)]
+
+    def points_statement(self, namespace_size, context_size, by_anchor, by_end):
+        key = (namespace_size, context_size, by_anchor, by_end)
+        statement = self.statements.get(key)
+        if statement is None:
+            statement = self.statements[key] = self.points_query % {
+                'namespace_filter': self.namespace_filter % self.list_sql(namespace_size) if namespace_size != 0 else '',
+                'anchor_filter': self.anchor_filter if by_anchor else '',
+                'end_filter': self.end_filter if by_end else '',
+                'context_filter': self.context_filter % self.list_sql(context_size) if context_size != 0 else ''
+            }
+        return statement
+
+    def get_points(self, user_id, anchor_time=None, end_time=None, contexts=None, namespaces=None):
+        time_params = [t for t in (anchor_time, end_time) if t]
+
+        # Namespaces are few, so only the contexts are split
+        namespace_size = self.list_size(namespaces)
+        namespace_params = self.bind_list(namespaces, namespace_size) if namespaces else []
+
+        result = []
+        for context_chunk in self.list_chunks(contexts):
+            context_size = self.list_size(context_chunk)
+
+            # Parameters in statement order
+            params = namespace_params + [user_id] + time_params
+            if context_chunk:
+                params += self.bind_list(context_chunk, context_size)
+
+            statement = self.points_statement(namespace_size, context_size, bool(anchor_time), bool(end_time))
+            result += self.db.execute(statement, params).fetchall()
+
+        return result
+
+    def get_notes(self, point_ids):
+        result = []
+        for chunk in self.list_chunks(point_ids):
+            size = self.list_size(chunk)
+            statement = self.notes_statements.get(size)
+            if statement is None:
+                statement = self.notes_statements[size] = self.notes_query % self.list_sql(size)
+
+            result += self.db.execute(statement, self.bind_list(chunk, size)).fetchall()
+
+        return result
+
+
 class Association(object):
     def __init__(self, graph, assoc_id, src_context, dest_context, key):
         self.graph = graph
@@ -40,6 +337,9 @@ class Association(object):
         return '<Association %s to %s, key=%s, ID=%s>' % (self.src.get_id(), self.dest.get_id(), self.key, self.assoc_id)
 
 
+# Versions of context labels and attributes, unique across all contexts
+context_versions = count()
+
 class Context(object):
     def __init__(self, graph, context_id, label, attributes=None, metadata=None):
         self.graph = graph
@@ -49,6 +349,9 @@ class Context(object):
         self.attributes = attributes or {}
         self.metadata = metadata or {}
 
+        # Changes whenever the label or an attribute is set
+        self.version = context_versions.next()
+
         self.outAssoc = {}
         self.inAssoc = {}
 
@@ -65,6 +368,7 @@ class Context(object):
             self.attributes[namespace_id] = {}
 
         self.attributes[namespace_id][attr_name] = attr_val
+        self.version = context_versions.next()
         return True
 
     def get(self, attr_name, namespace_id=None, default=None):
@@ -132,12 +436,28 @@ class Context(object):
 
 
 class Graph(object):
-    def __init__(self, root_context_id=None, contexts=None, associations=None, user_id=None, db_path=None):
+    def __init__(self, root_context_id=None, contexts=None, associations=None, user_id=None, db_path=None, point_store=None,
+                    connections=None, read_pool_size=READ_POOL_SIZE):
         self.root_context_id = root_context_id
         self.contexts = contexts or {}
         self.associations = associations or {}
         self.user_id = user_id or 1
         self.db_path = db_path
+        self.point_store = point_store
+
+        # Timing and memory of load() and load_point_store()
+        self.load_metrics = {}
+
+        # (user ID, attribute namespaces) the graph was loaded with, to reload it
+        self.load_args = None
+
+        # Nesting depth of begin_batch() calls, while commits are deferred
+        self.batch_depth = 0
+        self.batch_thread = None
+        self.commit_pending = False
+
+        # Held while the point store is loaded on first use
+        self.point_store_lock = threading.Lock()
 
         if not db_path:
             raise Exception('No DB path provided')
@@ -145,7 +465,83 @@ class Graph(object):
         if not os.path.exists(db_path):
             raise Exception('DB not found at %s' % db_path)
 
-        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        if connections is None:
+            connections = ConnectionManager(db_path, pool_size=read_pool_size)
+            migrate_schema(connections.writer)
+        self.connections = connections
+
+        # All writes go through the writer, reads mostly through read_db()
+        self.db = connections.writer
+        self.point_queries = {}
+
+    def commit(self):
+        'Commit the current write, or defer it to the end of the batch'
+        if self.batch_depth:
+            self.commit_pending = True
+        else:
+            self.commit_or_reload()
+
+    def commit_or_reload(self):
+        '''Commit, or when that fails roll back and reload the graph, which
+        already has the writes applied, before raising'''
+        try:
+            self.db.commit()
+        except Exception, e:
+            print 'Commit failed, rolling back: %s' % e
+            self.db.rollback()
+            self.reload()
+            raise
+
+    def reload(self):
+        'Load the contexts and associations again from the DB, and drop everything kept of points'
+        if not self.load_args:
+            raise Exception('Graph was not loaded')
+
+        self.contexts.clear()
+        self.associations.clear()
+        self.load(*self.load_args)
+
+        # Loaded again on first use
+        self.point_store = None
+
+        # Both without details, so the caches drop everything
+        dispatcher.send(signal=STRUCTURE_CHANGED, sender=self)
+        dispatcher.send(signal=POINT_UPDATED, sender=self)
+
+    def begin_batch(self):
+        '''Group the following writes into a single transaction.
+
+        Each begin_batch() must be matched by an end_batch(), and the outermost
+        end_batch() makes one commit for all of them.
+        '''
+        self.batch_depth += 1
+        self.batch_thread = threading.current_thread()
+
+    def end_batch(self):
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.batch_thread = None
+            if self.commit_pending:
+                self.commit_pending = False
+                self.commit_or_reload()
+
+    @contextmanager
+    def read_db(self):
+        '''Connection for reads, from the read-only pool.
+
+        Within a batch the batch's own thread reads from the writer instead,
+        as pooled readers only see committed writes.
+        '''
+        if self.batch_depth and self.batch_thread is threading.current_thread():
+            yield self.db
+        else:
+            with self.connections.reader() as db:
+                yield db
+
+    def get_point_queries(self, db):
+        if db not in self.point_queries:
+            self.point_queries[db] = PointQueries(db)
+        return self.point_queries[db]
 
     def get_root(self):
         return self.contexts[self.root_context_id]
@@ -160,15 +556,18 @@ class Graph(object):
 
         return block_begin, block_end
 
-    def get_last_id(self):
+    def get_last_id(self, update=True):
+        'With update False the ID is only read, for callers holding no write access'
         root_context = self.get_context(self.root_context_id)
         last_id = root_context.get('LastID')
         last_id = int(last_id)
 
         if last_id < 3000:
-            result = self.db.execute('SELECT MAX(ID) FROM Nodes').fetchone()
+            with self.read_db() as db:
+                result = db.execute('SELECT MAX(ID) FROM Nodes').fetchone()
             last_id = int(result[0])
-            self.set_last_id(last_id)
+            if update:
+                self.set_last_id(last_id)
 
         return last_id
 
@@ -212,7 +611,7 @@ class Graph(object):
                 db = self.db
                 set_query = '''REPLACE INTO Attributes (NodeID, NameSpaceID, Name, Value) VALUES (?, ?, ?, ?)'''
                 db.execute(set_query, (int(context_id), namespace_id, str(attr_name), str(attr_value)))
-                db.commit()
+                self.commit()
 
             return context.set(namespace_id, attr_name, attr_val)
         return False
@@ -235,7 +634,7 @@ class Graph(object):
         except Exception, e:
             print 'Context %s delete failed: %s' % (context_id, e)
         else:
-            db.commit()
+            self.commit()
 
             context = self.get_context(context_id)
 
@@ -253,6 +652,7 @@ class Graph(object):
                 del self.contexts[context_id]
 
             print 'Context %s deleted' % context_id
+            dispatcher.send(signal=STRUCTURE_CHANGED, sender=self)
             return True
 
         return False
@@ -327,13 +727,15 @@ class Graph(object):
             print e, context_id, attributes
             context_id = None
         else:
-            db.commit()
+            self.commit()
 
             self.init_context(context_id, label, attributes)
 
             for assoc_id, source_id, dest_id, key in assocs:
                 self.init_assoc(assoc_id, source_id, dest_id, key)
 
+            dispatcher.send(signal=STRUCTURE_CHANGED, sender=self)
+
         return context_id
 
     def update_context(self, context_id, attributes):
@@ -360,6 +762,7 @@ class Graph(object):
                             context_id
                         ))
                         context.label = attr_val
+                        context.version = context_versions.next()
 
                     else:
                         db.execute(update_context_attr, (
@@ -374,7 +777,7 @@ class Graph(object):
         except sqlite3.IntegrityError, e:
             print e, context_id, attributes
         else:
-            db.commit()
+            self.commit()
 
         return context_id
 
@@ -404,10 +807,11 @@ class Graph(object):
         except sqlite3.IntegrityError, e:
             print 'Error adding Assoc', e, source_context_id, key, dest_context_id
         else:
-            db.commit()
+            self.commit()
 
             print 'init new assoc with id %s from %s to %s key=%s' % (assoc_id, source_context_id, dest_context_id, key)
             self.init_assoc(assoc_id, source_context_id, dest_context_id, key)
+            dispatcher.send(signal=STRUCTURE_CHANGED, sender=self)
 
         return assoc_id
 
@@ -446,7 +850,7 @@ class Graph(object):
         except Exception, e:
             print 'Error removing Assoc', e, source_context_id, key, dest_context_id
         else:
-            db.commit()
+            self.commit()
 
             if assoc_id:
                 assoc = self.associations.get(assoc_id)
@@ -457,8 +861,11 @@ class Graph(object):
                     del assoc.dest.inAssoc[assoc_id]
                     del self.associations[assoc_id]
 
+                dispatcher.send(signal=STRUCTURE_CHANGED, sender=self)
+
     def prune_to_root(self, root_context_id, assoc_key=None):
-        new_graph = Graph(db_path=self.db_path, root_context_id=root_context_id)
+        new_graph = Graph(db_path=self.db_path, root_context_id=root_context_id, point_store=self.get_point_store(),
+                            connections=self.connections)
 
         root_context = self.contexts[root_context_id].clone(new_graph)
         new_graph.contexts[root_context_id] = root_context
@@ -502,67 +909,84 @@ class Graph(object):
 
     def get_points(self, anchor_time=None, end_time=None, contexts=None, namespaces=None, user_id=None):
         'Return all points linked to any of the current contexts'
-        db = self.db
-
         user_id = user_id or self.user_id
 
-        context_query = ''
-        if contexts:
-            contexts = map(str, contexts)
-            context_query += '''
-                AND
-                Associations.DestID IN (%s)
-            ''' % ','.join(contexts)
-
-        namespace_query = ''
-        if namespaces:
-            namespace_query += '''
-                AND
-                (
-                    Attributes.NameSpaceID IS NULL
-                    OR
-                    Attributes.NameSpaceID IN (%s)
-                )
-            ''' % (','.join(map(str, namespaces)), )
-
-        range_query = ''
-        if end_time or anchor_time:
-            if anchor_time:
-                range_query += '''
-                    AND
-                    Nodes.TimeStamp <= %s
-                ''' % anchor_time
+        with self.read_db() as db:
+            result = self.get_point_queries(db).get_points(user_id, anchor_time=anchor_time, end_time=end_time,
+                        contexts=contexts, namespaces=namespaces)
+        points = self.generate_points(result)
+        return points
 
-            if end_time:
-                range_query += '''
-                    AND
-                    Nodes.TimeStamp >= %s
-                ''' % end_time
+    def get_day_rollups(self, begin_day, end_day, user_id=None):
+        '''Totals of each context's points by day, from begin_day to end_day inclusive.
+
+        Returns {epoch day: {context ID: (duration, count, IDs of points with text)}}
+        '''
+        user_id = user_id or self.user_id
 
         query = '''
-        SELECT
-            Nodes.ID, Nodes.TimeStamp, Associations.DestID, Attributes.NameSpaceID,
-            Attributes.Name, Attributes.Value
-        FROM
-            Nodes
-                LEFT OUTER JOIN Attributes ON Nodes.ID = Attributes.NodeID
-                INNER JOIN Associations ON Nodes.ID = Associations.SourceID
-        WHERE
-            Nodes.Type = 'Point'
-            AND
-            Nodes.UserID = ?
-            AND
-            Associations.Key = 'up'
-            %s
-            %s
-            %s
-        ''' % (context_query, namespace_query, range_query)
-        result = db.execute(query, (user_id,)).fetchall()
-        points = self.generate_points(result)
-        return points
+        SELECT EpochDay, ContextID, Duration, Count, NoteIDs FROM DayRollups
+        WHERE UserID = ? AND EpochDay >= ? AND EpochDay <= ?
+        '''
+
+        rollups = {}
+        with self.read_db() as db:
+            for epoch_day, context_id, duration, count, note_ids in db.execute(query, (user_id, begin_day, end_day)):
+                note_ids = map(int, note_ids.split(',')) if note_ids else []
+                rollups.setdefault(epoch_day, {})[context_id] = (duration, count, note_ids)
+
+        return rollups
+
+    def get_notes(self, point_ids):
+        'Point ID -> (time, duration, text) of the points with text among point_ids'
+        if not point_ids:
+            return {}
+
+        with self.read_db() as db:
+            result = self.get_point_queries(db).get_notes(point_ids)
+
+        notes = {}
+        for point_id, timestamp, duration, text in result:
+            if text:
+                notes[point_id] = (float(timestamp), int(float(duration or 0)), text)
+
+        return notes
+
+    def rollup_point(self, point, sign=1):
+        '''Add the point to its day rollup, or with a sign of -1 take it out, in
+        the current transaction. Returns the point's epoch day.'''
+        try:
+            epoch_day = int(math.floor(float(point['1__Time']) / 86400))
+            duration = int(float(point.get('1__Duration') or 0))
+        except (KeyError, TypeError, ValueError), e:
+            print 'Point %s not rolled up: %s' % (point.get('ID'), e)
+            return None
+
+        key = (self.user_id, epoch_day, point['1__ContextID'])
+        row = self.db.execute('SELECT Duration, Count, NoteIDs FROM DayRollups WHERE UserID = ? AND EpochDay = ? AND ContextID = ?',
+                    key).fetchone()
+
+        total, count, note_ids = row or (0, 0, None)
+        note_ids = note_ids.split(',') if note_ids else []
+
+        total += sign * duration
+        count += sign
+        if point.get('1__Text'):
+            note_id = str(point['ID'])
+            if sign > 0:
+                note_ids.append(note_id)
+            elif note_id in note_ids:
+                note_ids.remove(note_id)
+
+        if count > 0:
+            self.db.execute('INSERT OR REPLACE INTO DayRollups (UserID, EpochDay, ContextID, Duration, Count, NoteIDs) VALUES (?, ?, ?, ?, ?, ?)',
+                    key + (total, count, ','.join(note_ids) or None))
+        else:
+            self.db.execute('DELETE FROM DayRollups WHERE UserID = ? AND EpochDay = ? AND ContextID = ?', key)
+
+        return epoch_day
 
     def get_point(self, point_id, user_id=None):
-        db = self.db
         user_id = user_id or self.user_id
 
         query = '''
@@ -580,7 +1004,9 @@ class Graph(object):
             AND
             Associations.Key = 'up'
         '''
-        result = db.execute(query, (point_id,)).fetchall()
+        with self.read_db() as db:
+            result = db.execute(query, (point_id,)).fetchall()
+
         if result:
             points = self.generate_points(result)
             if points and len(points) > 0:
@@ -593,6 +1019,8 @@ class Graph(object):
         db = self.db
 
         delete_point = 'DELETE FROM Nodes WHERE UserID = ? AND ID = ? AND Type = \'Point\''
+        context_id = self.get_point_context_id(point_id)
+        point = self.get_point(point_id)
 
         try:
             db.execute(delete_point, (
@@ -602,7 +1030,16 @@ class Graph(object):
         except Exception, e:
             print 'Point %s delete failed: %s' % (point_id, e)
         else:
-            db.commit()
+            epoch_days = []
+            if point:
+                epoch_days.append(self.rollup_point(point, -1))
+            self.commit()
+
+            if self.point_store:
+                self.point_store.remove(point_id)
+
+            dispatcher.send(signal=POINT_DELETED, sender=self, point_id=point_id, context_id=context_id,
+                                epoch_days=[day for day in epoch_days if day is not None])
             return True
 
         return False
@@ -665,7 +1102,20 @@ class Graph(object):
         except sqlite3.IntegrityError, e:
             print e, point_id, attributes
         else:
-            db.commit()
+            point = {
+                'ID': point_id,
+                '1__ContextID': context_id,
+                '1__Time': timestamp
+            }
+            for attr_name, attr_val in attributes.get(1, {}).items():
+                point['1__%s' % attr_name] = attr_val
+
+            epoch_days = [self.rollup_point(point)]
+            self.commit()
+            self.refresh_stored_point(point_id)
+
+            dispatcher.send(signal=POINT_ADDED, sender=self, point_id=point_id, context_id=context_id,
+                                epoch_days=[day for day in epoch_days if day is not None])
 
         return point_id
 
@@ -677,16 +1127,26 @@ class Graph(object):
 
         update_point = 'UPDATE Nodes SET TimeStamp = ? WHERE ID = ? AND Type = \'Point\''
         update_point_attr = 'REPLACE INTO Attributes (NodeID, NameSpaceID, Name, Value, Properties) VALUES (?, ?, ?, ?, ?)'
+        delete_time_attr = 'DELETE FROM Attributes WHERE NodeID = ? AND NameSpaceID = 1 AND Name = \'Time\''
+
+        # As it was, to be moved in the day rollups
+        old_point = self.get_point(point_id)
+        timestamp = None
 
         attributes = attributes or {}
         try:
-            if 'Time' in attributes:
-                timestamp = attributes.get('Time') or time.time()
+            if 'Time' in attributes.get(1, {}):
+                timestamp = attributes[1].get('Time') or time.time()
+                del attributes[1]['Time']
+
                 result = db.execute(update_point, (
                     timestamp,
                     point_id
                 ))
 
+                # Earlier updates stored the time as an attribute, which would shadow the new one
+                db.execute(delete_time_attr, (point_id,))
+
             for namespace_id, namespace_attrs in attributes.items():
                 for attr_name, attr_val in namespace_attrs.items():
                     if namespace_id == 2001 and attr_name == 'Bonuses':
@@ -706,13 +1166,133 @@ class Graph(object):
         except sqlite3.IntegrityError, e:
             print e, point_id, attributes
         else:
-            db.commit()
+            # Days whose rollups changed
+            epoch_days = []
+
+            rolled_up_attrs = set(attributes.get(1, {})) & set(('Duration', 'Text'))
+            if old_point and (timestamp is not None or rolled_up_attrs):
+                point = dict(old_point)
+                if timestamp is not None:
+                    point['1__Time'] = timestamp
+                for attr_name, attr_val in attributes.get(1, {}).items():
+                    point['1__%s' % attr_name] = attr_val
+
+                epoch_days.append(self.rollup_point(old_point, -1))
+                epoch_days.append(self.rollup_point(point))
+
+            self.commit()
+            self.refresh_stored_point(point_id)
+
+            dispatcher.send(signal=POINT_UPDATED, sender=self, point_id=point_id,
+                                context_id=self.get_point_context_id(point_id),
+                                epoch_days=[day for day in epoch_days if day is not None])
 
         return point_id
 
+    def get_change_counter(self):
+        result = self.db.execute('SELECT Value FROM Meta WHERE Name = \'ChangeCounter\'').fetchone()
+        if result:
+            return result[0]
+
+        return None
+
+    def get_point_context_id(self, point_id):
+        if self.point_store and point_id in self.point_store.index:
+            return self.point_store.index[point_id][0]
+
+        result = self.db.execute('SELECT DestID FROM Associations WHERE SourceID = ? AND Key = \'up\'', (point_id,)).fetchone()
+        if result:
+            return result[0]
+
+        return None
+
+    def get_point_store(self):
+        if self.point_store is None:
+            with self.point_store_lock:
+                if self.point_store is None:
+                    self.point_store = self.load_point_store()
+
+        return self.point_store
+
+    def load_point_store(self, user_id=None):
+        from point_store import PointStore
+
+        user_id = user_id or self.user_id
+
+        # Only the columns the store keeps. Detail matches len(point.keys()) - 2 of the
+        # points from generate_points, where 1__Time and 1__ContextID attributes collide.
+        query = '''
+        SELECT
+            Nodes.ID, Associations.DestID, Nodes.TimeStamp, TimeAttr.Value, DurationAttr.Value,
+            (
+                SELECT COUNT(*) FROM Attributes
+                WHERE
+                    Attributes.NodeID = Nodes.ID
+                    AND NOT
+                    (IFNULL(Attributes.NameSpaceID, 1) = 1 AND Attributes.Name IN ('Time', 'ContextID'))
+            )
+        FROM
+            Nodes
+                INNER JOIN Associations ON Nodes.ID = Associations.SourceID
+                LEFT OUTER JOIN Attributes AS TimeAttr ON Nodes.ID = TimeAttr.NodeID
+                    AND IFNULL(TimeAttr.NameSpaceID, 1) = 1 AND TimeAttr.Name = 'Time'
+                LEFT OUTER JOIN Attributes AS DurationAttr ON Nodes.ID = DurationAttr.NodeID
+                    AND IFNULL(DurationAttr.NameSpaceID, 1) = 1 AND DurationAttr.Name = 'Duration'
+        WHERE
+            Nodes.UserID = ?
+            AND
+            Nodes.Type = 'Point'
+            AND
+            Associations.Key = 'up'
+        '''
+
+        def rows(db):
+            for point_id, context_id, timestamp, time_attr, duration, num_attrs in iter_rows(db.execute(query, (user_id,))):
+                try:
+                    timestamp = float(time_attr or timestamp)
+                    duration = int(float(duration or 0))
+                except (TypeError, ValueError), e:
+                    print 'Point %s not stored: %s' % (point_id, e)
+                    continue
+
+                yield point_id, context_id, timestamp, duration, num_attrs + 1
+
+        t = time.time()
+        rss_begin = memory_usage()
+
+        point_store = PointStore()
+        with self.read_db() as db:
+            point_store.load(rows(db))
+
+        rss_end = memory_usage()
+        self.load_metrics['PointStore'] = {
+            'Points': len(point_store),
+            'Seconds': time.time() - t,
+            'RSS': rss_end,
+            'RSSDelta': rss_end - rss_begin
+        }
+        print 'Point store loaded %(Points)d points in %(Seconds).2fs, RSS %(RSS)dKB (+%(RSSDelta)dKB)' % self.load_metrics['PointStore']
+
+        return point_store
+
+    def refresh_stored_point(self, point_id):
+        if self.point_store is None:
+            return
+
+        point = self.get_point(point_id)
+        if point:
+            self.point_store.put(point)
+        else:
+            self.point_store.remove(point_id)
+
     def load(self, user_id, attr_namespaces):
+        self.load_args = (user_id, attr_namespaces)
+
         db = self.db
-        context_ids = []
+        context_ids = set()
+
+        t = time.time()
+        rss_begin = memory_usage()
 
         # Retrieve all contexts for a user with namespaced attributes
         context_query = '''
@@ -732,15 +1312,15 @@ class Graph(object):
                 OR
                 Attributes.NameSpaceID IN (%s)
             )
-        ''' % ','.join(attr_namespaces)
-        contexts_result = db.execute(context_query, (user_id, )).fetchall()
+        ''' % ','.join('?' * len(attr_namespaces))
+        contexts_cursor = db.execute(context_query, [user_id] + [int(n) for n in attr_namespaces])
 
-        for row in contexts_result:
+        for row in iter_rows(contexts_cursor):
             context_id, label, timestamp, namespace_id, attr_name, attr_val = row
             context_id = int(context_id)
 
             if context_id not in context_ids:
-                context_ids.append(context_id)
+                context_ids.add(context_id)
                 self.init_context(context_id, label)
                 self.set_context_attr(context_id, 1, 'Timestamp', timestamp)
 
@@ -748,23 +1328,42 @@ class Graph(object):
                 namespace_id = int(namespace_id)
                 self.set_context_attr(context_id, namespace_id, attr_name, attr_val)
 
-        # Get all outgoing associations from retrieved contexts
+        # Get all outgoing associations from retrieved contexts, joined on the
+        # context nodes so that point associations aren't scanned
         # TODO: Namespaced/keyed
         assoc_query = '''
         SELECT
-            ID, SourceID, DestID, Key
+            Associations.ID, Associations.SourceID, Associations.DestID, Associations.Key
         FROM
-            Associations
+            Nodes
+                INNER JOIN Associations ON Nodes.ID = Associations.SourceID
         WHERE
-            UserID = ?
+            Nodes.UserID = ?
             AND
-            SourceID in (%s)
-        ''' % ','.join(map(str, context_ids))
-        assoc_result = db.execute(assoc_query, (user_id, )).fetchall()
+            Nodes.Type = 'Context'
+            AND
+            Associations.UserID = ?
+        '''
+        assoc_cursor = db.execute(assoc_query, (user_id, user_id))
 
-        for row in assoc_result:
+        num_assocs = 0
+        for row in iter_rows(assoc_cursor):
             assoc_id, source_id, dest_id, key = row
+            if source_id not in context_ids:
+                continue
+
             self.init_assoc(assoc_id, source_id, dest_id, key)
+            num_assocs += 1
+
+        rss_end = memory_usage()
+        self.load_metrics['Graph'] = {
+            'Contexts': len(context_ids),
+            'Associations': num_assocs,
+            'Seconds': time.time() - t,
+            'RSS': rss_end,
+            'RSSDelta': rss_end - rss_begin
+        }
+        print 'Graph loaded %(Contexts)d contexts and %(Associations)d associations in %(Seconds).2fs, RSS %(RSS)dKB (+%(RSSDelta)dKB)' % self.load_metrics['Graph']
 
         return self
 
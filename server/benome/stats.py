@@ -0,0 +1,63 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last
+# bucket counting everything slower
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, perc):
+        'Upper bound of the bucket holding the percentile, or the max when beyond the last'
+        if not self.count:
+            return None
+
+        rank = self.count * perc / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                break
+
+        return self.max
+
+    def summary(self):
+        return {
+            'Count': self.count,
+            'Mean': self.total / self.count if self.count else None,
+            'P50': self.percentile(50),
+            'P95': self.percentile(95),
+            'P99': self.percentile(99),
+            'Max': self.max,
+            'Buckets': dict(zip(map(str, self.buckets) + ['Inf'], self.counts))
+        }
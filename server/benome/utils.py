@@ -85,22 +85,82 @@ class CompactID(object):
         return block_begin, block_end
 
 
+class RawJSON(str):
+    'Already encoded JSON, inserted by json_dumps as it is'
+    pass
+
+def simplejson_encoder():
+    return simplejson.dumps
+
+# Floats needing all 17 significant digits to round-trip
+FLOAT_PROBE = [0.1 + 0.2, 1700000000.1234567, 2.0 / 3]
+
+def ujson_encoder():
+    import ujson
+
+    # Forward slashes as simplejson leaves them
+    def encode(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+
+    # Only used where floats come out as simplejson's repr. ujson 1.x rounds
+    # them to at most 15 digits. Exponents still differ, 1e-05 being 1e-5.
+    if encode(FLOAT_PROBE) != '[%s]' % ','.join(map(repr, FLOAT_PROBE)):
+        raise ImportError('ujson rounds floats')
+
+    return encode
+
+# Tried in order for json_encode, the first that imports is used
+JSON_ENCODERS = (ujson_encoder, simplejson_encoder)
+
+def load_json_encoder(encoders=JSON_ENCODERS):
+    for encoder in encoders:
+        try:
+            return encoder()
+        except ImportError:
+            continue
+
+json_encode = load_json_encoder()
+
+def set_json_encoder(encoder):
+    'Replace the encoder used for responses, a function from an object to a JSON string'
+    global json_encode
+    json_encode = encoder
+
+def json_dumps(obj):
+    '''Encode obj with json_encode, leaving RawJSON fragments as they are.
+
+    Fragments are found as obj itself, items of a list or tuple, or values of a dict.
+    '''
+    if isinstance(obj, RawJSON):
+        return str(obj)
+
+    if isinstance(obj, (list, tuple)):
+        if any(isinstance(value, RawJSON) for value in obj):
+            return '[%s]' % ', '.join(value if isinstance(value, RawJSON) else json_dumps(value) for value in obj)
+
+    elif isinstance(obj, dict):
+        if any(isinstance(value, RawJSON) for value in obj.itervalues()):
+            return '{%s}' % ', '.join('%s: %s' % (json_encode(key if isinstance(key, basestring) else str(key)),
+                                        json_dumps(value)) for key, value in obj.iteritems())
+
+    return json_encode(obj)
+
 def json_response(d):
     from flask import make_response
 
-    response = make_response(simplejson.dumps(d))
+    response = make_response(json_dumps(d))
     response.headers['Content-Type'] = 'application/json'
     response.headers['Cache-Control'] = 'no-cache, private'
 
     return response
 
-def json_get(url, return_code=False, timeout=5):
+def json_get(url, return_code=False, timeout=5, headers=None):
     import requests
 
-    headers = {
+    headers = dict({
         'Content-type': 'application/json',
         'Accept': 'application/json'
-    }
+    }, **(headers or {}))
 
     try:
         r = requests.get(url, headers=headers, timeout=timeout)
@@ -14,4 +14,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Benome. If not, see http://www.gnu.org/licenses/.
 
-DATA_HISTORY_PATH = '/opt/benome/DataHistoryDev.db'
\ No newline at end of file
+DATA_HISTORY_PATH = '/opt/benome/DataHistoryDev.db'
+
+# Directory of the users' data directories, for containers bound to a user
+# after starting
+DATA_ROOT = '/opt/benome/data'
+
+# Seconds between checks for a settled graph to snapshot. A snapshot is written
+# once the DB has changed and then stayed unchanged for a full interval.
+SNAPSHOT_INTERVAL = 15
+
+# Group commit: queued write commands are run in one transaction, waiting at most
+# this many seconds after the first for more to arrive, up to this many writes.
+# A max size of 1 commits every write on its own.
+GROUP_COMMIT_MAX_LATENCY = 0.001
+GROUP_COMMIT_MAX_SIZE = 200
+
+# Threads running read commands concurrently, see ContainerExec. With none,
+# reads run in queue order with everything else.
+EXEC_READ_WORKERS = 4
+
+# Users' graphs kept loaded by a container serving many users. Past it, the least
+# recently used is snapshotted and unloaded.
+MAX_TENANTS = 50
+
+# Read workers and read-only connections of each of those graphs, kept low as
+# they add up over the tenants. Their snapshot and refresh timers are shared.
+TENANT_READ_WORKERS = 1
+TENANT_READ_CONNECTIONS = 1
+
+# Processes generating the days of week and month reports in parallel. With none,
+# days are generated in the requesting thread.
+REPORT_POOL_SIZE = 0
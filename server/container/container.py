@@ -25,17 +25,30 @@ import datetime
 import simplejson
 import atexit
 import random
+import hmac
 from uuid import uuid4
 from Queue import Empty
+from threading import Thread, Lock, Timer
+from collections import OrderedDict
 
-from flask import Flask, request
+from flask import Flask, request, g
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user
 
 from enc_data import EncryptedVolume
 from benome.utils import json_response, json_post
+from config import DATA_ROOT, MAX_TENANTS, TENANT_READ_WORKERS, TENANT_READ_CONNECTIONS, SNAPSHOT_INTERVAL
 
 app = Flask(__name__)
 
+# Seconds given the /exit response to go out before the process exits
+EXIT_DELAY = 0.1
+
+# Put before the data routes of a container serving many users
+TENANT_PREFIX = '/u/<user_id>'
+
+# Header carrying the secret a pooled container was started with, on /bind
+BIND_TOKEN_HEADER = 'X-Benome-Bind-Token'
+
 SECRET_FILE = os.path.normpath(os.path.join('.', 'SECRET.key'))
 try:
     secret_key = open(SECRET_FILE).read().strip()
@@ -61,6 +74,10 @@ class BenomeAuthError(BenomeContainerException):
 class BenomeDataError(BenomeContainerException):
     pass
 
+class ContainerUnavailable(Exception):
+    'The container is shutting down, or its graph was unloaded'
+    pass
+
 @app.errorhandler(Exception)
 def api_exception_handler(error):
     return_code = 200
@@ -104,6 +121,15 @@ def init_user(user_id):
 def load_user(user_id):
     return init_user(user_id)
 
+def exit_process(onexit):
+    '''Exit once the response is out, after onexit as the atexit handlers would
+    have run. exit() would only end the request's thread.'''
+    def run():
+        onexit()
+        os._exit(0)
+
+    Timer(EXIT_DELAY, run).start()
+
 # def ensure_data(f):
 #     def new_f(*args, **kwargs):
 #         validate_auth()
@@ -111,31 +137,81 @@ def load_user(user_id):
 #         return f(*args, **kwargs)
 #     return new_f
 
+def restrict_to_user(data_dir, uid):
+    '''Give the user's data directory to the UID and run as the UID from now on,
+    so no other user's data under the mounted data root can be opened'''
+    if os.getuid() != 0:
+        raise BenomeContainerException('Not running as root, cannot restrict data access')
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    for dir_path, dir_names, file_names in os.walk(data_dir):
+        os.lchown(dir_path, uid, uid)
+        for file_name in file_names:
+            os.lchown(os.path.join(dir_path, file_name), uid, uid)
+    os.chmod(data_dir, 0700)
+
+    os.setgroups([])
+    os.setgid(uid)
+    os.setuid(uid)
+
 class Container(object):
-    def __init__(self, app, enc_vol, user_id, data_dir, data_path, setup=True):
+    def __init__(self, app, enc_vol, user_id=None, data_dir=None, data_path=None, setup=True, exec_options=None):
         self.app = app
         self.enc_vol = enc_vol
-        self.user_id = user_id
-        self.data_dir = data_dir
-        self.data_path = data_path
+        self.user_id = None
+        self.data_dir = None
+        self.data_path = None
+
+        # Keyword arguments of the ContainerExec
+        self.exec_options = exec_options or {}
 
         self.api_disabled = False
 
-        # Start the task runner thread
-        from container_exec import ContainerExec
-        self.container_exec = ContainerExec(self.user_id, self.data_path)
-        self.container_exec.begin()
+        self.container_exec = None
+        self.exec_bundles = []
+        self.bind_lock = Lock()
 
-        if self.exec_cmd('init'):
-            print 'Database loaded'
-        else:
-            raise Exception('Database not initialized')
+        if user_id:
+            self.bind(user_id, data_dir, data_path)
 
         if setup:
             self.setup()
 
+    def bind(self, user_id, data_dir, data_path):
+        'Load the user\'s data. Started without a user, a pooled container waits for this.'
+        with self.bind_lock:
+            if self.container_exec:
+                raise BenomeContainerException('Container already bound to %s' % self.user_id)
+
+            self.user_id = user_id
+            self.data_dir = data_dir
+            self.data_path = data_path
+
+            # Start the task runner thread
+            from container_exec import ContainerExec
+            container_exec = ContainerExec(self.user_id, self.data_path, **self.exec_options)
+            container_exec.begin()
+            self.container_exec = container_exec
+
+            if self.exec_cmd('init'):
+                print 'Database loaded'
+            else:
+                raise Exception('Database not initialized')
+
+            for cls in self.exec_bundles:
+                container_exec.add_exec_bundle(cls)
+
+            if self.exec_cmd('inituser'):
+                print 'User initialized'
+            else:
+                print 'User exists'
+
     def setup(self):
         self.app.add_url_rule('/ping', 'ping', self.ping, methods=['GET'])
+        self.app.add_url_rule('/bind', 'bind', self.bind_user, methods=['GET'])
+        self.app.add_url_rule('/exec_stats', 'exec_stats', self.exec_stats, methods=['GET'])
         self.app.add_url_rule('/sync', 'sync', self.sync, methods=['GET'])
         self.app.add_url_rule('/exit', 'exit', self.exit, methods=['GET'])
 
@@ -145,26 +221,27 @@ class Container(object):
         import atexit
         atexit.register(self.onexit)
 
-        if self.exec_cmd('inituser'):
-            print 'User initialized'
-        else:
-            print 'User exists'
-
     def onexit(self):
-        print 'Flushing command queue'
-        self.container_exec.flush(save=True)
-        print 'Done'
+        if self.container_exec:
+            print 'Flushing command queue'
+            self.container_exec.flush(save=True)
+            print 'Done'
 
         if self.enc_vol:
             print self.enc_vol.close()
             print 'Encrypted volume unmounted'
 
     def add_exec_bundle(self, cls):
-        self.container_exec.add_exec_bundle(cls)
+        self.exec_bundles.append(cls)
+        if self.container_exec:
+            self.container_exec.add_exec_bundle(cls)
 
     def exec_cmd(self, cmd, params=None, timeout=30, disable=False):
         if self.api_disabled:
-            raise Exception('Interface is not available')
+            raise ContainerUnavailable('Interface is not available')
+
+        if not self.container_exec:
+            raise BenomeDataError('No user bound')
 
         if disable:
             self.api_disabled = True
@@ -172,7 +249,8 @@ class Container(object):
         if params is None:
             params = []
 
-        q = self.container_exec.add(cmd, *params)
+        # Not worth running once the caller has given up on the result
+        q = self.container_exec.submit(cmd, params, deadline=time.time() + timeout)
         try:
             success, result = q.get(True, timeout)
         except Empty:
@@ -198,12 +276,60 @@ class Container(object):
 
     def ping(self):
         if self.api_disabled:
-            raise Exception('Interface is not available')
+            raise ContainerUnavailable('Interface is not available')
+
+        from benome.sql_db import memory_usage
+
+        return json_response({
+            'Success': True,
+            'UserID': self.user_id,
+            'RSS': memory_usage()
+        })
+
+    def bind_user(self):
+        token = os.environ.get('BENOME_BIND_TOKEN')
+        supplied_token = request.headers.get(BIND_TOKEN_HEADER, '')
+        if isinstance(supplied_token, unicode):
+            supplied_token = supplied_token.encode('utf-8')
+
+        if not token or not hmac.compare_digest(supplied_token, token):
+            raise BenomeAuthError('Unauthorized')
+
+        user_id = request.args.get('UserID', None)
+        if not user_id or not re.match(r'^[\w-]+$', user_id):
+            raise BenomeContainerException('Invalid UserID')
+
+        try:
+            uid = int(request.args.get('UID'))
+        except (TypeError, ValueError):
+            raise BenomeContainerException('Invalid UID')
+
+        # Imported while the code can still be read as root
+        from history_log import init_history_db
+        from report import stop_report_pool
+
+        with self.bind_lock:
+            if self.container_exec:
+                raise BenomeContainerException('Container already bound to %s' % self.user_id)
+
+            data_dir = os.path.join(os.environ.get('BENOME_DATA_ROOT', DATA_ROOT), user_id)
+
+            # Its processes would keep running as root, so reports are generated in process
+            stop_report_pool()
+            restrict_to_user(data_dir, uid)
+
+        # The history DB outside it can no longer be written
+        init_history_db(os.path.join(data_dir, 'DataHistory.db'))
+
+        self.bind(user_id, data_dir, os.path.join(data_dir, 'sql.db'))
 
         return json_response({
             'Success': True
         })
 
+    def exec_stats(self):
+        return json_response(self.container_exec.stats.summary())
+
     def sync(self):
         self.exec_cmd('shutdown', disable=True)
 
@@ -212,7 +338,11 @@ class Container(object):
         })
 
     def exit(self):
-        exit(0)
+        exit_process(self.onexit)
+
+        return json_response({
+            'Success': True
+        })
 
     def auth(self):
         if current_user and current_user.is_authenticated() and self.enc_vol and self.enc_vol.is_open(quick=True):
@@ -255,6 +385,200 @@ class Container(object):
 
         return json_response('Closed'), 200
 
+class Tenants(object):
+    '''Many users served by one container, each user's graph loaded on their
+    first request under /u/<user_id>.
+
+    Past max_tenants the graph of the least recently served user is synced,
+    writing its snapshot, and unloaded. The snapshot makes loading it again
+    quick. Large users can still have a container of their own.
+
+    Each graph gets few read workers and connections, and one timer thread
+    snapshots and refreshes them all.
+    '''
+
+    def __init__(self, app, data_root, max_tenants=MAX_TENANTS):
+        self.app = app
+        self.data_root = data_root
+        self.max_tenants = max_tenants
+        self.exec_bundles = []
+
+        # User ID -> Container bound to the user, least recently used first
+        self.containers = OrderedDict()
+        self.lock = Lock()
+
+        # Held while loading a user's graph, so it is only loaded once. Kept
+        # until the graph is unloaded.
+        self.user_locks = {}
+
+        self.exec_options = {
+            'read_workers': TENANT_READ_WORKERS,
+            'read_connections': TENANT_READ_CONNECTIONS,
+            'timers': False
+        }
+        self.tick_interval = SNAPSHOT_INTERVAL
+        self.running = False
+
+        self.app.url_value_preprocessor(self.pull_user_id)
+
+    def setup(self):
+        self.app.add_url_rule('/ping', 'ping', self.ping, methods=['GET'])
+        self.app.add_url_rule(TENANT_PREFIX + '/exec_stats', 'exec_stats', self.exec_stats, methods=['GET'])
+        self.app.add_url_rule(TENANT_PREFIX + '/sync', 'sync', self.sync, methods=['GET'])
+        self.app.add_url_rule('/exit', 'exit', self.exit, methods=['GET'])
+
+        atexit.register(self.onexit)
+        self.begin()
+
+    def begin(self):
+        self.running = True
+
+        thread = Thread(target=self.run_timers, name='Tenants-timers')
+        thread.daemon = True
+        thread.start()
+
+    def run_timers(self):
+        while self.running:
+            time.sleep(self.tick_interval)
+
+            with self.lock:
+                containers = self.containers.items()
+
+            for user_id, container in containers:
+                try:
+                    container.container_exec.tick()
+                except Exception, e:
+                    print 'Timer error for user %s: %s' % (user_id, e)
+
+    @staticmethod
+    def pull_user_id(endpoint, values):
+        # Routes are shared with single user containers, so take it out of their arguments
+        if values and 'user_id' in values:
+            g.user_id = values.pop('user_id')
+
+    def onexit(self):
+        self.running = False
+        with self.lock:
+            containers, self.containers = self.containers, OrderedDict()
+
+        for user_id, container in containers.items():
+            self.unload(user_id, container)
+
+    def add_exec_bundle(self, cls):
+        self.exec_bundles.append(cls)
+
+    def get(self, user_id):
+        'The container of the user, loading the user\'s graph if not loaded'
+        if not re.match(r'^[\w-]+$', user_id):
+            raise BenomeContainerException('Invalid UserID')
+
+        while True:
+            with self.lock:
+                container = self.containers.pop(user_id, None)
+                if container:
+                    self.containers[user_id] = container
+                    return container
+
+                user_lock = self.user_locks.setdefault(user_id, Lock())
+
+            user_lock.acquire()
+            with self.lock:
+                container = self.containers.get(user_id)
+                # Dropped by unload if it was free, before it was taken here
+                current = self.user_locks.get(user_id) is user_lock
+
+            if container is None and current:
+                break
+
+            user_lock.release()
+            if container:
+                return container
+
+        try:
+            container = self.load(user_id)
+
+            with self.lock:
+                self.containers[user_id] = container
+
+                evicted = []
+                while len(self.containers) > self.max_tenants:
+                    evicted.append(self.containers.popitem(last=False))
+        finally:
+            user_lock.release()
+
+        for evicted_user_id, evicted_container in evicted:
+            self.unload(evicted_user_id, evicted_container)
+
+        return container
+
+    def load(self, user_id):
+        data_dir = os.path.join(self.data_root, user_id)
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+
+        container = Container(self.app, None, setup=False, exec_options=self.exec_options)
+        for cls in self.exec_bundles:
+            container.add_exec_bundle(cls)
+
+        container.bind(user_id, data_dir, os.path.join(data_dir, 'sql.db'))
+        return container
+
+    def unload(self, user_id, container):
+        with self.lock:
+            # Unless the user is being loaded again
+            user_lock = self.user_locks.get(user_id)
+            if user_lock and user_id not in self.containers and user_lock.acquire(False):
+                del self.user_locks[user_id]
+                user_lock.release()
+
+        try:
+            container.exec_cmd('shutdown', disable=True)
+        except Exception, e:
+            print 'Error unloading graph of user %s: %s' % (user_id, e)
+        else:
+            print 'Unloaded graph of user %s' % user_id
+
+    def exec_cmd(self, cmd, params=None, timeout=30, disable=False):
+        from container_exec import ExecStopped
+
+        try:
+            return self.get(g.user_id).exec_cmd(cmd, params=params, timeout=timeout, disable=disable)
+        except (ContainerUnavailable, ExecStopped):
+            # Unloaded meanwhile, with the command not run, so loaded again
+            return self.get(g.user_id).exec_cmd(cmd, params=params, timeout=timeout, disable=disable)
+
+    def validate_auth(self):
+        return self.get(g.user_id).validate_auth()
+
+    def ping(self):
+        from benome.sql_db import memory_usage
+
+        return json_response({
+            'Success': True,
+            'Tenants': len(self.containers),
+            'RSS': memory_usage()
+        })
+
+    def exec_stats(self):
+        return json_response(self.get(g.user_id).container_exec.stats.summary())
+
+    def sync(self):
+        with self.lock:
+            container = self.containers.pop(g.user_id, None)
+
+        if container:
+            self.unload(g.user_id, container)
+
+        return json_response({
+            'Success': True
+        })
+
+    def exit(self):
+        exit_process(self.onexit)
+
+        return json_response({
+            'Success': True
+        })
 
 def get_config():
     user_id = os.environ.get('BENOME_USERID')
@@ -264,7 +588,17 @@ def get_config():
     multi_user = os.environ.get('BENOME_MULTI_USER') == '1'
     sys_auth_token = os.environ.get('BENOME_SYS_AUTH_TOKEN', 'SYS_AUTH_TOKEN')
 
-    if user_id and data_dir:
+    if multi_user:
+        # Users come with each request
+        user_id = None
+        data_dir = None
+        port = int(os.environ.get('BENOME_CONTAINER_PORT'))
+    elif os.environ.get('BENOME_POOLED') == '1':
+        # Started ahead of need, bound to a user later
+        user_id = None
+        data_dir = None
+        port = int(os.environ.get('BENOME_CONTAINER_PORT'))
+    elif user_id and data_dir:
         controller_url = os.environ.get('BENOME_CONTROLLER_URL')
         auth_token = os.environ.get('BENOME_CONTROLLER_AUTHTOKEN')
 
@@ -333,6 +667,10 @@ if __name__ == '__main__':
 
     print 'Listening on %s:%d' % (host, port)
 
+    # Forked before any threads are started
+    from report import start_report_pool
+    start_report_pool()
+
     enc_vol = None
     if data_encrypt:
         print 'Data is encrypted'
@@ -346,18 +684,28 @@ if __name__ == '__main__':
     from history_log import init_history_db
     init_history_db(DATA_HISTORY_PATH)
 
-    container = Container(app, enc_vol, user_id, data_dir, os.path.join(data_dir, 'graph.db'), setup=False)
-
-    # Core
     from routes import Routes as DataRoutes
-    data_routes = DataRoutes(app, container)
-
     from data import DataExec
-    container.add_exec_bundle(DataExec)
 
-    container.setup()
+    if multi_user:
+        print 'Serving many users'
+        tenants = Tenants(app, os.environ.get('BENOME_DATA_ROOT', DATA_ROOT))
+        data_routes = DataRoutes(app, tenants, prefix=TENANT_PREFIX)
+        tenants.add_exec_bundle(DataExec)
+        tenants.setup()
+    else:
+        container = Container(app, enc_vol, setup=False)
+
+        # Core
+        data_routes = DataRoutes(app, container)
+        container.add_exec_bundle(DataExec)
+
+        container.setup()
+
+        if user_id:
+            container.bind(user_id, data_dir, os.path.join(data_dir, 'sql.db'))
 
     try:
-        app.run(debug=True, host=host, port=port, threaded=False, use_reloader=False)
+        app.run(debug=True, host=host, port=port, threaded=True, use_reloader=False)
     except Exception, e:
         print e
@@ -17,8 +17,25 @@
 import os
 import time
 import simplejson
-from threading import Thread, Timer
-from Queue import Queue, Empty
+from itertools import count
+from threading import Thread, Timer, Condition, Lock
+from Queue import Queue, PriorityQueue, Empty
+
+from config import SNAPSHOT_INTERVAL, GROUP_COMMIT_MAX_LATENCY, GROUP_COMMIT_MAX_SIZE, EXEC_READ_WORKERS
+from exec_stats import ExecStats
+
+# FIXME: hardcoded namespace/app ID
+ATTR_NAMESPACES = ['1', '2001']
+
+# Command priorities, lowest first. A queued command of a higher priority
+# runs before any of a lower one, and commands of equal priority in the
+# order they were queued.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+# Sorts ahead of every command, to wake and stop the exec threads
+PRIORITY_STOP = -1
 
 class CommandNotFound(Exception):
     pass
@@ -26,8 +43,53 @@ class CommandNotFound(Exception):
 class CommandError(Exception):
     pass
 
+class CommandExpired(Exception):
+    pass
+
+class ExecStopped(Exception):
+    'A command left queued when the exec thread stopped'
+    pass
+
+class ReadWriteLock(object):
+    '''Any number of readers or a single writer.
+
+    A waiting writer keeps new readers out, so it only waits for the reads
+    already running.
+    '''
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
 class ContainerExec(Thread):
-    def __init__(self, user_id, data_path):
+    def __init__(self, user_id, data_path, read_workers=EXEC_READ_WORKERS, read_connections=None, timers=True):
         Thread.__init__(self)
         self.daemon = True
 
@@ -35,56 +97,309 @@ class ContainerExec(Thread):
         self.data_path = data_path
 
         self.do_stop = False
-        self.queue = Queue()
         self.running = False
 
+        # (priority, sequence, item)
+        self.queue = PriorityQueue()
+        self.sequence = count()
+
         self.cache = {}
         self.exec_bundles = []
 
+        # Command -> priority, PRIORITY_NORMAL when not listed
+        self.cmd_priorities = {
+            'init': PRIORITY_INTERACTIVE,
+            'save': PRIORITY_BATCH
+        }
+
+        # Commands that only write, which can share a transaction
+        self.write_cmds = set()
+
+        # Commands that only read, which run concurrently on the read workers.
+        # Everything else runs in order on this thread, with no reads running.
+        self.read_cmds = set()
+        self.read_queue = PriorityQueue()
+        self.num_read_workers = read_workers
+        self.num_read_connections = read_connections
+        self.read_workers = []
+        self.rw_lock = ReadWriteLock()
+
+        # Reads that only query the DB through read_db(), so only see committed
+        # writes and run alongside them without the lock
+        self.db_read_cmds = set()
+
+        # Reads handed to the workers and not yet finished
+        self.reads_pending = 0
+        self.reads_lock = Lock()
+
+        self.stats = ExecStats()
+        self.max_batch_latency = GROUP_COMMIT_MAX_LATENCY
+        self.max_batch_size = GROUP_COMMIT_MAX_SIZE
+
+        self.data = None
+        self.persist_interval = SNAPSHOT_INTERVAL
+        self.persist_timer = None
+
+        # Without timers of its own, tick() is called from a shared one
+        self.timers = timers
+
+        # Change counter of the DB when the snapshot was written or loaded,
+        # and when it was last checked while waiting for writes to settle
+        self.snapshot_path = None
+        self.snapshot_counter = None
+        self.settle_counter = None
+
     def add_exec_bundle(self, cls):
-        self.exec_bundles.append(cls(self))
+        bundle = cls(self)
+        self.exec_bundles.append(bundle)
+        self.write_cmds.update(getattr(bundle, 'write_cmds', ()))
+        self.read_cmds.update(getattr(bundle, 'read_cmds', ()))
+        self.db_read_cmds.update(getattr(bundle, 'db_read_cmds', ()))
+        self.cmd_priorities.update(getattr(bundle, 'cmd_priorities', {}))
+
+    def command_class(self, cmd):
+        if cmd in self.read_cmds:
+            return 'read'
+        return 'write'
 
     def flush(self, save=True):
-        while not self.queue.empty():
+        while self.running and (not self.queue.empty() or self.reads_pending):
             time.sleep(0.1)
 
         return True
 
     def db_persist_timer(self):
+        if self.do_stop:
+            return
+
+        # Through the command queue, as the graph is only used from the exec thread
+        self.add('save')
+
         self.persist_timer = Timer(self.persist_interval, self.db_persist_timer)
         self.persist_timer.daemon = True
         self.persist_timer.start()
 
+    def tick(self):
+        'What the timers would do, for containers run from one shared timer'
+        if self.do_stop:
+            return
+
+        self.add('save')
+        for bundle in self.exec_bundles:
+            tick = getattr(bundle, 'tick', None)
+            if tick:
+                tick()
+
     def begin(self):
         if not self.running:
             self.running = True
             self.start()
 
+            for i in range(self.num_read_workers):
+                worker = Thread(target=self.run_reads, name='ContainerExec-read-%d' % i)
+                worker.daemon = True
+                worker.start()
+                self.read_workers.append(worker)
+
     def stop_thread(self):
         self.do_stop = True
         self.running = False
 
+        if self.persist_timer:
+            self.persist_timer.cancel()
+
+        # Bundles may have timers of their own
+        for bundle in self.exec_bundles:
+            stop = getattr(bundle, 'stop', None)
+            if stop:
+                stop()
+
+        self.queue.put((PRIORITY_STOP, self.sequence.next(), None))
+        for worker in self.read_workers:
+            self.read_queue.put((PRIORITY_STOP, self.sequence.next(), None))
+
     def add(self, cmd, *args, **kwargs):
+        return self.submit(cmd, args, kwargs)
+
+    def submit(self, cmd, args=(), kwargs=None, priority=None, deadline=None):
+        '''Queue a command, returning the queue its (success, result) is put on.
+
+        A command still queued at its deadline, in seconds since the epoch,
+        is dropped with CommandExpired rather than run.
+        '''
+        if priority is None:
+            priority = self.cmd_priorities.get(cmd, PRIORITY_NORMAL)
+
         result_queue = Queue()
-        self.queue.put((cmd, args, kwargs, result_queue))
+        self.stats.queued(cmd, self.command_class(cmd))
+
+        item = (cmd, args, kwargs or {}, result_queue, time.time(), deadline)
+        self.queue.put((priority, self.sequence.next(), item))
         return result_queue
 
     def run(self):
         self.running = True
         while not self.do_stop:
-            try:
-                cmd, args, kwargs, result_queue = self.queue.get(True, 1)
-            except Empty:
+            # Without a timeout, as a timed get polls in steps of up to 50ms
+            priority, sequence, item = self.queue.get()
+            if item is None:
+                break
+
+            cmd = item[0]
+            if cmd in self.read_cmds and self.num_read_workers:
+                with self.reads_lock:
+                    self.reads_pending += 1
+                self.read_queue.put((priority, sequence, item))
                 continue
-            except Exception:
+
+            if self.expired(item):
                 continue
 
+            self.rw_lock.acquire_write()
+            try:
+                if cmd in self.write_cmds and self.max_batch_size > 1:
+                    self.run_batch(item)
+                else:
+                    self.run_item(item)
+            finally:
+                self.rw_lock.release_write()
+
+        self.fail_queued()
+
+    def fail_queued(self):
+        'Answer the commands left queued on stopping, so callers can retry elsewhere'
+        for queue in (self.queue, self.read_queue):
+            stops = []
+            while True:
+                try:
+                    entry = queue.get(False)
+                except Empty:
+                    break
+
+                item = entry[2]
+                if item is None:
+                    stops.append(entry)
+                else:
+                    item[3].put((False, ExecStopped('Stopped before running %s' % item[0])))
+
+            # Still wanted by the read workers
+            for entry in stops:
+                queue.put(entry)
+
+    def expired(self, item):
+        'Drop the command if it is past its deadline'
+        cmd, args, kwargs, result_queue, queued_at, deadline = item
+
+        now = time.time()
+        if deadline is None or now < deadline:
+            return False
+
+        self.stats.dropped(cmd, self.command_class(cmd), now - queued_at)
+        result_queue.put((False, CommandExpired('Command %s expired after %.1fs' % (cmd, now - queued_at))))
+        return True
+
+    def execute(self, item):
+        'Run a queued command, returning (success, result)'
+        cmd, args, kwargs, result_queue, queued_at, deadline = item
+
+        begin_time = time.time()
+        try:
+            result = self.handle_item(cmd, args, kwargs)
+        except Exception, e:
+            import traceback; traceback.print_exc()
+            success, result = False, e
+        else:
+            success = True
+
+        self.stats.done(cmd, self.command_class(cmd), begin_time - queued_at, time.time() - begin_time, success)
+        return success, result
+
+    def run_item(self, item):
+        item[3].put(self.execute(item))
+
+    def run_reads(self):
+        while not self.do_stop:
+            priority, sequence, item = self.read_queue.get()
+            if item is None:
+                break
+
             try:
-                result = self.handle_item(cmd, args, kwargs)
-                result_queue.put((True, result))
+                if self.expired(item):
+                    pass
+                elif item[0] in self.db_read_cmds:
+                    self.run_read(item)
+                else:
+                    self.rw_lock.acquire_read()
+                    try:
+                        self.run_read(item)
+                    finally:
+                        self.rw_lock.release_read()
+            finally:
+                with self.reads_lock:
+                    self.reads_pending -= 1
+
+    def run_read(self, item):
+        if self.do_stop:
+            # Shut down while this waited, its connections closed
+            item[3].put((False, ExecStopped('Stopped before running %s' % item[0])))
+            return
+
+        success, result = self.execute(item)
+        if not success and self.do_stop:
+            # Connections closed under a read running without the lock
+            result = ExecStopped('Stopped while running %s' % item[0])
+        item[3].put((success, result))
+
+    def next_batch_item(self, deadline):
+        'The next queued write arriving before the deadline, or None'
+        timeout = deadline - time.time()
+        try:
+            if timeout > 0:
+                entry = self.queue.get(True, timeout)
+            else:
+                entry = self.queue.get(False)
+        except Empty:
+            return None
+
+        item = entry[2]
+        if item is None or item[0] not in self.write_cmds:
+            # Keeps its place, to run after the batch
+            self.queue.put(entry)
+            return None
+
+        if self.expired(item):
+            return self.next_batch_item(deadline)
+
+        return item
+
+    def run_batch(self, item):
+        '''Run consecutive queued writes in one transaction.
+
+        Results are only returned once the transaction has committed, so each
+        caller's acknowledgement means its write is durable.
+        '''
+        data = self.data
+        results = []
+
+        deadline = time.time() + self.max_batch_latency
+        data.begin_batch()
+        try:
+            while item:
+                success, result = self.execute(item)
+                results.append((item[3], success, result))
+
+                if len(results) >= self.max_batch_size:
+                    break
+                item = self.next_batch_item(deadline)
+        finally:
+            try:
+                data.end_batch()
             except Exception, e:
                 import traceback; traceback.print_exc()
-                result_queue.put((False, e))
+                results = [(result_queue, False, e) for result_queue, success, result in results]
+
+        for result_queue, success, result in results:
+            result_queue.put((success, result))
 
     def handle_item(self, cmd, args, kwargs):
         try:
@@ -94,6 +409,8 @@ class ContainerExec(Thread):
                 return self.init_user()
             elif cmd == 'shutdown':
                 return self.shutdown()
+            elif cmd == 'save':
+                return self.save()
             else:
                 return self.ext_exec(cmd, args, kwargs)
             
@@ -124,13 +441,20 @@ class ContainerExec(Thread):
         if not data_path:
             data_path = self.data_path
 
-        # FIXME: direct substitution into path, hardcoded namespace/app ID
-        from benome.sql_db import Graph
-        db_path = '/opt/benome/data/%s/sql.db' % self.user_id
-        g = Graph(root_context_id=1000, db_path=db_path)
-        g.load(1, ['1', '2001'])
+        from benome.sql_db import Graph, READ_POOL_SIZE
+        from benome.snapshot import load_snapshot
+        db_path = data_path
+        self.snapshot_path = os.path.join(os.path.dirname(db_path), 'graph.snapshot')
+
+        g = Graph(root_context_id=1000, db_path=db_path, read_pool_size=self.num_read_connections or READ_POOL_SIZE)
+        self.snapshot_counter = load_snapshot(g, self.snapshot_path, 1, ATTR_NAMESPACES)
+        if self.snapshot_counter is None:
+            g.load(1, ATTR_NAMESPACES)
         self.data = g
 
+        if self.timers and not self.persist_timer:
+            self.db_persist_timer()
+
         return True
 
     def init_user(self):
@@ -157,9 +481,38 @@ class ContainerExec(Thread):
 
         # return False
 
-    def save(self):
-        pass
+    def save(self, settled=False):
+        '''Snapshot the graph if it changed since the last snapshot.
+
+        Unless settled is set, the DB must also be unchanged since the previous
+        call, so that a burst of writes is followed by a single snapshot.
+        '''
+        if self.data is None or not self.snapshot_path:
+            return False
+
+        change_counter = self.data.get_change_counter()
+        if change_counter == self.snapshot_counter:
+            return False
+
+        if not settled and change_counter != self.settle_counter:
+            self.settle_counter = change_counter
+            return False
+
+        from benome.snapshot import save_snapshot
+        try:
+            self.snapshot_counter = save_snapshot(self.data, self.snapshot_path, ATTR_NAMESPACES)
+        except (IOError, OSError), e:
+            print 'Snapshot failed: %s' % e
+            return False
+
+        return True
 
     def shutdown(self):
+        self.save(settled=True)
+
+        # Not flushed, as this runs on the exec thread that would drain the queue
         self.stop_thread()
-        self.flush(save=True)
\ No newline at end of file
+
+        # No reads run alongside, this running as a write
+        if self.data is not None:
+            self.data.connections.close()
\ No newline at end of file
@@ -0,0 +1,192 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+from operator import itemgetter
+
+from benome.utils import RawJSON, json_dumps
+from benome.events import dispatcher, POINT_ADDED, POINT_UPDATED, POINT_DELETED, STRUCTURE_CHANGED
+
+# Newest point times kept per context, as many as a context score uses
+RECENT_POINTS = 10
+
+def score_details(pts, anchor_time, adjust_delta, target_interval, include_adjustment=True):
+    '''Score a context from the times of its newest points, newest first.
+
+    The recent intervals are averages of the gaps from the anchor time back
+    through the points, which add up to the age of the oldest point used.
+    '''
+    time_since = None
+    time_since_adjusted = None
+    score = None
+    recent_interval_5 = None
+    recent_interval_10 = None
+
+    if pts:
+        time_since = anchor_time - pts[0]
+
+    if len(pts) > 1:
+        recent_5 = pts[:5]
+        recent_10 = pts[:10]
+        recent_interval_5 = float(anchor_time - recent_5[-1]) / float(len(recent_5))
+        recent_interval_10 = float(anchor_time - recent_10[-1]) / float(len(recent_10))
+
+        # Linear proportion between time since last action and recent average interval
+        # Clamped to between 0.0 and 1.0 for now to keep it simple
+        # 0 = just done
+        # 0.5 = do soon
+        # 1.0 = way overdue
+
+        if target_interval:
+            score_interval = target_interval
+        else:
+            score_interval = recent_interval_5
+
+        time_since_adjusted = time_since
+        if include_adjustment:
+            time_since_adjusted += adjust_delta
+
+        score = max(0, min(1.0, 0.5 * (time_since_adjusted / score_interval)))
+
+    return {
+        'TimeSince': time_since,
+        'TimeSinceAdjusted': time_since_adjusted,
+        'CurrentScore': score,
+        'TargetInterval': target_interval,
+        'RecentInterval_5': recent_interval_5,
+        'RecentInterval_10': recent_interval_10,
+        'Weight': 1.0,
+    }
+
+# Keys of score_details, in the order they are encoded
+SCORE_KEYS = ('TimeSince', 'TimeSinceAdjusted', 'CurrentScore', 'TargetInterval',
+                'RecentInterval_5', 'RecentInterval_10', 'Weight')
+
+SCORE_JSON = '{%s}' % ', '.join('"%s": %%s' % key for key in SCORE_KEYS)
+get_scores = itemgetter(*SCORE_KEYS)
+
+def encode_number(value):
+    'A number or None as simplejson encodes it'
+    if value is None:
+        return 'null'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def score_json(details):
+    'Encode score_details output, faster than a general encoder as the keys and types are fixed'
+    return SCORE_JSON % tuple(map(encode_number, get_scores(details)))
+
+class ContextView(object):
+    '''get_contexts rows, kept between calls.
+
+    Per context, the attributes encoded as JSON and the score parameters are
+    kept until the context changes, and the times of its newest points until one of its
+    points is written. A score only depends on those and the anchor time, so
+    it is computed for any anchor without going to the point store.
+    '''
+
+    def __init__(self, graph, format_context):
+        self.graph = graph
+        self.format_context = format_context
+
+        # Context ID -> (context version, JSON attributes, AdjustDelta,
+        # TargetFrequency). Versions are unique across contexts, so a replaced
+        # context never matches.
+        self.rows = {}
+
+        # Context ID -> newest point times, newest first
+        self.recent = {}
+
+        # IDs of the contexts without children, which are the ones scored
+        self.leaf_ids = None
+
+        for signal in (POINT_ADDED, POINT_UPDATED, POINT_DELETED):
+            dispatcher.connect(self.point_changed, signal=signal, sender=graph)
+        dispatcher.connect(self.structure_changed, signal=STRUCTURE_CHANGED, sender=graph)
+
+    def point_changed(self, context_id=None):
+        if context_id is None:
+            self.recent.clear()
+        else:
+            self.recent.pop(context_id, None)
+
+    def structure_changed(self):
+        self.leaf_ids = None
+
+    def row(self, context):
+        context_id = context.get_id()
+
+        row = self.rows.get(context_id)
+        if row is None or row[0] != context.version:
+            attributes = self.format_context(context)
+            del attributes['MetaData']
+            del attributes['Properties']
+
+            # Without the closing brace, for the score to be appended
+            attributes = json_dumps(attributes)[:-1]
+
+            adjust_delta = float(context.get('AdjustDelta', 0) or 0)
+            target_interval = float(context.get('TargetFrequency', 0) or 0)
+
+            row = (context.version, attributes, adjust_delta, target_interval)
+            self.rows[context_id] = row
+
+        return row
+
+    def recent_times(self, context_id):
+        times = self.recent.get(context_id)
+        if times is None:
+            times = []
+            series = self.graph.get_point_store().get_series(context_id)
+            if series:
+                times = series.times[-RECENT_POINTS:]
+                times.reverse()
+
+            self.recent[context_id] = times
+
+        return times
+
+    def point_times(self, context_id, begin_time, end_time):
+        'Times of the newest points with begin_time <= time <= end_time, newest first'
+        times = self.recent_times(context_id)
+        if times and times[0] > end_time:
+            # Anchored before the newest points, which the kept times may not reach
+            times = self.graph.get_point_store().get_times([context_id], begin_time, end_time)[-RECENT_POINTS:]
+            times.reverse()
+            return times
+
+        return [t for t in times if t >= begin_time]
+
+    def get(self, anchor_time, interval):
+        begin_time = anchor_time - interval
+
+        if self.leaf_ids is None:
+            self.leaf_ids = set(c.get_id() for c in self.graph.get_leaves())
+
+        result = []
+        for context_id, context in self.graph.contexts.items():
+            version, attributes, adjust_delta, target_interval = self.row(context)
+
+            details = {}
+            if context_id in self.leaf_ids:
+                point_times = self.point_times(context_id, begin_time, anchor_time)
+                if point_times:
+                    pts = [t for t in point_times if t]
+                    details = score_details(pts, anchor_time, adjust_delta, target_interval)
+            context.set_metadata(details)
+
+            details_json = score_json(details) if details else '{}'
+            result.append(RawJSON('%s, "MetaData": %s, "Properties": {}}' % (attributes, details_json)))
+
+        return result
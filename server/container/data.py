@@ -21,10 +21,23 @@ import simplejson
 import pytz
 from copy import deepcopy
 
-from container_exec import CommandNotFound
+from threading import Timer, Lock
+
+from container_exec import CommandNotFound, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+from query_cache import DataQueryCache, day_anchor
+from context_view import ContextView, RECENT_POINTS, score_details
+from fragments import PointFragments
+from report_cache import ReportCache
+from benome.utils import RawJSON, json_dumps
 
 tz = pytz.timezone('GMT')
 
+# data_query segments: (number of segments, segment size, variance rolling window)
+DATA_QUERY_CONFIG = (30, 86400, 86400 * 5)
+
+# Seconds past each day boundary to recompute data_query
+DATA_QUERY_REFRESH_DELAY = 60
+
 class DataExec(object):
     def __init__(self, CE):
         self.CE = CE
@@ -52,10 +65,83 @@ class DataExec(object):
             'update-association': self.methods.update_association,
             'delete-association': self.methods.delete_association,
 
+            'get-load': self.methods.get_load,
+
             'get-report': self.methods.get_report,
             'data-query': self.methods.data_query
         }
 
+        # Run in batches that commit once, see ContainerExec.run_batch
+        self.write_cmds = set([
+            'add-context', 'update-context', 'delete-context',
+            'add-point', 'update-point', 'delete-point',
+            'add-association', 'update-association', 'delete-association'
+        ])
+
+        # Run concurrently on the read workers, see ContainerExec.run. Must not
+        # change the graph, or only under a lock of their own.
+        self.read_cmds = set([
+            'get-root-context-id', 'get-contexts', 'get-points', 'get-point',
+            'get-associations', 'get-load', 'get-report', 'data-query'
+        ])
+
+        # Reads that go to the DB alone, which skip the exec lock and so are
+        # not held up by writes. The rest read the graph or caches that writes
+        # change, such as the point fragments.
+        self.db_read_cmds = set(['get-point'])
+
+        # Single-record reads and all writes go ahead of whole-graph reads,
+        # reports and analytics. Writes share a priority to keep their order.
+        self.cmd_priorities = {
+            'get-root-context-id': PRIORITY_INTERACTIVE,
+            'get-id-block': PRIORITY_INTERACTIVE,
+            'get-last-id': PRIORITY_INTERACTIVE,
+            'get-point': PRIORITY_INTERACTIVE,
+
+            'get-report': PRIORITY_BATCH,
+            'data-query': PRIORITY_BATCH
+        }
+        for cmd in self.write_cmds:
+            self.cmd_priorities[cmd] = PRIORITY_INTERACTIVE
+
+        self.stopped = False
+        self.refresh_timer = None
+        self.refresh_time = None
+        self.schedule_refresh()
+
+    def stop(self):
+        'Called by ContainerExec.stop_thread, so nothing keeps the graph once it is unloaded'
+        self.stopped = True
+        if self.refresh_timer:
+            self.refresh_timer.cancel()
+
+    def schedule_refresh(self):
+        'Roll data_query over to the new day in the background, so reads stay warm'
+        if self.stopped:
+            return
+
+        self.refresh_time = day_anchor(time.time()) + DATA_QUERY_REFRESH_DELAY
+
+        # Otherwise tick() is called from a timer shared by many containers
+        if self.CE.timers:
+            self.refresh_timer = Timer(self.refresh_time - time.time(), self.refresh)
+            self.refresh_timer.daemon = True
+            self.refresh_timer.start()
+
+    def tick(self):
+        if time.time() >= self.refresh_time:
+            self.refresh()
+
+    def refresh(self):
+        if self.stopped:
+            return
+
+        # Through the command queue, as the graph is only used from the exec thread
+        if self.methods.query_cache.key is not None:
+            self.CE.add('data-query')
+
+        self.schedule_refresh()
+
     def exec_cmd(self, cmd, args, kwargs):
         func = self.cmd_map.get(cmd)
         if func:
@@ -70,6 +156,14 @@ class DataExec(object):
 class DataMethods(object):
     def __init__(self, ext):
         self.ext = ext
+        self.query_cache = DataQueryCache(ext.data, self.compute_data_query)
+
+        self.context_view = ContextView(ext.data, self.format_context)
+        self.point_fragments = PointFragments(ext.data, self.format_point)
+        self.report_cache = ReportCache(ext.data)
+
+        # get_contexts stores scores in the context metadata
+        self.contexts_lock = Lock()
 
     def get_root_context_id(self):
         if self.ext:
@@ -119,144 +213,35 @@ class DataMethods(object):
         if interval is None:
             interval = (86400 * 7 * 4)
 
-        end_time = anchor_time - interval
-
-        points = self.get_points(root_context_id, anchor_time=anchor_time, interval=interval)
-        # Grouped by context
-        context_points = {}
-        for point in points:
-            context_id = point['1__ContextID']
-            if context_id not in context_points:
-                context_points[context_id] = []
-            context_points[context_id].append(point)
-
-        # Sort each context
-        for context_id, points in context_points.items():
-            context_points[context_id] = sorted(points, key=lambda p: p['1__Time'], reverse=False)
-
-        # Calculate the context scores
-        result = []
-        contexts = self.ext.data.contexts
-        self.interior_aggregate(root_context_id, contexts)
-        for context_id, context in contexts.items():
-            score_details = {}
-            if context.is_leaf() and context_id in context_points:
-                score_details = self.calc_context_score(context_id, points=context_points[context_id], anchor_time=anchor_time)
-            context.set_metadata(score_details)
-
-            result.append(self.format_context(context))
-
-        return result
-
-    def interior_aggregate(self, current_context_id, contexts):
-        context = contexts.get(current_context_id)
-        if not context:
-            return None
-
-        child_ids = context.outV('down', ids_only=True)
-        if not child_ids:
-            return context.metadata.get('CurrentScore', None)
-
-        total_score = 0
-        num_scores = 0
-        for child_id in child_ids:
-            child_score = self.interior_aggregate(child_id, contexts)
-            if child_score is None:
-                continue
-
-            total_score += child_score
-            num_scores += 1
-
-        current_score = 0
-        if num_scores > 0:
-            current_score = total_score / num_scores
-
-        context.metadata['CurrentScore'] = current_score
-
-        return current_score
+        with self.contexts_lock:
+            return self.context_view.get(anchor_time, interval)
 
-    def calc_context_score(self, context_id, points=None, anchor_time=None, include_adjustment=True):
+    def calc_context_score(self, context_id, points=None, point_times=None, anchor_time=None, include_adjustment=True,
+                                interval=None):
         data = self.ext.data
 
         if not anchor_time:
             anchor_time = int(time.time())
 
-        def calc_avg_interval(pts, anchor_time):
-            # pts sorted high to low
-            intervals = []
-            last_time = anchor_time
-            for point_time in pts:
-                intervals.append(last_time - point_time)
-                last_time = point_time
-
-            return float(sum(intervals)) / float(len(intervals))
-
-        filtered_points = []
-        time_since = None
-        time_since_adjusted = None
-        score = None
-        recent_interval_5 = None
-        recent_interval_10 = None
-
-        if not points:
-            interval = (86400 * 30)
-            points = self.get_points(context_id, anchor_time=anchor_time, interval=interval)
+        if points:
+            point_times = [p['1__Time'] for p in points]
+        elif point_times is None:
+            if interval is None:
+                interval = (86400 * 30)
+            point_times = data.get_point_store().get_times([context_id], anchor_time - interval, anchor_time)
 
         context = data.get_context(context_id)
         adjust_delta = float(context.get('AdjustDelta', 0) or 0)
         target_interval = float(context.get('TargetFrequency', 0) or 0)
 
-        # Simplify structure
-        for p in points:
-            point_time = p['1__Time']
-
-            # Remove points ahead of the anchor time (in case it is in the past)
-            if not point_time or point_time > anchor_time:
-               continue
+        # Remove points ahead of the anchor time (in case it is in the past)
+        pts = [t for t in point_times if t and t <= anchor_time]
 
-            filtered_points.append({
-                'PointID': p['ID'],
-                'Time': point_time
-            })
-
-        pts = [p['Time'] for p in filtered_points]
         # Now largest (newest) to smallest (oldest)
         pts.sort(reverse=True)
-        pts = pts[:10]
-
-        if pts:
-            time_since = anchor_time - pts[0]
+        pts = pts[:RECENT_POINTS]
 
-        if len(pts) > 1:
-            recent_interval_5 = calc_avg_interval(pts[:5], anchor_time)
-            recent_interval_10 = calc_avg_interval(pts[:10], anchor_time)
-
-            # Linear proportion between time since last action and recent average interval
-            # Clamped to between 0.0 and 1.0 for now to keep it simple
-            # 0 = just done
-            # 0.5 = do soon
-            # 1.0 = way overdue
-
-            if target_interval:
-                score_interval = target_interval
-            else:
-                score_interval = recent_interval_5
-
-            time_since_adjusted = time_since
-            if include_adjustment:
-                time_since_adjusted += adjust_delta
-
-            score = max(0, min(1.0, 0.5 * (time_since_adjusted / score_interval)))
-        
-        return {
-            'TimeSince': time_since,
-            'TimeSinceAdjusted': time_since_adjusted,
-            'CurrentScore': score,
-            'TargetInterval': target_interval,
-            'RecentInterval_5': recent_interval_5,
-            'RecentInterval_10': recent_interval_10,
-            'Weight': 1.0,
-        }
+        return score_details(pts, anchor_time, adjust_delta, target_interval, include_adjustment=include_adjustment)
 
     def delete_context(self, context_id):
         data = self.ext.data
@@ -447,7 +432,7 @@ class DataMethods(object):
         end_time = anchor_time - interval
 
         points = self.ext.data.get_points(anchor_time=anchor_time, end_time=end_time, user_id=1)
-        return [self.format_point(p) for p in points]
+        return [self.point_fragments.get(p) for p in points]
 
     def get_point(self, point_id):
         data = self.ext.data
@@ -642,18 +627,22 @@ class DataMethods(object):
         return self.format_point(data.get_point(point_id))
 
     def data_query(self):
+        anchor_time = day_anchor(time.time())
+        return self.query_cache.get(anchor_time, DATA_QUERY_CONFIG)
+
+    def compute_data_query(self, anchor_time, config, aggregates=None, context_ids=None):
         data = self.ext.data
 
-        anchor_time = int(time.time())
         big_result = {}
-        num_segments = 30 # days
+        num_segments, segment_size, rolling_window = config
+        window = segment_size * num_segments
 
         if 1:
             from benome.quality import all_frequencies
-            window = 86400 * num_segments
 
             t = time.time()
-            result = all_frequencies(data, anchor_time, window, num_segments)
+            result = all_frequencies(data, anchor_time, window, num_segments, aggregates=aggregates,
+                                        context_ids=context_ids)
 
             for context_id, context_result in result.items():
                 if context_id not in big_result:
@@ -665,7 +654,7 @@ class DataMethods(object):
             from benome.quality import all_quality
 
             t = time.time()
-            result = all_quality(data, anchor_time, num_segments)
+            result = all_quality(data, anchor_time, num_segments, aggregates=aggregates, context_ids=context_ids)
 
             for context_id, context_result in result.items():
                 if context_id not in big_result:
@@ -675,12 +664,10 @@ class DataMethods(object):
 
         if 1:
             from benome.quality import all_variance
-            window = 86400 * num_segments
-            segment_size = 86400 * 1
-            rolling_window = 86400 * 5
 
             t = time.time()
-            result = all_variance(data, anchor_time, window, rolling_window, segment_size)
+            result = all_variance(data, anchor_time, window, rolling_window, segment_size, aggregates=aggregates,
+                                    context_ids=context_ids)
 
             for context_id, context_result in result.items():
                 if context_id not in big_result:
@@ -690,6 +677,23 @@ class DataMethods(object):
 
         return big_result
 
+    def get_load(self, root_context_id, anchor_time=None):
+        '''Contexts, points, associations and the last ID in one command.
+
+        Run as one read, so no write lands between the parts. Contexts and
+        points are encoded here, leaving the response ready to be passed on as is.
+        '''
+        if not anchor_time:
+            anchor_time = int(time.time())
+
+        return {
+            'ContextID': root_context_id,
+            'LastID': self.ext.data.get_last_id(update=False),
+            'Points': RawJSON(json_dumps(self.get_points(root_context_id, anchor_time=anchor_time))),
+            'Contexts': RawJSON(json_dumps(self.get_contexts(root_context_id, anchor_time=anchor_time))),
+            'Associations': self.get_associations(root_context_id)
+        }
+
     def get_report(self, context_id, interval, day=None, month=None, year=None, begin_date=None,
                         max_depth=None, leaf_notes=True, leaf_note_timing=False, public=False):
         data = self.ext.data
@@ -697,6 +701,6 @@ class DataMethods(object):
         from report import get_report as get_report_ext
         report = get_report_ext(data, context_id, interval, day=day, month=month, year=year, 
                     begin_date=begin_date, max_depth=max_depth, leaf_notes=leaf_notes,
-                    leaf_note_timing=leaf_note_timing, public=public)
+                    leaf_note_timing=leaf_note_timing, public=public, cache=self.report_cache)
 
         return report
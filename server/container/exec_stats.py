@@ -0,0 +1,89 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+import threading
+
+from benome.stats import LatencyHistogram
+
+class CommandStats(object):
+    'Queue depth, latencies and drops of a command or class of commands'
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.errors = 0
+        self.drops = 0
+        self.wait = LatencyHistogram()
+        self.service = LatencyHistogram()
+
+    def summary(self):
+        return {
+            'Depth': self.depth,
+            'MaxDepth': self.max_depth,
+            'Errors': self.errors,
+            'Drops': self.drops,
+            'WaitMs': self.wait.summary(),
+            'ServiceMs': self.service.summary()
+        }
+
+class ExecStats(object):
+    '''Metrics of ContainerExec, per command and per command class.
+
+    Wait is from when a command was queued until it started running, service
+    is how long it ran. Depth counts commands queued or running. Drops are
+    commands past their deadline when they came to run.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.classes = {}
+        self.commands = {}
+
+    def get_stats(self, cmd, cmd_class):
+        if cmd_class not in self.classes:
+            self.classes[cmd_class] = CommandStats()
+        if cmd not in self.commands:
+            self.commands[cmd] = CommandStats()
+        return self.classes[cmd_class], self.commands[cmd]
+
+    def queued(self, cmd, cmd_class):
+        with self.lock:
+            for stats in self.get_stats(cmd, cmd_class):
+                stats.depth += 1
+                stats.max_depth = max(stats.max_depth, stats.depth)
+
+    def done(self, cmd, cmd_class, wait, service, success=True):
+        with self.lock:
+            for stats in self.get_stats(cmd, cmd_class):
+                stats.depth -= 1
+                stats.wait.add(wait)
+                stats.service.add(service)
+                if not success:
+                    stats.errors += 1
+
+    def dropped(self, cmd, cmd_class, wait):
+        with self.lock:
+            for stats in self.get_stats(cmd, cmd_class):
+                stats.depth -= 1
+                stats.wait.add(wait)
+                stats.drops += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                'Classes': dict((cmd_class, stats.summary()) for cmd_class, stats in self.classes.items()),
+                'Commands': dict((cmd, stats.summary()) for cmd, stats in self.commands.items())
+            }
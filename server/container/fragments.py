@@ -0,0 +1,53 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+from benome.utils import RawJSON, json_dumps
+from benome.events import dispatcher, POINT_UPDATED, POINT_DELETED
+
+# Points kept before the cache is emptied and starts over
+MAX_POINT_FRAGMENTS = 200000
+
+class PointFragments(object):
+    'Formatted points encoded as JSON, kept until the point is updated or deleted'
+
+    def __init__(self, graph, format_point, max_size=MAX_POINT_FRAGMENTS):
+        self.format_point = format_point
+        self.max_size = max_size
+
+        # Point ID -> RawJSON
+        self.fragments = {}
+
+        for signal in (POINT_UPDATED, POINT_DELETED):
+            dispatcher.connect(self.point_changed, signal=signal, sender=graph)
+
+    def point_changed(self, point_id=None):
+        if point_id is None:
+            self.fragments.clear()
+        else:
+            self.fragments.pop(point_id, None)
+
+    def get(self, point):
+        point_id = point['ID']
+
+        fragment = self.fragments.get(point_id)
+        if fragment is None:
+            fragment = RawJSON(json_dumps(self.format_point(point)))
+
+            if len(self.fragments) >= self.max_size:
+                self.fragments.clear()
+            self.fragments[point_id] = fragment
+
+        return fragment
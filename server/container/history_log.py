@@ -15,6 +15,7 @@
 # along with Benome. If not, see http://www.gnu.org/licenses/.
 
 import simplejson
+from threading import Lock
 from functools import wraps
 from flask import request
 
@@ -23,6 +24,10 @@ data_history_db = None
 class DataHistoryDB(object):
     def __init__(self, db):
         self._db = db
+
+        # Requests are served from several threads, sharing the connection
+        self.lock = Lock()
+
         self.init_db()
 
     def db(self, new=False):
@@ -44,21 +49,22 @@ class DataHistoryDB(object):
 
     def add(self, method, url, args, form, json):
         db = self.db()
-        cursor = db.cursor()
 
         query = 'INSERT INTO RequestHistory (Method, Url, Args, Form, Json) VALUES (?, ?, ?, ?, ?)'
-        result = cursor.execute(query, (
-            method,
-            url,
-            simplejson.dumps(args),
-            simplejson.dumps(form),
-            simplejson.dumps(json)
-        ))
-        db.commit()
+        with self.lock:
+            cursor = db.cursor()
+            result = cursor.execute(query, (
+                method,
+                url,
+                simplejson.dumps(args),
+                simplejson.dumps(form),
+                simplejson.dumps(json)
+            ))
+            db.commit()
 
 def init_history_db(db_path='./DataHistory.db'):
     import sqlite3
-    db = sqlite3.connect(db_path)
+    db = sqlite3.connect(db_path, check_same_thread=False)
 
     global data_history_db
     data_history_db = DataHistoryDB(db)
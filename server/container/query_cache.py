@@ -0,0 +1,101 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+from threading import Lock
+
+from benome.events import dispatcher, POINT_ADDED, POINT_UPDATED, POINT_DELETED, STRUCTURE_CHANGED
+from benome.quality import context_aggregates
+
+def day_anchor(timestamp):
+    'End of the UTC day containing timestamp'
+    return (int(timestamp) // 86400 + 1) * 86400
+
+class DataQueryCache(object):
+    '''data_query results per context, for one anchor day and segment config.
+
+    A point write marks its context and every context above it as stale, and
+    only those are recomputed on the next read. Adding or removing contexts or
+    associations drops everything, as does moving to a new anchor or config.
+    '''
+
+    def __init__(self, graph, compute):
+        self.graph = graph
+
+        # compute(anchor_time, config, aggregates=None, context_ids=None)
+        self.compute = compute
+
+        # Held by get(), which can run on several read workers at once
+        self.lock = Lock()
+
+        self.clear()
+
+        for signal in (POINT_ADDED, POINT_UPDATED, POINT_DELETED):
+            dispatcher.connect(self.point_changed, signal=signal, sender=graph)
+        dispatcher.connect(self.clear, signal=STRUCTURE_CHANGED, sender=graph)
+
+    def clear(self):
+        self.key = None
+        self.results = {}
+        self.aggregates = None
+        self.stale = set()
+
+    def point_changed(self, context_id=None):
+        if self.key is None or context_id is None:
+            return
+
+        if self.aggregates:
+            self.aggregates.invalidate(context_id)
+        self.stale.update(self.ancestors(context_id))
+
+    def ancestors(self, context_id):
+        'The context and all contexts above it'
+        contexts = self.graph.contexts
+        result = set()
+
+        pending = [context_id]
+        while pending:
+            context_id = pending.pop()
+            if context_id in result or context_id not in contexts:
+                continue
+
+            result.add(context_id)
+            pending.extend(contexts[context_id].outV('up', ids_only=True))
+
+        return result
+
+    def get(self, anchor_time, config):
+        with self.lock:
+            return self.get_results(anchor_time, config)
+
+    def get_results(self, anchor_time, config):
+        key = (anchor_time, config)
+
+        if key != self.key:
+            self.clear()
+            self.aggregates = context_aggregates(self.graph)
+            self.results = self.compute(anchor_time, config, aggregates=self.aggregates)
+            self.key = key
+
+        elif self.stale:
+            stale = self.stale
+            self.stale = set()
+
+            for context_id in stale:
+                self.results.pop(context_id, None)
+
+            self.results.update(self.compute(anchor_time, config, aggregates=self.aggregates, context_ids=stale))
+
+        return dict(self.results)
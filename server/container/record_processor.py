@@ -49,12 +49,16 @@ class RecordProcessor(object):
             period_end = period_begin - self.raw_record_interval
 
         # Pull relevant records
-        points = self.data.get_points(contexts=[base_context.get_id()], anchor_time=period_begin, end_time=period_end)
+        points = self.data.get_points(contexts=self.record_contexts(base_context), anchor_time=period_begin, end_time=period_end)
         if not points:
             raise Exception('No results found in period %d to %d' % (period_begin, period_end))
 
         return points
 
+    def record_contexts(self, base_context):
+        'IDs of the contexts whose points are bucketed'
+        return [base_context.get_id()]
+
     def bucket_records(self, points):
         # Run through these records, bucketing by day
         day_buckets = {}
@@ -62,9 +66,9 @@ class RecordProcessor(object):
         for point in points:
             common_details = {
                 'BeginTime': point['1__Time'],
-                'EndTime': point['1__EndTime'],
-                'Duration': point['1__Duration'],
-                'Text': point['1__Text']
+                'EndTime': point.get('1__EndTime'),
+                'Duration': point.get('1__Duration', 0),
+                'Text': point.get('1__Text')
             }
 
             attr = None
@@ -21,8 +21,16 @@ import simplejson
 import datetime
 import pytz
 
+from config import REPORT_POOL_SIZE
+
 tz = pytz.timezone('GMT')
 
+# Seconds to wait for the pool to generate a report's days
+REPORT_POOL_TIMEOUT = 30
+
+# Processes generating the days of multi-day reports, see start_report_pool
+report_pool = None
+
 def generate_days(range_type, day=None, month=None, year=None, begin_date=None):
     from datetime import date, datetime
     import time
@@ -122,102 +130,119 @@ def get_epoch_month(begin_time=None, begin_date=None):
     epoch_month = range(month_begin, month_begin + month_length)
     return epoch_month
 
-def gen_idx(g, period, num_periods, begin_time=None):
-    if not begin_time:
-        begin_time = time.time()
-    end_time = begin_time - (period * num_periods)
-
-    period_idx = {}
-    points = g.get_points(anchor_time=begin_time, end_time=end_time)
-
-    begin_epoch_day = get_epoch_day(begin_time)
-
-    for point in points:
-        ts = float(point['1__Time'])
-        period_num = begin_epoch_day - int(math.floor((begin_time - ts) / period))
-
-        if period_num not in period_idx:
-            period_idx[period_num] = []
-
-        common_details = {
-            'BeginTime': point['1__Time'],
-            'EndTime': point.get('1__EndTime', None),
-            'Duration': int(float(point.get('1__Duration', 0))),
-            'Text': point.get('1__Text', '')
-        }
-
-        period_idx[period_num].append({
-            'ContextID': point['1__ContextID'],
-            'CommonDetails': common_details
-        })
-
-    return period_idx
-
-def create_structure(period_num, period_idx):
-    structure = {}
-    if period_num in period_idx:
-        for point in period_idx[period_num]:
-            context_id = point['ContextID']
-            if context_id not in structure:
-                structure[context_id] = []
-
-            structure[context_id].append(point)
-
-    return structure
-
-def compute_day_results(point_idx, epoch_day, context, structure, level=0):
-    context_id = context.get_id()
-    context_details = {
-        'Context': context,
-        'ContextID': context_id,
-        'TotalTime': 0,
-        'SelfTotalTime': 0,
-        'ChildTotalTime': 0,
-        'ProportionalTime': 0.0,
-        'RecordNotes': None,
-        'Children': []
-    }
-
-    # Get all records for current context
-    self_total = 0
-    for child_rec in structure.get(context_id, []):
-        self_total += child_rec['CommonDetails']['Duration']
-    context_details['SelfTotalTime'] = self_total
-
-    child_total = 0
-    down_vertexes = context.outV('down')
-    if down_vertexes:
-        for child_vertex in down_vertexes:
-            child_details = compute_day_results(point_idx, epoch_day, child_vertex, structure, level=level+1)
-            context_details['Children'] += child_details
-            child_total += sum([child_detail['TotalTime'] for child_detail in child_details])
-
-    # Data points
-    day_points = point_idx.get(epoch_day, [])
-    record_notes = []
-
-    for point in day_points:
-        timestamp = point['CommonDetails'].get('BeginTime')
-        if not timestamp:
-            continue
-
-        if point.get('ContextID') != context_id:
-            continue
-
-        description = point['CommonDetails'].get('Text', None)
-        duration = point['CommonDetails'].get('Duration', 0)
-
-        if description:
-            record_notes.append((duration, map(str.strip, str(description.strip()).split('\n'))))
-
-    context_details['ChildTotalTime'] = child_total
-    context_details['TotalTime'] = child_total + self_total
-    context_details['RecordNotes'] = record_notes
-
-    if level == 0:
-        return context_details
-    else:
-        return [context_details]
+def gen_idx(g, days, leaf_notes=True):
+    '''Day rollups of the days, and the notes of their points when wanted.
+
+    Reads a row per day and context with points, however many points there are.
+    '''
+    rollups = g.get_day_rollups(min(days), max(days))
+
+    # The days may not be consecutive, when some are cached
+    wanted = set(days)
+    rollups = dict((epoch_day, day_rollups) for epoch_day, day_rollups in rollups.items() if epoch_day in wanted)
+
+    notes = {}
+    if leaf_notes:
+        note_ids = []
+        for day_rollups in rollups.values():
+            for duration, count, point_ids in day_rollups.values():
+                note_ids += point_ids
+
+        notes = g.get_notes(note_ids)
+
+    return rollups, notes
+
+class ContextLabel(object):
+    'The ID and label of a context, all that reports use of it, to pass to other processes'
+
+    def __init__(self, context_id, label):
+        self.context_id = context_id
+        self.label = label
+
+    def get_id(self):
+        return self.context_id
+
+class ReportTree(object):
+    '''The contexts under a report's root, in pre-order with the position of
+    each one's parent.
+
+    Built once per report. Each day is then totalled in passes over these
+    lists, children being after their parents, rather than by walking the graph.
+    '''
+
+    def __init__(self, root):
+        self.contexts = []
+        self.context_ids = []
+        self.parents = []
+
+        # Changes with the label or attributes of any of the contexts
+        self.version = None
+
+        stack = [(root, -1)]
+        while stack:
+            context, parent = stack.pop()
+            position = len(self.contexts)
+
+            self.contexts.append(context)
+            self.context_ids.append(context.get_id())
+            self.parents.append(parent)
+            self.version = max(self.version, context.version)
+
+            # Reversed, so children are visited in their usual order
+            for child in reversed(context.outV('down')):
+                stack.append((child, position))
+
+    def compute(self, self_totals, record_notes):
+        '''Nested details of the root and its descendants for a day, from each
+        context's own total and notes'''
+        details = []
+        for context, context_id in zip(self.contexts, self.context_ids):
+            self_total = self_totals.get(context_id, 0)
+            details.append({
+                'Context': context,
+                'ContextID': context_id,
+                'TotalTime': self_total,
+                'SelfTotalTime': self_total,
+                'ChildTotalTime': 0,
+                'ProportionalTime': 0.0,
+                'RecordNotes': record_notes.get(context_id, []),
+                'Children': []
+            })
+
+        # In reverse, a context's total is complete before it is added to its parent's
+        parents = self.parents
+        for position in xrange(len(details) - 1, 0, -1):
+            total_time = details[position]['TotalTime']
+            parent_details = details[parents[position]]
+            parent_details['ChildTotalTime'] += total_time
+            parent_details['TotalTime'] += total_time
+
+        for position in xrange(1, len(details)):
+            details[parents[position]]['Children'].append(details[position])
+
+        return details[0]
+
+    def __getstate__(self):
+        # Contexts hold the whole graph, so only their labels are pickled
+        state = self.__dict__.copy()
+        state['contexts'] = [ContextLabel(context_id, context.label)
+                                for context_id, context in zip(self.context_ids, self.contexts)]
+        return state
+
+def compute_day_results(day_rollups, notes, tree):
+    self_totals = {}
+    record_notes = {}
+
+    for context_id, (duration, count, note_ids) in day_rollups.items():
+        self_totals[context_id] = duration
+
+        # Notes in time order
+        context_notes = sorted(notes[point_id] for point_id in note_ids if point_id in notes)
+        if context_notes:
+            record_notes[context_id] = [(duration, map(str.strip, str(description.strip()).split('\n')))
+                                            for timestamp, duration, description in context_notes]
+
+    return tree.compute(self_totals, record_notes)
 
 def format_time(interval, time_unit):
     if time_unit == 'hours':
@@ -315,23 +340,98 @@ def construct_report(report_data, days, context_name='Activity', public=False, d
     report += '\n\n'.join(report_days) + '\n\n'
     return report
 
-def generate_report_days(root, period_idx, days, max_depth, leaf_notes, leaf_note_timing):
+def generate_day_sections(tree, day_inputs, max_depth, leaf_notes, leaf_note_timing):
+    '''Epoch day, text and total time of each day, from (epoch day, day rollups,
+    notes) of the days. The text is None for days with nothing to show. Run by
+    the report pool, or directly.'''
+    sections = []
+
+    for epoch_day, day_rollups, notes in day_inputs:
+        r = compute_day_results(day_rollups, notes, tree)
+
+        lines = generate_report(r, print_empty=False, display_root=False, max_depth=max_depth, time_unit='hours', leaf_notes=leaf_notes, leaf_note_timing=leaf_note_timing)
+        sections.append((epoch_day, '\n'.join(lines) if lines else None, r['TotalTime']))
+
+    return sections
+
+def start_report_pool(pool_size=REPORT_POOL_SIZE):
+    '''Fork the report processes, if configured. Call on startup before any
+    threads run, as a child forked from a threaded process can inherit a lock
+    held by another thread and deadlock on it.'''
+    global report_pool
+
+    if pool_size and report_pool is None:
+        from multiprocessing import Pool
+        report_pool = Pool(pool_size)
+
+    return report_pool
+
+def stop_report_pool():
+    global report_pool
+
+    if report_pool is not None:
+        report_pool.terminate()
+        report_pool = None
+
+def generate_report_days(root, day_idx, days, max_depth, leaf_notes, leaf_note_timing, pool_size=0, tree=None):
+    'Epoch day -> (text, total time) of the days'
+    rollups, notes = day_idx
+    tree = tree or ReportTree(root)
+
+    pool = report_pool
+    if pool and pool_size and len(days) > 1:
+        from multiprocessing import TimeoutError
+
+        # Consecutive days to each process, sent with the tree and their own notes
+        chunk_size = int(math.ceil(len(days) / float(pool_size)))
+
+        chunks = []
+        for chunk_begin in range(0, len(days), chunk_size):
+            day_inputs = []
+            for epoch_day in days[chunk_begin:chunk_begin + chunk_size]:
+                day_rollups = rollups.get(epoch_day, {})
+                day_notes = {}
+                for duration, count, note_ids in day_rollups.values():
+                    for point_id in note_ids:
+                        if point_id in notes:
+                            day_notes[point_id] = notes[point_id]
+
+                day_inputs.append((epoch_day, day_rollups, day_notes))
+
+            chunks.append((day_inputs, pool.apply_async(generate_day_sections,
+                            (tree, day_inputs, max_depth, leaf_notes, leaf_note_timing))))
+
+        sections = []
+        deadline = time.time() + REPORT_POOL_TIMEOUT
+        for day_inputs, result in chunks:
+            try:
+                sections += result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                # A stuck or overloaded pool, so the days are generated here
+                print 'Report pool timed out, generating %d days in process' % len(day_inputs)
+                sections += generate_day_sections(tree, day_inputs, max_depth, leaf_notes, leaf_note_timing)
+    else:
+        day_inputs = [(epoch_day, rollups.get(epoch_day, {}), notes) for epoch_day in days]
+        sections = generate_day_sections(tree, day_inputs, max_depth, leaf_notes, leaf_note_timing)
+
+    return dict((epoch_day, (day_text, day_total)) for epoch_day, day_text, day_total in sections)
+
+def join_report_days(days, day_sections):
+    'Sections of the days with something to show, in order, and the total time'
     report_days = []
     total_time = 0.0
 
-    for i, epoch_day in enumerate(days):
-        structure = create_structure(epoch_day, period_idx)
-        r = compute_day_results(period_idx, epoch_day, root, structure)
-        total_time += r['TotalTime']
+    for epoch_day in days:
+        day_text, day_total = day_sections[epoch_day]
+        total_time += day_total
 
-        lines = generate_report(r, print_empty=False, display_root=False, max_depth=max_depth, time_unit='hours', leaf_notes=leaf_notes, leaf_note_timing=leaf_note_timing)
-        if lines:
+        if day_text:
             day_section = ''
             if len(days) > 1:
                 day_section += format_epoch_weekday(epoch_day) + '\n'
                 day_section += ('-' * len(day_section)) + '\n'
 
-            day_section += '\n'.join(lines)
+            day_section += day_text
             report_days.append(day_section)
 
     return report_days, total_time
@@ -345,7 +445,11 @@ def format_epoch_weekday(epoch_day):
     return timestamp.strftime('%A, %b %d')
 
 def get_report(g, root_context_id, interval, day=None, month=None, year=None, begin_date=None,
-                    max_depth=None, leaf_notes=True, leaf_note_timing=False, public=False):
+                    max_depth=None, leaf_notes=True, leaf_note_timing=False, public=False, pool_size=None,
+                    cache=None):
+
+    if pool_size is None:
+        pool_size = REPORT_POOL_SIZE
 
     intervals = ('day', 'week', 'month')
     if interval not in intervals:
@@ -363,9 +467,25 @@ def get_report(g, root_context_id, interval, day=None, month=None, year=None, be
         if max_depth is None:
             max_depth = 4
 
-    period_idx = gen_idx(g, 86400, len(days), (days[-1] + 1) * 86400)
     root = g.get_context(root_context_id)
-    report_data = generate_report_days(root, period_idx, days, max_depth, leaf_notes, leaf_note_timing)
+    tree = ReportTree(root)
+    options = (max_depth, leaf_notes, leaf_note_timing)
+
+    # Only the days not generated since they were last written
+    day_sections = {}
+    if cache:
+        day_sections = cache.get(root_context_id, tree.version, options, days)
+
+    missing_days = [epoch_day for epoch_day in days if epoch_day not in day_sections]
+    if missing_days:
+        day_idx = gen_idx(g, missing_days, leaf_notes)
+        generated = generate_report_days(root, day_idx, missing_days, max_depth, leaf_notes, leaf_note_timing, pool_size, tree=tree)
+        if cache:
+            cache.set(root_context_id, tree.version, options, generated)
+
+        day_sections.update(generated)
+
+    report_data = join_report_days(days, day_sections)
     report = construct_report(report_data, days, root.label, public=public)
 
     return report
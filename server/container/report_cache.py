@@ -0,0 +1,87 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+from threading import Lock
+
+from benome.events import dispatcher, POINT_ADDED, POINT_UPDATED, POINT_DELETED, STRUCTURE_CHANGED
+
+# Days kept before the cache is emptied and starts over
+MAX_REPORT_DAYS = 20000
+
+class ReportCache(object):
+    '''Generated report days, by root context, epoch day and report options.
+
+    Past days rarely change, so a day is only generated again once a point of
+    that day is written. Adding or removing contexts or associations drops
+    everything. Days generated before a context under the root changed its
+    label or attributes are passed over, the tree's version having changed.
+    '''
+
+    def __init__(self, graph, max_size=MAX_REPORT_DAYS):
+        self.max_size = max_size
+
+        # Epoch day -> {(root context ID, options): (tree version, text, total time)}
+        self.days = {}
+        self.size = 0
+
+        # Reports run on several read workers at once
+        self.lock = Lock()
+
+        for signal in (POINT_ADDED, POINT_UPDATED, POINT_DELETED):
+            dispatcher.connect(self.point_changed, signal=signal, sender=graph)
+        dispatcher.connect(self.clear, signal=STRUCTURE_CHANGED, sender=graph)
+
+    def clear(self):
+        with self.lock:
+            self.days = {}
+            self.size = 0
+
+    def point_changed(self, epoch_days=None):
+        if epoch_days is None:
+            self.clear()
+            return
+
+        with self.lock:
+            for epoch_day in epoch_days:
+                self.size -= len(self.days.pop(epoch_day, ()))
+
+    def get(self, root_context_id, tree_version, options, days):
+        'Epoch day -> (text, total time) of the days generated for this tree version'
+        key = (root_context_id, options)
+        result = {}
+
+        with self.lock:
+            for epoch_day in days:
+                entry = self.days.get(epoch_day, {}).get(key)
+                if entry and entry[0] == tree_version:
+                    result[epoch_day] = entry[1:]
+
+        return result
+
+    def set(self, root_context_id, tree_version, options, day_sections):
+        key = (root_context_id, options)
+
+        with self.lock:
+            if self.size + len(day_sections) > self.max_size:
+                self.days = {}
+                self.size = 0
+
+            for epoch_day, (day_text, day_total) in day_sections.items():
+                day_entries = self.days.setdefault(epoch_day, {})
+                if key not in day_entries:
+                    self.size += 1
+
+                day_entries[key] = (tree_version, day_text, day_total)
@@ -21,10 +21,13 @@ from benome.utils import json_response
 from history_log import log_change
 
 class Routes(object):
-    def __init__(self, app, container):
+    def __init__(self, app, container, prefix=''):
         self.app = app
         self.container = container
 
+        # Put before each URL, as /u/<user_id> when serving many users
+        self.prefix = prefix
+
         self.routes = (
             ('/get_root_context_id', 'get_root_context_id', ('GET',)),
             ('/get_id_block/<block_size>', 'get_id_block', ('GET',)),
@@ -43,6 +46,9 @@ class Routes(object):
             ('/data/associations/<context_id>', 'data_associations', ('GET', )),
             ('/data/association/<association_id>', 'data_association', ('GET', 'POST', 'PUT', 'DELETE')),
 
+            # Contexts, points, associations and last ID together
+            ('/data/load/<context_id>', 'data_load', ('GET', )),
+
             # Queries
             ('/data/query', 'data_query', ('GET', )),
             ('/data/query/<context_id>', 'data_query', ('GET', )),
@@ -56,7 +62,7 @@ class Routes(object):
     def attach(self, routes):
         for url, name, methods in routes:
             func = self.__getattribute__(name)
-            self.app.add_url_rule(url, name, func, methods=methods)
+            self.app.add_url_rule(self.prefix + url, name, func, methods=methods)
 
     def get_id_block(self, block_size=None):
         if block_size:
@@ -146,6 +152,23 @@ class Routes(object):
         result = self.container.exec_cmd('get-points', params=(context_id, anchor_time, interval))
         return json_response(result), 200
 
+    def data_load(self, context_id):
+        self.container.validate_auth()
+
+        try:
+            context_id = int(context_id)
+        except:
+            raise Exception('Invalid ContextID')
+
+        anchor_time = None
+        try:
+            anchor_time = int(request.args.get('AnchorTime'))
+        except:
+            pass
+
+        result = self.container.exec_cmd('get-load', params=(context_id, anchor_time))
+        return json_response(result), 200
+
     @log_change
     def data_point(self, point_id=None):
         self.container.validate_auth()
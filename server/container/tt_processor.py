@@ -17,62 +17,54 @@
 import simplejson
 import math
 from record_processor import RecordProcessor
+from report import ReportTree
 
 class TimeTrackingProcessor(RecordProcessor):
-    def _compute_day_results(self, epoch_day, context, structure, level=0):
+    def __init__(self, *args, **kwargs):
+        # ReportTree by root context ID, built on first use
+        self.report_trees = {}
+
+        RecordProcessor.__init__(self, *args, **kwargs)
+
+    def get_report_tree(self, context):
         context_id = context.get_id()
-        context_details = {
-            'Context': context,
-            'ContextID': context_id,
-            'TotalTime': 0,
-            'SelfTotalTime': 0,
-            'ChildTotalTime': 0,
-            'ProportionalTime': 0.0,
-            'RecordNotes': None,
-            'Children': []
-        }
-
-        # Get all records for current context
-        self_total = 0
-        for child_rec in structure.get(context_id, []):
-            self_total += child_rec['CommonDetails']['Duration']
-        context_details['SelfTotalTime'] = self_total
-
-        child_total = 0
-        down_vertexes = context.outV('down')
-        if down_vertexes:
-            for child_vertex in down_vertexes:
-                child_details = self._compute_day_results(epoch_day, child_vertex, structure, level=level+1)
-                context_details['Children'] += child_details
-                child_total += sum([child_detail['TotalTime'] for child_detail in child_details])
-
-        # Data points
-        context_points = self.data.get_points(contexts=[context_id])
-        record_notes = []
-        if context_points:
-            for point in context_points:
-                timestamp = point.get('1__Time')
-                if not timestamp:
-                    continue
-
-                point_epoch_day = self.get_epoch_day(timestamp)
-                if point_epoch_day != epoch_day:
-                    continue
-
-                description = point.get('1__Text', None)
-                duration = point.get('1__Duration', 0)
-
-                if description:
-                    record_notes.append((duration, map(str.strip, str(description.strip()).split('\n'))))
-
-        context_details['ChildTotalTime'] = child_total
-        context_details['TotalTime'] = child_total + self_total
-        context_details['RecordNotes'] = record_notes
-
-        if level == 0:
-            return context_details
-        else:
-            return [context_details]
+        if context_id not in self.report_trees:
+            self.report_trees[context_id] = ReportTree(context)
+
+        return self.report_trees[context_id]
+
+    def record_contexts(self, base_context):
+        'The base context and all under it, so one query brings every record of a report'
+        return self.get_report_tree(base_context).context_ids
+
+    def fix_durations(self):
+        for records in self.day_buckets.values():
+            for record in records:
+                details = record['CommonDetails']
+                try:
+                    details['Duration'] = int(float(details['Duration'] or 0))
+                except (TypeError, ValueError):
+                    details['Duration'] = 0
+
+    def _compute_day_results(self, epoch_day, context, structure, level=0):
+        # Totals and notes from the day's records, grouped by context once
+        self_totals = {}
+        record_notes = {}
+
+        for context_id, records in structure.items():
+            self_totals[context_id] = sum([record['CommonDetails']['Duration'] for record in records])
+
+            context_notes = []
+            for record in sorted(records, key=lambda record: float(record['CommonDetails']['BeginTime'] or 0)):
+                details = record['CommonDetails']
+                description = details['Text']
+                if details['BeginTime'] and description:
+                    context_notes.append((details['Duration'], map(str.strip, str(description.strip()).split('\n'))))
+
+            if context_notes:
+                record_notes[context_id] = context_notes
+
+        return self.get_report_tree(context).compute(self_totals, record_notes)
 
     def to_structure(self, context_list):
         'Include everything, with all available detail'
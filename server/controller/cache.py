@@ -0,0 +1,85 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache(object):
+    '''Values kept for up to ttl seconds, the least recently used dropped
+    beyond max_size.
+
+    Values are shared, so callers must not change them.
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # Key -> (expiry time, value), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is None:
+                return default
+
+            expires, value = item
+            if expires < time.time():
+                return default
+
+            self.entries[key] = item
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        'The cached value, or the result of load() cached unless None'
+        value = self.get(key)
+        if value is None:
+            value = load()
+            if value is not None:
+                self.set(key, value)
+
+        return value
+
+    def pop(self, key):
+        with self.lock:
+            item = self.entries.pop(key, None)
+
+        if item is not None:
+            return item[1]
+
+    def items(self):
+        'Unexpired keys and values'
+        now = time.time()
+        with self.lock:
+            return [(key, value) for key, (expires, value) in self.entries.items() if expires >= now]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
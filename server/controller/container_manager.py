@@ -14,17 +14,100 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Benome. If not, see http://www.gnu.org/licenses/.
 
+import os
 import time
+import threading
 import simplejson
 from uuid import uuid4
 
 from global_config import REDIS_HOST, CONTAINER_PORT, CONTAINER_BASE_IMAGE
 from benome.utils import connect_redis, disconnect_redis, json_get
+from benome.events import dispatcher, CONTAINER_STARTED, CONTAINER_STOPPED
+from benome.stats import LatencyHistogram
+from cache import TTLCache
+from docker_client import DockerCLI
+
+# Verified container ports kept in memory, and for how long in seconds. A
+# port is dropped sooner when its container is stopped or found unreachable.
+PORT_CACHE_SIZE = 1000
+PORT_CACHE_TTL = 300
+
+SRC_CODE_DIR = '/opt/benome/src'
+DATA_ROOT = '/opt/benome/data'
+
+# Seconds for a started container to run and answer pings
+CONTAINER_START_TIMEOUT = 10
+
+# Seconds between checks while a container starts, from the first doubling
+# up to the max
+START_POLL_INTERVAL = 0.05
+START_POLL_MAX_INTERVAL = 0.5
+
+# Seconds for a pooled container to load a user's data
+BIND_TIMEOUT = 30
+
+# Seconds for a container to write its snapshot on /sync, and to stop after /exit
+SYNC_TIMEOUT = 30
+CONTAINER_STOP_TIMEOUT = 10
+
+# Total resident memory of the containers in KB. Past it, the longest idle
+# containers are stopped before another is started. None for no limit.
+CONTAINER_MEMORY_LIMIT = 8 * 1024 * 1024
+
+# KB taken to be needed by a container bound to a user, until some report theirs
+CONTAINER_MEMORY_ESTIMATE = 200 * 1024
+
+# UIDs given to users, which pooled containers drop to once bound
+USER_UID_BASE = 100000
+
+# Header carrying the secret a pooled container was started with, on /bind
+BIND_TOKEN_HEADER = 'X-Benome-Bind-Token'
+
+class LifecycleStats(object):
+    '''Latencies and failures of container lifecycle operations.
+
+    ColdStart is a user waiting on a new container, PoolStart a container
+    started for the pool, Bind a pooled container loading a user's data.
+    '''
+
+    NAMES = ('ColdStart', 'PoolStart', 'Bind', 'HealthCheck')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict((name, LatencyHistogram()) for name in self.NAMES)
+        self.failures = dict.fromkeys(self.NAMES, 0)
+
+    def add(self, name, seconds, success=True):
+        with self.lock:
+            self.latencies[name].add(seconds)
+            if not success:
+                self.failures[name] += 1
+
+    def summary(self):
+        with self.lock:
+            return dict((name, dict(self.latencies[name].summary(), Failures=self.failures[name]))
+                            for name in self.NAMES)
 
 class ContainerManager(object):
-    def __init__(self, controller_url, dns_host, user_manager=None):
+    def __init__(self, controller_url, dns_host, user_manager=None, docker_client=None):
         self.controller_url = controller_url
         self.dns_host = dns_host
+        self.docker_client = docker_client or DockerCLI()
+
+        # A ContainerPool, when containers are started ahead of need
+        self.pool = None
+        self.stats = LifecycleStats()
+
+        # Held while starting or stopping a user's container, so only one is started
+        self.user_locks = {}
+        self.lock = threading.Lock()
+
+        # User ID -> time of the last request for the user's container
+        self.last_active = {}
+
+        # Port -> resident memory in KB of the container, as reported in its pings
+        self.memory = {}
+        self.memory_limit = CONTAINER_MEMORY_LIMIT
 
         self.redis = connect_redis(host=REDIS_HOST)
 
@@ -34,6 +117,129 @@ class ContainerManager(object):
         elif user_manager:
             self.user_manager = user_manager
 
+        # User ID -> port of a container known to be running
+        self.ports = TTLCache(PORT_CACHE_SIZE, PORT_CACHE_TTL)
+
+    def get_port(self, user_id, container_name=None):
+        'Port of the user\'s container, started and verified unless recently done'
+        self.last_active[user_id] = time.time()
+
+        port = self.ports.get(user_id)
+        if port is not None:
+            return port
+
+        self.ensure_container(user_id, container_name=container_name, user_is_valid=True)
+        ready = self.verify_container(user_id)
+
+        try:
+            port = int(self.get_user_port(user_id))
+        except:
+            return None
+
+        if ready:
+            self.ports.set(user_id, port)
+
+        return port
+
+    def forget_container(self, user_id):
+        'Drop what is known of the running container, as after it stopped'
+        port = self.ports.pop(user_id)
+        self.memory.pop(port, None)
+        dispatcher.send(CONTAINER_STOPPED, sender=self, user_id=user_id, port=port)
+
+    def restrict_data_root(self):
+        '''Leave each user's data directory to its owner alone, as pooled
+        containers mount the whole data root'''
+        if not os.path.exists(DATA_ROOT):
+            os.makedirs(DATA_ROOT)
+
+        os.chmod(DATA_ROOT, 0711)
+        for name in os.listdir(DATA_ROOT):
+            path = os.path.join(DATA_ROOT, name)
+            if os.path.isdir(path):
+                os.chmod(path, 0700)
+
+    def get_user_uid(self, user_id):
+        'UID of the user\'s data, assigned on first use'
+        uid = self.redis.hget('UserUIDMap', user_id)
+        if uid is None:
+            self.redis.hsetnx('UserUIDMap', user_id, USER_UID_BASE + self.redis.incr('UserUIDCounter'))
+            uid = self.redis.hget('UserUIDMap', user_id)
+
+        return int(uid)
+
+    def set_bind_token(self, container_id, token):
+        self.redis.hset('ContainerBindTokens', container_id, token)
+
+    def get_bind_token(self, container_id):
+        return self.redis.hget('ContainerBindTokens', container_id)
+
+    def user_lock(self, user_id):
+        with self.lock:
+            return self.user_locks.setdefault(user_id, threading.Lock())
+
+    def idle_users(self, idle_timeout):
+        'Users whose containers have had no requests for idle_timeout seconds, longest idle first'
+        idle_since = time.time() - idle_timeout
+        return [user_id for last_active, user_id in sorted((t, u) for u, t in self.last_active.items())
+                    if last_active < idle_since]
+
+    def stop_container(self, user_id, idle_timeout=None, wait=True):
+        '''Sync and stop the user's container, to be resumed from its snapshot
+        on the user's next request.
+
+        Skipped when a request came within idle_timeout, or when not waiting
+        and the container is being started or stopped. Returns whether stopped.
+        '''
+        user_lock = self.user_lock(user_id)
+        if not user_lock.acquire(wait):
+            return False
+
+        try:
+            if idle_timeout and self.last_active.get(user_id, 0) > time.time() - idle_timeout:
+                return False
+
+            self.last_active.pop(user_id, None)
+            self.shutdown_container(user_id)
+            return True
+        finally:
+            user_lock.release()
+
+    def resident_memory(self):
+        return sum(self.memory.values())
+
+    def memory_estimate(self):
+        'KB a container is expected to need once bound, the mean of the bound ones'
+        bound = [self.memory[port] for user_id, port in self.ports.items() if port in self.memory]
+        if bound:
+            return sum(bound) / len(bound)
+        return CONTAINER_MEMORY_ESTIMATE
+
+    def admit(self, user_id):
+        'Make room for the user\'s container under the memory limit, stopping the longest idle'
+        if not self.memory_limit:
+            return
+
+        needed = self.memory_estimate()
+        for idle_user_id in self.idle_users(0):
+            if self.resident_memory() + needed <= self.memory_limit:
+                return
+
+            if idle_user_id == user_id:
+                continue
+
+            if not self.container_running(idle_user_id):
+                # Gone already, with nothing to free
+                self.last_active.pop(idle_user_id, None)
+                self.forget_container(idle_user_id)
+                continue
+
+            print 'Stopping container of user %s for memory' % idle_user_id
+            self.stop_container(idle_user_id, wait=False)
+
+        if self.resident_memory() + needed > self.memory_limit:
+            raise Exception('No memory available for another container')
+
     def ensure_container(self, user_id, container_name=None, user_is_valid=False):
         if not user_is_valid:
             # Raise exception if user id is not valid
@@ -43,7 +249,8 @@ class ContainerManager(object):
         if not container_name:
             container_name = user_id
 
-        return self.init_container(user_id, container_name)
+        with self.user_lock(user_id):
+            return self.init_container(user_id, container_name)
 
     def init_container(self, user_id, container_name=None):
         'Init the container and map to the user'
@@ -57,63 +264,99 @@ class ContainerManager(object):
             else:
                 return container_id
 
-        import os
-        src_code_dir = '/opt/benome/src'
-        dest_code_dir = '/opt/benome/src'
-        data_dir = '/opt/benome/data/%s' % user_id
+        self.admit(user_id)
+
+        if self.pool:
+            container_id = self.pool.bind(user_id)
+            if container_id:
+                return container_id
+
+        data_dir = os.path.join(DATA_ROOT, user_id)
 
         if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
+            os.makedirs(data_dir, 0700)
 
         if not os.path.isdir(data_dir):
             raise Exception('Data dir not available')
 
-        cmd = ['/usr/bin/python', os.path.join(dest_code_dir, 'container/container.py')]
-        #auth_token = str(uuid4())
-
-        container_id = self.docker([
-                'run', '-d', '-p', str(CONTAINER_PORT), '--dns=%s' % self.dns_host,
-                '--name="%s"' % container_name,
-                '-v', '%s:%s' % (data_dir, data_dir),
-                '-v', '%s:%s' % (src_code_dir, dest_code_dir),
-                '-e', 'BENOME_DATA_DIR=%s' % data_dir,
-                '-e', 'BENOME_USERID=%s' % user_id,
-                '-e', 'BENOME_CONTAINER_PORT=%s' % CONTAINER_PORT,
-                #'-e', 'BENOME_CONTROLLER_URL=%s' % self.controller_url,
-                #'-e', 'BENOME_CONTROLLER_AUTHTOKEN=%s' % auth_token,
-                '-e', 'PYTHONPATH=/opt/benome/src',
-                CONTAINER_BASE_IMAGE
-            ] + cmd)
-
-        # Verify that it loaded successfully
-        container_running = False
-        container_ext_port = None
         begin_time = time.time()
+        try:
+            container_id, container_ext_port = self.run_container({
+                    'BENOME_DATA_DIR': data_dir,
+                    'BENOME_USERID': user_id
+                }, [(data_dir, data_dir)], name=container_name)
+        except:
+            self.stats.add('ColdStart', time.time() - begin_time, success=False)
+            raise
 
-        while not container_running and time.time() - begin_time < 5:
-            container_state = self.get_container_state(container_id)
+        self.stats.add('ColdStart', time.time() - begin_time)
 
-            if container_state:
-                container_exists = True
-                container_running = container_state['State']['Running']
+        self.set_user_port(user_id, container_ext_port)
+        self.set_user_container_id(user_id, container_id)
 
-                if container_running:
-                    container_ext_port = self.get_container_ext_port(container_state)
-                    break
+        return container_id
 
-            time.sleep(0.25)
+    def run_container(self, env, volumes, name=None):
+        'Start a container and wait until it answers, returning its ID and port'
+        cmd = ['/usr/bin/python', os.path.join(SRC_CODE_DIR, 'container/container.py')]
 
-        if container_running:
-            self.set_user_port(user_id, container_ext_port)
-            self.set_user_container_id(user_id, container_id)
-            #self.set_user_auth_token(user_id, auth_token)
-        else:
+        env = dict(env)
+        env.update({
+            'BENOME_CONTAINER_PORT': CONTAINER_PORT,
+            'PYTHONPATH': SRC_CODE_DIR
+        })
+
+        container_id = self.docker_client.run(CONTAINER_BASE_IMAGE, cmd, CONTAINER_PORT, name=name, env=env,
+                                volumes=list(volumes) + [(SRC_CODE_DIR, SRC_CODE_DIR)], dns=self.dns_host)
+
+        container_ext_port, result = self.wait_ready(container_id)
+        if not container_ext_port:
             raise Exception('Container failed to initialize')
 
-        return container_id
+        return container_id, container_ext_port
+
+    def wait_ready(self, container_id, timeout=CONTAINER_START_TIMEOUT):
+        'Wait for a container to run and answer pings, returning its port and ping result'
+        end_time = time.time() + timeout
+        interval = START_POLL_INTERVAL
+        container_ext_port = None
 
-    def get_container_ext_port(self, container_state):
-        return container_state['NetworkSettings']['Ports']['%s/tcp' % str(CONTAINER_PORT)][0]['HostPort']
+        while time.time() < end_time:
+            if not container_ext_port:
+                container_state = self.get_container_state(container_id)
+                if container_state and container_state['Running']:
+                    container_ext_port = container_state['Port']
+
+            if container_ext_port:
+                result = self.ping(container_ext_port)
+                if result:
+                    return container_ext_port, result
+
+            time.sleep(interval)
+            interval = min(interval * 2, START_POLL_MAX_INTERVAL)
+
+        return None, None
+
+    def ping(self, port, timeout=0.5):
+        'The ping result of the container on a port, or None when it does not answer'
+        result = json_get('http://127.0.0.1:%s/ping' % port, timeout=timeout)
+        if result and result.get('Success'):
+            if result.get('RSS'):
+                self.memory[int(port)] = result['RSS']
+            return result
+
+    def bind_container(self, container_id, port, user_id):
+        'Load a user\'s data in a container started without a user'
+        token = self.get_bind_token(container_id)
+        if not token:
+            raise Exception('No bind token for container %s' % container_id)
+
+        url = 'http://127.0.0.1:%s/bind?UserID=%s&UID=%d' % (port, user_id, self.get_user_uid(user_id))
+        result, status_code = json_get(url, return_code=True, timeout=BIND_TIMEOUT,
+                                    headers={BIND_TOKEN_HEADER: token})
+
+        if status_code != 200 or not result or not result.get('Success'):
+            raise Exception('Could not bind container on port %s: %s' % (port, result))
 
     def get_user_container_id(self, user_id):
         return self.redis.hget('UserContainerMap', user_id)
@@ -130,6 +373,9 @@ class ContainerManager(object):
     def set_user_port(self, user_id, port):
         self.redis.hset('UserPortMap', user_id, port)
 
+        self.forget_container(user_id)
+        dispatcher.send(CONTAINER_STARTED, sender=self, user_id=user_id, port=int(port))
+
     def get_user_port(self, user_id):
         return self.redis.hget('UserPortMap', user_id)
 
@@ -137,49 +383,68 @@ class ContainerManager(object):
         self.delete_user_container_id(user_id)
         self.redis.hdel('UserContainerTokenMap', user_id)
         self.redis.hdel('UserPortMap', user_id)
+        self.forget_container(user_id)
 
     def start_container(self, container_id, user_id):
         container_state = self.get_container_state(container_id)
         if not container_state:
             raise Exception('Invalid container state')
-        elif container_state['State']['Running']:
+        elif container_state['Running']:
             return
         else:
-            self.docker(['start', container_id])
+            self.admit(user_id)
+            self.docker_client.start(container_id)
 
-            container_state = self.get_container_state(container_id)
-            if not container_state or not container_state['State']['Running']:
+            container_ext_port, result = self.wait_ready(container_id)
+            if not container_ext_port:
                 raise Exception('Could not start container: %s' % container_id)
-            else:
-                self.set_user_port(user_id, self.get_container_ext_port(container_state))
-                self.set_user_container_id(user_id, container_id)
-                time.sleep(1)
+
+            # A pooled container comes back without its user
+            if 'UserID' in result and not result['UserID']:
+                self.bind_container(container_id, container_ext_port, user_id)
+
+            self.set_user_port(user_id, container_ext_port)
+            self.set_user_container_id(user_id, container_id)
 
     def get_container_state(self, container_id):
         if not container_id:
             return None
 
-        container_state = None
-        result = self.docker(['inspect', container_id])
-        if result:
-            try:
-                container_state = simplejson.loads(result)[0]
-            except Exception, e:
-                print 'Error parsing Docker response: %s, |%s|' % (e, result)
+        return self.docker_client.inspect(container_id, CONTAINER_PORT)
+
+    def container_running(self, user_id):
+        container_state = self.get_container_state(self.get_user_container_id(user_id))
+        return bool(container_state and container_state['Running'])
+
+    def wait_stopped(self, container_id, timeout=CONTAINER_STOP_TIMEOUT):
+        'Wait for a container to stop running, returning whether it did'
+        end_time = time.time() + timeout
+        interval = START_POLL_INTERVAL
+
+        while time.time() < end_time:
+            container_state = self.get_container_state(container_id)
+            if not container_state or not container_state['Running']:
+                return True
 
-        return container_state
+            time.sleep(interval)
+            interval = min(interval * 2, START_POLL_MAX_INTERVAL)
+
+        return False
+
+    def remove_container(self, container_id, port=None):
+        self.docker_client.remove(container_id)
+        self.redis.hdel('ContainerBindTokens', container_id)
+        if port is not None:
+            self.memory.pop(int(port), None)
 
     def verify_container(self, user_id):
         container_port = self.get_user_port(user_id)
         ready = False
 
         if container_port:
-            ping_url = 'http://127.0.0.1:%s/ping' % container_port
-
             tries = 0
             while not ready and tries < 10:
-                result = json_get(ping_url, timeout=0.5)
-                if result and result.get('Success'):
+                if self.ping(container_port):
                     ready = True
                     break
 
@@ -189,16 +454,24 @@ class ContainerManager(object):
         return ready
 
     def shutdown_container(self, user_id, kill=False, remove=False):
+        # Requests from now on find no port, and start the container again
+        # once it has stopped, waiting on the user lock while it stops
+        self.forget_container(user_id)
+
         container_id = self.get_user_container_id(user_id)
-        container_port = self.get_user_port(user_id)
+
+        # From docker, as the recorded port may be stale
+        container_state = self.get_container_state(container_id)
+        container_port = None
+        if container_state and container_state['Running']:
+            container_port = container_state['Port']
 
         try:
             if container_port:
-                # Graceful shutdown
+                # Graceful shutdown, /sync answering once the snapshot is written
                 sync_url = 'http://127.0.0.1:%s/sync' % container_port
                 try:
-                    json_get(sync_url)
-                    time.sleep(2)
+                    json_get(sync_url, timeout=SYNC_TIMEOUT)
                 except:
                     pass
 
@@ -208,23 +481,27 @@ class ContainerManager(object):
                 except:
                     pass
 
+                if not kill and not self.wait_stopped(container_id):
+                    print 'Container %s still running after /exit' % container_id
+
             if container_id:
                 if kill:
                     # Wait until process finishes, then kill it
                     #self.docker(['wait', container_id])
-                    self.docker(['kill', container_id])
+                    self.docker_client.kill(container_id)
 
                 if remove:
-                    self.docker(['rm', '-f', container_id])
+                    self.docker_client.remove(container_id)
         except Exception, e:
             print 'Error shutting down container: %s' % e
 
+        if container_port:
+            self.memory.pop(int(container_port), None)
+
         #self.clear_user_state(user_id)
 
     def docker(self, args, stdin=None):
-        from benome.utils import ext
-        #print ' '.join(args)
-        return ext('docker', list(args), wait=True, shell=False, raw=True, debug=False).strip()
+        return self.docker_client.command(args)
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,170 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+import time
+import threading
+from uuid import uuid4
+
+from container_manager import DATA_ROOT
+
+# Started containers kept waiting for a user
+POOL_SIZE = 2
+
+# Seconds between health checks of pooled and bound containers
+HEALTH_CHECK_INTERVAL = 30
+
+# Seconds before starting another pooled container after a start failed
+FILL_RETRY_DELAY = 10
+
+class ContainerPool(object):
+    '''Containers started ahead of need, each bound to a user on the user's
+    first request.
+
+    Pooled containers run without a user, with the whole data root mounted so
+    any user's data can be loaded in them. Each is started with a secret that
+    /bind requires, and once bound runs as the user's UID, so only that user's
+    data directory can be opened. One thread keeps the pool full, another
+    checks that pooled and bound containers still run and answer.
+    '''
+
+    def __init__(self, manager, size=POOL_SIZE, health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.manager = manager
+        self.size = size
+        self.health_check_interval = health_check_interval
+
+        # (container ID, port) of the pooled containers, oldest first
+        self.warm = []
+        self.lock = threading.Lock()
+
+        # Set when the pool may need filling
+        self.wanted = threading.Event()
+        self.running = False
+
+    def begin(self):
+        self.manager.restrict_data_root()
+        self.manager.pool = self
+        self.running = True
+
+        for target in (self.fill, self.check_health):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+        self.wanted.set()
+
+    def stop(self):
+        'Stop filling the pool and remove the pooled containers'
+        self.running = False
+        self.wanted.set()
+
+        with self.lock:
+            warm, self.warm = self.warm, []
+
+        for container_id, port in warm:
+            self.manager.remove_container(container_id, port)
+
+    def take(self):
+        with self.lock:
+            container = self.warm.pop(0) if self.warm else None
+
+        self.wanted.set()
+        return container
+
+    def bind(self, user_id):
+        'Bind a pooled container to the user, returning its ID, or None if none is ready'
+        container = self.take()
+        if not container:
+            return None
+
+        container_id, port = container
+        begin_time = time.time()
+        try:
+            self.manager.bind_container(container_id, port, user_id)
+        except Exception, e:
+            print 'Pooled container %s failed to bind: %s' % (container_id, e)
+            self.manager.stats.add('Bind', time.time() - begin_time, success=False)
+            self.manager.remove_container(container_id, port)
+            return None
+
+        self.manager.stats.add('Bind', time.time() - begin_time)
+
+        self.manager.set_user_port(user_id, port)
+        self.manager.set_user_container_id(user_id, container_id)
+        return container_id
+
+    def fill(self):
+        while self.running:
+            self.wanted.wait()
+            self.wanted.clear()
+
+            while self.running and len(self.warm) < self.size:
+                begin_time = time.time()
+                token = uuid4().hex
+                try:
+                    container = self.manager.run_container({
+                            'BENOME_POOLED': '1',
+                            'BENOME_DATA_ROOT': DATA_ROOT,
+                            'BENOME_BIND_TOKEN': token
+                        }, [(DATA_ROOT, DATA_ROOT)])
+                    self.manager.set_bind_token(container[0], token)
+                except Exception, e:
+                    print 'Pooled container failed to start: %s' % e
+                    self.manager.stats.add('PoolStart', time.time() - begin_time, success=False)
+                    time.sleep(FILL_RETRY_DELAY)
+                    continue
+
+                self.manager.stats.add('PoolStart', time.time() - begin_time)
+
+                with self.lock:
+                    self.warm.append(container)
+
+                if not self.running:
+                    self.stop()
+
+    def check(self, container_id, port):
+        'Whether a container runs and answers pings'
+        begin_time = time.time()
+
+        container_state = self.manager.get_container_state(container_id)
+        healthy = bool(container_state and container_state['Running'] and self.manager.ping(port))
+
+        self.manager.stats.add('HealthCheck', time.time() - begin_time, success=healthy)
+        return healthy
+
+    def check_health(self):
+        while self.running:
+            time.sleep(self.health_check_interval)
+
+            with self.lock:
+                warm = list(self.warm)
+
+            for container in warm:
+                if not self.check(*container):
+                    print 'Removing unhealthy pooled container %s' % container[0]
+                    with self.lock:
+                        if container in self.warm:
+                            self.warm.remove(container)
+
+                    self.manager.remove_container(*container)
+                    self.wanted.set()
+
+            # Bound containers in use lately. Those failing are checked again,
+            # and restarted if need be, on their user's next request.
+            for user_id, port in self.manager.ports.items():
+                container_id = self.manager.get_user_container_id(user_id)
+                if not self.check(container_id, port):
+                    print 'Container of user %s is unhealthy' % user_id
+                    self.manager.forget_container(user_id)
@@ -0,0 +1,99 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Requests to containers over kept-alive connections, with responses passed
+through to the client as they arrive rather than decoded and encoded again.
+'''
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for a connection to a container
+CONNECT_TIMEOUT = 2
+
+# Open connections kept per container
+POOL_SIZE = 8
+
+# Bytes passed on at a time when streaming a container response
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Response headers passed on from the container with the undecoded body.
+# Length and transfer headers are left to the server streaming the response.
+PASS_HEADERS = ('Content-Type', 'Content-Encoding', 'Cache-Control')
+
+class ContainerProxy(object):
+    def __init__(self, host='127.0.0.1', pool_size=POOL_SIZE):
+        self.host = host
+        self.pool_size = pool_size
+
+        # Port -> requests.Session
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, port):
+        session = self.sessions.get(port)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(port)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    self.sessions[port] = session
+
+        return session
+
+    def close(self, port=None):
+        'Close the connections to a container, or to all when no port is given'
+        with self.lock:
+            ports = [port] if port is not None else self.sessions.keys()
+            for port in ports:
+                session = self.sessions.pop(port, None)
+                if session:
+                    session.close()
+
+    def request(self, port, method, url_path, data=None, headers=None, timeout=5):
+        'Send a request, leaving the response body unread'
+        url = 'http://%s:%d%s' % (self.host, port, url_path)
+        return self.get_session(port).request(method, url, data=data, headers=headers,
+                                timeout=(CONNECT_TIMEOUT, timeout), stream=True)
+
+    def forward(self, port, method, url_path, data=None, headers=None, timeout=5):
+        '''A Flask response streaming the container's response body as is.
+
+        Raises requests exceptions when the container can't be reached or
+        sends no response headers within the timeout.
+        '''
+        from flask import Response
+
+        r = self.request(port, method, url_path, data=data, headers=headers, timeout=timeout)
+
+        def relay():
+            # Returns the connection to the pool once the body is read
+            try:
+                for chunk in r.raw.stream(STREAM_CHUNK_SIZE, decode_content=False):
+                    yield chunk
+            finally:
+                r.close()
+
+        response = Response(relay(), status=r.status_code)
+        for name in PASS_HEADERS:
+            if name in r.headers:
+                response.headers[name] = r.headers[name]
+
+        return response
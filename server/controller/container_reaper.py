@@ -0,0 +1,61 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+import time
+import threading
+
+# Seconds without requests after which a user's container is stopped
+IDLE_TIMEOUT = 30 * 60
+
+# Seconds between looks for idle containers
+REAP_INTERVAL = 60
+
+class ContainerReaper(object):
+    '''Stops the containers of users gone idle, freeing their memory.
+
+    A container syncs before stopping, writing its graph snapshot, so the
+    user's next request restarts it from the snapshot rather than the DB.
+    '''
+
+    def __init__(self, manager, idle_timeout=IDLE_TIMEOUT, interval=REAP_INTERVAL):
+        self.manager = manager
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.running = False
+
+    def begin(self):
+        self.running = True
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+
+            try:
+                self.reap()
+            except Exception, e:
+                print 'Reaper error: %s' % e
+
+    def reap(self):
+        for user_id in self.manager.idle_users(self.idle_timeout):
+            if self.manager.stop_container(user_id, idle_timeout=self.idle_timeout):
+                print 'Stopped idle container of user %s' % user_id
@@ -32,12 +32,37 @@ from flask_login import LoginManager, UserMixin, AnonymousUserMixin, login_requi
                     current_user
 
 from benome.utils import json_response, json_get
-from global_config import REDIS_HOST, CONTAINER_PORT, DEFAULT_TZ_OFFSET, GLOBAL_USER_ID, USER_DB_PATH
+from benome.events import dispatcher, CONTAINER_STARTED, CONTAINER_STOPPED
+from global_config import REDIS_HOST, CONTAINER_PORT, DEFAULT_TZ_OFFSET, GLOBAL_USER_ID, USER_DB_PATH, \
+                    CONTAINER_POOL_SIZE
 from container_manager import ContainerManager
+from container_proxy import ContainerProxy
+from container_pool import ContainerPool
+from container_reaper import ContainerReaper
+from cache import TTLCache
 from user_manager import UserManager
 
 container_manager = ContainerManager('http://127.0.0.1:5200', '127.0.0.1', user_manager=False)
 user_manager = UserManager()
+container_proxy = ContainerProxy()
+
+# Root context IDs kept in memory, and for how long in seconds. Dropped when
+# the user's container starts or stops.
+ROOT_CONTEXT_CACHE_SIZE = 1000
+ROOT_CONTEXT_CACHE_TTL = 3600
+
+root_context_ids = TTLCache(ROOT_CONTEXT_CACHE_SIZE, ROOT_CONTEXT_CACHE_TTL)
+
+def container_changed(user_id=None, port=None):
+    root_context_ids.pop(user_id)
+
+def container_stopped(user_id=None, port=None):
+    container_changed(user_id, port)
+    if port is not None:
+        container_proxy.close(port)
+
+dispatcher.connect(container_changed, signal=CONTAINER_STARTED, sender=container_manager)
+dispatcher.connect(container_stopped, signal=CONTAINER_STOPPED, sender=container_manager)
 
 redis = StrictRedis(host=REDIS_HOST, db=0)
 
@@ -128,7 +153,7 @@ class User(UserMixin):
 
     def get_root_context_id(self):
         if not self.root_context_id:
-            self.root_context_id = call_container('get_root_context_id')
+            self.root_context_id = root_context_ids.get_or_load(self.id, lambda: call_container('get_root_context_id'))
 
         return self.root_context_id
 
@@ -156,19 +181,22 @@ class User(UserMixin):
 
         if config.get('ContainerType') == 'Local':
             return int(config.get('LocalPort'))
+        elif config.get('ContainerType') == 'Tenant':
+            # A container shared with other users
+            return int(config.get('TenantPort'))
         else:
             if self.containerized():
                 user_id = self.get_id()
             else:
                 user_id = get_global_user_id()
 
-            container_manager.ensure_container(user_id, container_name=self.name, user_is_valid=True)
-            container_manager.verify_container(user_id)
+            return container_manager.get_port(user_id, container_name=self.name)
 
-            try:
-                return int(container_manager.get_user_port(user_id))
-            except:
-                pass
+    def get_url_prefix(self):
+        'Put before container URLs, naming the user in a shared container'
+        if self.get_config().get('ContainerType') == 'Tenant':
+            return '/u/%s' % self.get_id()
+        return ''
 
     def __repr__(self):
         return '<%s: %s>' % (self.id, self.get_name())
@@ -192,6 +220,9 @@ class AnonymousUser(AnonymousUserMixin):
     def get_port(self):
         return get_global_port()
 
+    def get_url_prefix(self):
+        return ''
+
 login_manager.anonymous_user = AnonymousUser
 
 def init_user(username=None, user_id=None, password=None):
@@ -248,17 +279,7 @@ def data_load(context_id=None):
     if not context_id or str(context_id) in ('null', 'None'):
         context_id = current_user.get_root_context_id()
 
-    contexts = call_container('get_contexts', data=context_id)
-    points = call_container('get_points', data=context_id)
-    associations = call_container('get_associations', data=context_id)
-
-    return json_response({
-        'ContextID': context_id,
-        'LastID': current_user.get_last_id(),
-        'Points': points,
-        'Contexts': contexts,
-        'Associations': associations
-    })
+    return forward_container('/data/load/%s' % context_id, timeout=30)
 
 @app.route('/get_id_block', methods=['GET'])
 @app.route('/get_id_block/<block_size>', methods=['GET'])
@@ -271,6 +292,19 @@ def data_load(context_id=None):
 def data_interface(*args, **kwargs):
     return forward_container()
 
+@app.route('/container_stats', methods=['GET'])
+def container_stats():
+    if not current_user or current_user.is_anonymous:
+        return 'Unauthorized', 403
+
+    stats = container_manager.stats.summary()
+    stats['Memory'] = {
+        'ResidentKB': container_manager.resident_memory(),
+        'LimitKB': container_manager.memory_limit,
+        'Containers': len(container_manager.memory)
+    }
+    return json_response(stats)
+
 @app.route('/cache.manifest', methods=['GET'])
 def input_manifest():
     context = {}
@@ -418,9 +452,7 @@ def user_root(username):
         'Username': display_username
         })
 
-def get_container_host():
-    ip = '127.0.0.1'
-
+def get_container_port():
     from flask.ext.login import current_user
     if current_user.is_anonymous:
         raise BenomeAuthException('Authentication required')
@@ -429,46 +461,37 @@ def get_container_host():
     if not port or type(port) is not int:
         raise BenomeControllerException('Container not available')
 
-    return 'http://%s:%d' % (ip, port)
+    return port
 
-def forward_container(url_path=None, as_response=True, return_code=True, timeout=5):
-    import requests
+def get_container_host():
+    ip = '127.0.0.1'
+    return 'http://%s:%d%s' % (ip, get_container_port(), current_user.get_url_prefix())
 
-    base_host = get_container_host()
-    url_path = url_path or request.full_path
+def forward_container(url_path=None, timeout=5):
+    'Pass the request on to the container and its response back as it arrives'
+    port = get_container_port()
+    url_path = current_user.get_url_prefix() + (url_path or request.full_path)
     
     headers = {
         'Content-type': 'application/json',
         'Accept': 'application/json'
     }
 
-    try:
-        json_data = simplejson.dumps(request.json or {})
-        if request.method == 'POST':
-            r = requests.post(base_host + url_path, data=json_data, headers=headers, timeout=timeout)
-        elif request.method == 'PUT':
-            r = requests.put(base_host + url_path, data=json_data, headers=headers, timeout=timeout)
-        elif request.method == 'DELETE':
-            r = requests.delete(base_host + url_path, data=json_data, headers=headers, timeout=timeout)
-        elif request.method == 'GET':
-            r = requests.get(base_host + url_path, headers=headers, timeout=timeout)
-
-        if callable(r.json):
-            json = r.json()
-        else:
-            json = r.json
+    data = None
+    if request.method != 'GET':
+        # JSON bodies are passed on as sent
+        data = (request.get_data() if request.mimetype == 'application/json' else None) or '{}'
 
-        status_code = r.status_code
-
-    except Exception, e:
+    try:
+        return container_proxy.forward(port, request.method, url_path, data=data, headers=headers, timeout=timeout)
+    except requests.RequestException, e:
         print 'Forward error to %s: %s' % (url_path, e)
-        json = None
-        status_code = 600
 
-    if return_code:
-        return json_response(json), status_code
-    else:
-        return json_response(json)
+        if isinstance(e, requests.ConnectionError) and not current_user.is_anonymous:
+            # Checked again on the next request
+            container_manager.forget_container(current_user.get_id())
+
+        return json_response(None), 600
 
 def call_container(cmd, data=None, port=None, timeout=5, **kwargs):
     base_host = get_container_host()
@@ -534,6 +557,11 @@ if __name__ == '__main__':
         except:
             raise Exception('Invalid port')
 
+    # Not at import, so scripts using this module start no containers
+    if CONTAINER_POOL_SIZE:
+        ContainerPool(container_manager, size=CONTAINER_POOL_SIZE).begin()
+    ContainerReaper(container_manager).begin()
+
     try:
         app.run(debug=True, host='127.0.0.1', port=port, threaded=True, use_reloader=False)
     except Exception, e:
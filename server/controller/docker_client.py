@@ -0,0 +1,161 @@
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''The container operations ContainerManager needs, through the docker command
+line or, for development and tests, as local processes.
+
+Container states are dicts of Running and Port, the host port mapped to the
+container's port.
+'''
+
+import os
+import sys
+import socket
+import threading
+import subprocess
+import simplejson
+
+from benome.utils import ext
+
+class DockerCLI(object):
+    def command(self, args):
+        return ext('docker', list(args), wait=True, shell=False, raw=True, debug=False).strip()
+
+    def run(self, image, cmd, port, name=None, env=None, volumes=None, dns=None):
+        'Start a container, returning its ID'
+        args = ['run', '-d', '-p', str(port)]
+        if dns:
+            args.append('--dns=%s' % dns)
+        if name:
+            args.append('--name="%s"' % name)
+
+        for host_path, container_path in volumes or ():
+            args.extend(['-v', '%s:%s' % (host_path, container_path)])
+
+        for key, value in sorted((env or {}).items()):
+            args.extend(['-e', '%s=%s' % (key, value)])
+
+        return self.command(args + [image] + cmd)
+
+    def inspect(self, container_id, port):
+        if not container_id:
+            return None
+
+        result = self.command(['inspect', container_id])
+        if not result:
+            return None
+
+        try:
+            container_state = simplejson.loads(result)[0]
+        except Exception, e:
+            print 'Error parsing Docker response: %s, |%s|' % (e, result)
+            return None
+
+        ext_port = None
+        running = container_state['State']['Running']
+        if running:
+            ext_port = int(container_state['NetworkSettings']['Ports']['%s/tcp' % port][0]['HostPort'])
+
+        return {
+            'Running': running,
+            'Port': ext_port
+        }
+
+    def start(self, container_id):
+        self.command(['start', container_id])
+
+    def kill(self, container_id):
+        self.command(['kill', container_id])
+
+    def remove(self, container_id):
+        self.command(['rm', '-f', container_id])
+
+class LocalContainers(object):
+    '''Containers as processes on this host, each given a free port.
+
+    Volumes are ignored, the host paths being used as they are. For running
+    without docker, and as a stand-in during tests.
+    '''
+
+    def __init__(self, python=sys.executable):
+        self.python = python
+        self.lock = threading.Lock()
+
+        # Container ID -> (process, port, command, environment)
+        self.containers = {}
+
+    def free_port(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def spawn(self, cmd, env):
+        port = self.free_port()
+        process_env = dict(os.environ, **env)
+        process_env['BENOME_CONTAINER_PORT'] = str(port)
+
+        # The python of the image stands for this host's
+        process = subprocess.Popen([self.python] + cmd[1:], env=process_env, close_fds=True)
+        return process, port
+
+    def run(self, image, cmd, port, name=None, env=None, volumes=None, dns=None):
+        env = env or {}
+        process, ext_port = self.spawn(cmd, env)
+
+        container_id = 'local-%d' % process.pid
+        with self.lock:
+            self.containers[container_id] = (process, ext_port, cmd, env)
+
+        return container_id
+
+    def inspect(self, container_id, port):
+        with self.lock:
+            container = self.containers.get(container_id)
+
+        if not container:
+            return None
+
+        process, ext_port, cmd, env = container
+        running = process.poll() is None
+
+        return {
+            'Running': running,
+            'Port': ext_port if running else None
+        }
+
+    def start(self, container_id):
+        with self.lock:
+            process, ext_port, cmd, env = self.containers[container_id]
+            if process.poll() is None:
+                return
+
+            process, ext_port = self.spawn(cmd, env)
+            self.containers[container_id] = (process, ext_port, cmd, env)
+
+    def kill(self, container_id):
+        with self.lock:
+            container = self.containers.get(container_id)
+
+        if container and container[0].poll() is None:
+            container[0].kill()
+            container[0].wait()
+
+    def remove(self, container_id):
+        self.kill(container_id)
+        with self.lock:
+            self.containers.pop(container_id, None)
@@ -20,4 +20,9 @@ CONTAINER_PORT = 28001
 CONTAINER_BASE_IMAGE = '67482d3248ff'
 DEFAULT_TZ_OFFSET = -420
 GLOBAL_USER_ID = '__global__'
-USER_DB_PATH = '/opt/benome/BenomeUsersDev.db'
\ No newline at end of file
+USER_DB_PATH = '/opt/benome/BenomeUsersDev.db'
+
+# Containers started ahead of need, bound to a user on the user's first request.
+# Off when 0: pooled containers mount the whole data root until bound, and must
+# run as root to drop to the user's UID.
+CONTAINER_POOL_SIZE = 0
@@ -19,8 +19,16 @@ import scrypt
 import hashlib
 import sqlite3
 
+from copy import deepcopy
 from uuid import uuid4
 
+from cache import TTLCache
+
+# Users kept in memory, and for how long in seconds. Changes made through
+# this UserManager take effect at once, others once the cached user expires.
+USER_CACHE_SIZE = 1000
+USER_CACHE_TTL = 60
+
 class UserManager(object):
     def __init__(self, db_path=None):
         if not db_path:
@@ -30,6 +38,9 @@ class UserManager(object):
         self._db = None
         self.init_db()
 
+        # (column, value) -> user record
+        self.users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
     def db(self, new=False):
         if new:
             return sqlite3.connect(self.db_path)
@@ -86,6 +97,7 @@ class UserManager(object):
         db.commit()
         db.close()
 
+        self.users.clear()
         return user_id
 
     # For internal use only.
@@ -143,8 +155,6 @@ class UserManager(object):
             db.close()
 
     def get_user(self, user_id=None, username=None, exception=True):
-        db = self.db(new=True)
-
         if user_id:
             col = 'UserID'
             param = user_id
@@ -152,6 +162,20 @@ class UserManager(object):
             col = 'UserName'
             param = username
 
+        key = (col, param)
+        user_data = self.users.get(key)
+        if user_data is None:
+            user_data = self.load_user(col, param, username, exception)
+            if not user_data:
+                return user_data
+
+            self.users.set(key, user_data)
+
+        return deepcopy(user_data)
+
+    def load_user(self, col, param, username, exception):
+        db = self.db(new=True)
+
         query = 'SELECT UserID, Username, RootContextID, Config FROM Users WHERE LOWER(%s) = LOWER(?)' % col
         result = db.execute(query, (param,)).fetchall()
 
@@ -203,6 +227,8 @@ class UserManager(object):
         db.commit()
         db.close()
 
+        self.users.clear()
+
     def get_users(self):
         db = self.db(new=True)
 
@@ -237,6 +263,8 @@ class UserManager(object):
         db.commit()
         db.close()
 
+        self.users.clear()
+
         return True
 
     def update_feature(self, user_id, feature_id, feature_enabled=True):
@@ -263,6 +291,8 @@ class UserManager(object):
         db.commit()
         db.close()
 
+        self.users.clear()
+
         return True
 
 
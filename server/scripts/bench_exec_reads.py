@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Latency of cheap reads through ContainerExec while heavy reads keep running.
+
+Clients repeatedly request a year of points while another requests single
+points, run once with reads in queue order and once on the read workers.
+
+    python bench_exec_reads.py [num_points] [num_heavy_clients] [db_dir]
+'''
+
+import sys
+import os
+import time
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container'))
+
+from bench_get_points import generate_history
+from benome.sql_db import Graph
+from container_exec import ContainerExec
+from data import DataExec
+
+DURATION = 5
+
+def run(db_path, num_heavy_clients, num_read_workers):
+    g = Graph(root_context_id=1000, db_path=db_path)
+    g.load(1, ['1', '2001'])
+
+    ce = ContainerExec(1, None)
+    ce.data = g
+    ce.num_read_workers = num_read_workers
+    ce.add_exec_bundle(DataExec)
+    ce.begin()
+
+    stop_time = time.time() + DURATION
+    latencies = []
+    num_heavy = [0]
+
+    def heavy_client():
+        while time.time() < stop_time:
+            ce.add('get-points', 1000, interval=86400 * 365).get(True, 60)
+            num_heavy[0] += 1
+
+    def cheap_client():
+        while time.time() < stop_time:
+            t = time.time()
+            ce.add('get-point', 100001).get(True, 60)
+            latencies.append(time.time() - t)
+            time.sleep(0.01)
+
+    clients = [Thread(target=heavy_client) for i in range(num_heavy_clients)]
+    clients.append(Thread(target=cheap_client))
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+
+    ce.stop_thread()
+
+    latencies.sort()
+    return latencies[len(latencies) / 2], latencies[int(len(latencies) * 0.99)], num_heavy[0]
+
+if __name__ == '__main__':
+    num_points = 100000
+    if len(sys.argv) > 1:
+        num_points = int(sys.argv[1])
+
+    num_heavy_clients = 2
+    if len(sys.argv) > 2:
+        num_heavy_clients = int(sys.argv[2])
+
+    db_dir = '/tmp'
+    if len(sys.argv) > 3:
+        db_dir = sys.argv[3]
+
+    db_path = os.path.join(db_dir, 'bench_exec_reads.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    generate_history(db_path, num_points, int(time.time()))
+
+    results = []
+    for name, num_read_workers in (('Serial', 0), ('Read workers', ContainerExec(1, None).num_read_workers)):
+        results.append((name, ) + run(db_path, num_heavy_clients, num_read_workers))
+
+    os.remove(db_path)
+
+    print
+    print '%-14s %14s %14s %12s' % ('', 'get-point p50', 'get-point p99', 'get-points')
+    for name, p50, p99, num_heavy in results:
+        print '%-14s %12.1fms %12.1fms %12d' % (name, p50 * 1000, p99 * 1000, num_heavy)
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Pure Python versus NumPy frequency_decay on synthetic point histories.
+
+Each history is checked for identical output before it is timed.
+
+    python bench_frequency_decay.py [num_points] [num_runs]
+'''
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benome.quality import calc_target_interval, frequency_decay_py, frequency_decay_np
+
+WINDOW = 86400 * 60
+
+# (Description, num_segments, spacing between points in seconds)
+HISTORIES = (
+    ('Dense, daily segments', 60, 300),
+    ('Dense, hourly segments', 1440, 300),
+    ('Sparse, hourly segments', 1440, 86400 * 2),
+)
+
+def generate_points(num_points, anchor_time, spacing):
+    # Newest to oldest, wrapping around to stay clear of the oldest segment
+    max_age = WINDOW - 86400
+    points = []
+    age = 0
+    for i in range(num_points):
+        age = (age + random.randint(1, spacing * 2)) % max_age
+        points.append(anchor_time - age)
+
+    points.sort(reverse=True)
+    return points
+
+def bench(func, points, target_interval, anchor_time, num_segments, num_runs):
+    timings = []
+    for i in range(num_runs):
+        t = time.time()
+        func(points, target_interval, anchor_time, WINDOW, num_segments)
+        timings.append(time.time() - t)
+
+    return min(timings)
+
+if __name__ == '__main__':
+    num_points = 10000
+    if len(sys.argv) > 1:
+        num_points = int(sys.argv[1])
+
+    num_runs = 5
+    if len(sys.argv) > 2:
+        num_runs = int(sys.argv[2])
+
+    random.seed(1)
+    anchor_time = int(time.time())
+
+    print '%-24s %8s %10s %10s %8s' % ('History', 'Segments', 'Python ms', 'NumPy ms', 'Speedup')
+    for description, num_segments, spacing in HISTORIES:
+        points = generate_points(num_points, anchor_time, spacing)
+        target_interval = calc_target_interval(points, anchor_time)
+
+        # Oldest to newest, as frequency() passes them
+        points.sort()
+
+        for decrease_immed in (False, True):
+            py_result = frequency_decay_py(points, target_interval, anchor_time, WINDOW, num_segments, decrease_immed=decrease_immed)
+            np_result = frequency_decay_np(points, target_interval, anchor_time, WINDOW, num_segments, decrease_immed=decrease_immed)
+            if py_result != np_result:
+                print 'Results differ: %s, decrease_immed=%s' % (description, decrease_immed)
+                sys.exit(1)
+
+        py_time = bench(frequency_decay_py, points, target_interval, anchor_time, num_segments, num_runs)
+        np_time = bench(frequency_decay_np, points, target_interval, anchor_time, num_segments, num_runs)
+        print '%-24s %8d %10.2f %10.2f %7.1fx' % (description, num_segments, py_time * 1000, np_time * 1000, py_time / np_time)
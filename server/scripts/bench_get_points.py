@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Time Graph.get_points for a dashboard-sized window while the history grows.
+
+Points are generated at a constant rate so that the 30-day window always holds
+the same number of points, only the amount of older history changes.
+
+    python bench_get_points.py [num_points,...] [db_dir]
+'''
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from init_db import init_db
+from benome.sql_db import Graph
+
+POINTS_PER_DAY = 100
+WINDOW = 86400 * 30
+NUM_RUNS = 5
+
+def generate_history(db_path, num_points, anchor_time, num_contexts=50):
+    import sqlite3
+
+    init_db(db_path)
+    db = sqlite3.connect(db_path)
+
+    context_ids = range(3000, 3000 + num_contexts)
+    for context_id in context_ids:
+        db.execute('INSERT INTO Nodes (ID, UserID, Type, Label, TimeStamp) VALUES (?, 1, \'Context\', ?, ?)',
+            (context_id, 'Context %d' % context_id, anchor_time))
+        db.execute('INSERT INTO Associations (UserID, SourceID, DestID, Key) VALUES (1, 1004, ?, \'down\')', (context_id,))
+        db.execute('INSERT INTO Associations (UserID, SourceID, DestID, Key) VALUES (1, ?, 1004, \'up\')', (context_id,))
+
+    spacing = 86400.0 / POINTS_PER_DAY
+    batch_size = 50000
+    point_id = 100000
+
+    for batch_begin in range(0, num_points, batch_size):
+        nodes = []
+        assocs = []
+        attrs = []
+        for i in range(batch_begin, min(num_points, batch_begin + batch_size)):
+            point_id += 1
+            timestamp = int(anchor_time - (i * spacing))
+            duration = random.choice((0, 60, 600, 3600))
+
+            nodes.append((point_id, timestamp))
+            assocs.append((point_id, random.choice(context_ids)))
+            attrs.append((point_id, 'Duration', duration))
+            attrs.append((point_id, 'EndTime', timestamp + duration))
+
+        db.executemany('INSERT INTO Nodes (ID, UserID, Type, TimeStamp) VALUES (?, 1, \'Point\', ?)', nodes)
+        db.executemany('INSERT INTO Associations (UserID, SourceID, DestID, Key) VALUES (1, ?, ?, \'up\')', assocs)
+        db.executemany('INSERT INTO Attributes (NodeID, NameSpaceID, Name, Value) VALUES (?, 1, ?, ?)', attrs)
+        db.commit()
+
+    db.close()
+
+def bench(db_path, anchor_time):
+    g = Graph(root_context_id=1000, db_path=db_path)
+    g.load(1, ['1', '2001'])
+
+    timings = []
+    for i in range(NUM_RUNS):
+        t = time.time()
+        points = g.get_points(anchor_time=anchor_time, end_time=anchor_time - WINDOW)
+        timings.append(time.time() - t)
+
+    return len(points), min(timings), sum(timings) / len(timings)
+
+if __name__ == '__main__':
+    sizes = [10000, 100000, 1000000, 5000000]
+    if len(sys.argv) > 1:
+        sizes = map(int, sys.argv[1].split(','))
+
+    db_dir = '/tmp'
+    if len(sys.argv) > 2:
+        db_dir = sys.argv[2]
+
+    anchor_time = int(time.time())
+
+    print '%10s %10s %10s %10s' % ('History', 'Window', 'Min (ms)', 'Avg (ms)')
+    for num_points in sizes:
+        db_path = os.path.join(db_dir, 'bench_get_points_%d.db' % num_points)
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+        generate_history(db_path, num_points, anchor_time)
+        num_window, min_time, avg_time = bench(db_path, anchor_time)
+        print '%10d %10d %10.1f %10.1f' % (num_points, num_window, min_time * 1000, avg_time * 1000)
+
+        os.remove(db_path)
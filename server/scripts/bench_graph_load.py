@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Time Graph.load against the list-based loader it replaced, as the context tree grows.
+
+    python bench_graph_load.py [num_contexts,...] [points_per_context]
+'''
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from init_db import init_db
+from benome.sql_db import Graph
+
+class LegacyGraph(Graph):
+    def load(self, user_id, attr_namespaces):
+        'Graph.load as it was before the streaming loader, for comparison'
+        db = self.db
+        context_ids = []
+
+        context_query = '''
+        SELECT
+            Nodes.ID, Nodes.Label, Nodes.Timestamp, Attributes.NameSpaceID,
+                Attributes.Name, Attributes.Value
+        FROM
+            Nodes
+                LEFT OUTER JOIN Attributes ON Nodes.ID = Attributes.NodeID
+        WHERE
+            Nodes.Type = 'Context'
+            AND
+            Nodes.UserID = ?
+            AND
+            (
+                Attributes.NameSpaceID IS NULL
+                OR
+                Attributes.NameSpaceID IN (%s)
+            )
+        ''' % ','.join(attr_namespaces)
+        contexts_result = db.execute(context_query, (user_id, )).fetchall()
+
+        for row in contexts_result:
+            context_id, label, timestamp, namespace_id, attr_name, attr_val = row
+            context_id = int(context_id)
+
+            if context_id not in context_ids:
+                context_ids.append(context_id)
+                self.init_context(context_id, label)
+                self.set_context_attr(context_id, 1, 'Timestamp', timestamp)
+
+            if namespace_id and attr_name:
+                namespace_id = int(namespace_id)
+                self.set_context_attr(context_id, namespace_id, attr_name, attr_val)
+
+        assoc_query = '''
+        SELECT
+            ID, SourceID, DestID, Key
+        FROM
+            Associations
+        WHERE
+            UserID = ?
+            AND
+            SourceID in (%s)
+        ''' % ','.join(map(str, context_ids))
+        assoc_result = db.execute(assoc_query, (user_id, )).fetchall()
+
+        for row in assoc_result:
+            assoc_id, source_id, dest_id, key = row
+            self.init_assoc(assoc_id, source_id, dest_id, key)
+
+        return self
+
+def generate_tree(db_path, num_contexts, points_per_context):
+    import sqlite3
+
+    init_db(db_path)
+    db = sqlite3.connect(db_path)
+
+    anchor_time = int(time.time())
+    context_ids = [1004]
+    nodes = []
+    assocs = []
+    attrs = []
+    for context_id in range(10000, 10000 + num_contexts):
+        parent_id = random.choice(context_ids[-50:])
+        context_ids.append(context_id)
+
+        nodes.append((context_id, 'Context', 'Context %d' % context_id, anchor_time))
+        assocs.append((context_id, parent_id, 'up'))
+        assocs.append((parent_id, context_id, 'down'))
+        attrs.append((context_id, 1, 'TargetFrequency', 86400))
+        attrs.append((context_id, 2001, 'Color', '#808080'))
+
+    point_id = 10000 + num_contexts
+    for context_id in context_ids[1:]:
+        for i in range(points_per_context):
+            point_id += 1
+            nodes.append((point_id, 'Point', None, anchor_time - random.randint(0, 86400 * 365)))
+            assocs.append((point_id, context_id, 'up'))
+
+    db.executemany('INSERT INTO Nodes (ID, UserID, Type, Label, TimeStamp) VALUES (?, 1, ?, ?, ?)', nodes)
+    db.executemany('INSERT INTO Associations (UserID, SourceID, DestID, Key) VALUES (1, ?, ?, ?)', assocs)
+    db.executemany('INSERT INTO Attributes (NodeID, NameSpaceID, Name, Value) VALUES (?, ?, ?, ?)', attrs)
+    db.commit()
+    db.close()
+
+def bench(cls, db_path):
+    g = cls(root_context_id=1000, db_path=db_path)
+
+    t = time.time()
+    g.load(1, ['1', '2001'])
+    return time.time() - t, len(g.contexts), len(g.associations)
+
+if __name__ == '__main__':
+    sizes = [1000, 10000, 50000]
+    if len(sys.argv) > 1:
+        sizes = map(int, sys.argv[1].split(','))
+
+    points_per_context = 20
+    if len(sys.argv) > 2:
+        points_per_context = int(sys.argv[2])
+
+    random.seed(1)
+
+    results = []
+    for num_contexts in sizes:
+        db_path = '/tmp/bench_graph_load_%d.db' % num_contexts
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+        generate_tree(db_path, num_contexts, points_per_context)
+        current_time, num_loaded, num_assocs = bench(Graph, db_path)
+        legacy_time, num_loaded, num_assocs = bench(LegacyGraph, db_path)
+        results.append((num_contexts, num_assocs, legacy_time, current_time))
+
+        os.remove(db_path)
+
+    print
+    print '%10s %12s %12s %12s' % ('Contexts', 'Assocs', 'Legacy (s)', 'Current (s)')
+    for num_contexts, num_assocs, legacy_time, current_time in results:
+        print '%10d %12d %12.2f %12.2f' % (num_contexts, num_assocs, legacy_time, current_time)
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Bulk point upload through ContainerExec, with and without group commit.
+
+Several clients each send add-point commands and wait for every acknowledgement,
+as concurrent sync requests from the client do.
+
+    python bench_group_commit.py [num_points] [num_clients] [db_dir]
+'''
+
+import sys
+import os
+import time
+import random
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container'))
+
+from bench_get_points import generate_history
+from benome.sql_db import Graph
+from container_exec import ContainerExec
+from data import DataExec
+
+def upload(db_path, num_points, num_clients, max_batch_size):
+    g = Graph(root_context_id=1000, db_path=db_path)
+    g.load(1, ['1', '2001'])
+
+    ce = ContainerExec(1, None)
+    ce.data = g
+    ce.max_batch_size = max_batch_size
+    ce.add_exec_bundle(DataExec)
+    ce.begin()
+
+    anchor_time = int(time.time())
+
+    def client(client_num):
+        for i in range(num_points / num_clients):
+            point_data = {
+                '1__ContextID': 3000 + random.randint(0, 49),
+                '1__Time': anchor_time - random.randint(0, 86400),
+                '1__Text': 'Client %d point %d' % (client_num, i)
+            }
+
+            success, result = ce.add('add-point', point_data).get(True, 30)
+            if not success:
+                raise result
+
+    t = time.time()
+    clients = [Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - t
+
+    ce.stop_thread()
+
+    # Every acknowledged point must be in the DB
+    num_points = g.db.execute('SELECT COUNT(*) FROM Nodes WHERE Type = \'Point\'').fetchone()[0]
+    return elapsed, num_points
+
+if __name__ == '__main__':
+    num_points = 2000
+    if len(sys.argv) > 1:
+        num_points = int(sys.argv[1])
+
+    num_clients = 8
+    if len(sys.argv) > 2:
+        num_clients = int(sys.argv[2])
+
+    db_dir = '/tmp'
+    if len(sys.argv) > 3:
+        db_dir = sys.argv[3]
+
+    db_path = os.path.join(db_dir, 'bench_group_commit.db')
+    anchor_time = int(time.time())
+
+    results = []
+    for name, max_batch_size in (('Per write', 1), ('Group commit', ContainerExec(1, None).max_batch_size)):
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        generate_history(db_path, 1000, anchor_time)
+
+        elapsed, num_stored = upload(db_path, num_points, num_clients, max_batch_size)
+        results.append((name, elapsed, num_stored))
+
+    os.remove(db_path)
+
+    print
+    for name, elapsed, num_stored in results:
+        print '%-14s %6d points in %.2fs, %.0f points/s, %d points stored' % (
+                    name, num_points, elapsed, num_points / elapsed, num_stored)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Repeated get-points calls with string-built SQL versus the fixed parameterized statements.
+
+Every call uses a new anchor time and context list, as the container does, so the
+string-built version produces new SQL text each time.
+
+    python bench_point_queries.py [num_calls] [num_points]
+'''
+
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bench_get_points import generate_history
+from benome.sql_db import Graph
+
+WINDOW = 3600 * 6
+
+def legacy_get_points(g, anchor_time=None, end_time=None, contexts=None, user_id=1):
+    'get_points as it was before PointQueries, for comparison'
+
+    context_query = ''
+    if contexts:
+        context_query += '''
+            AND
+            Associations.DestID IN (%s)
+        ''' % ','.join(map(str, contexts))
+
+    range_query = ''
+    if anchor_time:
+        range_query += '''
+            AND
+            Nodes.TimeStamp <= %s
+        ''' % anchor_time
+
+    if end_time:
+        range_query += '''
+            AND
+            Nodes.TimeStamp >= %s
+        ''' % end_time
+
+    query = '''
+    SELECT
+        Nodes.ID, Nodes.TimeStamp, Associations.DestID, Attributes.NameSpaceID,
+        Attributes.Name, Attributes.Value
+    FROM
+        Nodes
+            LEFT OUTER JOIN Attributes ON Nodes.ID = Attributes.NodeID
+            INNER JOIN Associations ON Nodes.ID = Associations.SourceID
+    WHERE
+        Nodes.Type = 'Point'
+        AND
+        Nodes.UserID = ?
+        AND
+        Associations.Key = 'up'
+        %s
+        %s
+    ''' % (context_query, range_query)
+    result = g.db.execute(query, (user_id,)).fetchall()
+    return g.generate_points(result)
+
+def bench(func, g, anchor_time, num_calls):
+    t = time.time()
+    num_points = 0
+    for i in range(num_calls):
+        call_anchor = anchor_time - (i * 7)
+        contexts = [3000 + (i % 50), 3000 + ((i + 1) % 50)]
+        num_points += len(func(g, anchor_time=call_anchor, end_time=call_anchor - WINDOW, contexts=contexts))
+
+    return time.time() - t, num_points
+
+if __name__ == '__main__':
+    num_calls = 5000
+    if len(sys.argv) > 1:
+        num_calls = int(sys.argv[1])
+
+    num_points = 100000
+    if len(sys.argv) > 2:
+        num_points = int(sys.argv[2])
+
+    db_path = '/tmp/bench_point_queries.db'
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    anchor_time = int(time.time())
+    generate_history(db_path, num_points, anchor_time)
+
+    g = Graph(root_context_id=1000, db_path=db_path)
+    g.load(1, ['1', '2001'])
+
+    def current_get_points(g, **kwargs):
+        return g.get_points(**kwargs)
+
+    for name, func in (('String-built', legacy_get_points), ('Parameterized', current_get_points)):
+        elapsed, total_points = bench(func, g, anchor_time, num_calls)
+        print '%-14s %6d calls in %.2fs, %.3fms/call, %d points' % (name, num_calls, elapsed, elapsed * 1000 / num_calls, total_points)
+
+    os.remove(db_path)
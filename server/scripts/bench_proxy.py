@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Controller CPU and latency of forwarding container responses.
+
+A stand-in container in another process serves a fixed list of points.
+Clients fetch it through the controller, once decoded and encoded again on a
+new connection per request, and once streamed through ContainerProxy.
+
+    python bench_proxy.py [num_requests] [num_points] [num_clients]
+'''
+
+import sys
+import os
+import time
+from threading import Thread
+from multiprocessing import Process
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controller'))
+
+import requests
+from flask import Flask
+from werkzeug.serving import run_simple
+
+from benome.utils import json_response, json_dumps
+from container_proxy import ContainerProxy
+
+PORT = 28901
+
+def run_container(num_points):
+    points = [{
+        'ID': 100000 + i,
+        '1__ContextID': 3000 + i % 50,
+        '1__Time': 1450000000 + i * 60,
+        '1__Text': 'Point %d' % i
+    } for i in range(num_points)]
+    body = json_dumps(points)
+
+    app = Flask('container')
+
+    @app.route('/data/points/<context_id>')
+    def data_points(context_id):
+        response = app.response_class(body)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    run_simple('127.0.0.1', PORT, app, threaded=True)
+
+def make_controller():
+    app = Flask('controller')
+    proxy = ContainerProxy()
+
+    headers = {
+        'Content-type': 'application/json',
+        'Accept': 'application/json'
+    }
+
+    @app.route('/decode/<path:url_path>')
+    def decode(url_path):
+        # As forward_container was
+        r = requests.get('http://127.0.0.1:%d/%s' % (PORT, url_path), headers=headers, timeout=5)
+        return json_response(r.json()), r.status_code
+
+    @app.route('/stream/<path:url_path>')
+    def stream(url_path):
+        return proxy.forward(PORT, 'GET', '/' + url_path, headers=headers, timeout=5)
+
+    return app
+
+def run(app, prefix, num_requests, num_clients):
+    latencies = []
+
+    def client():
+        test_client = app.test_client()
+        for i in range(num_requests / num_clients):
+            t = time.time()
+            response = test_client.get('/%s/data/points/1000' % prefix)
+            assert response.status_code == 200 and response.data
+            latencies.append(time.time() - t)
+
+    cpu = sum(os.times()[:2])
+    t = time.time()
+
+    clients = [Thread(target=client) for i in range(num_clients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+
+    elapsed = time.time() - t
+    cpu = sum(os.times()[:2]) - cpu
+
+    latencies.sort()
+    return cpu / len(latencies), latencies[len(latencies) / 2], latencies[int(len(latencies) * 0.99)], elapsed
+
+if __name__ == '__main__':
+    num_requests = 1000
+    if len(sys.argv) > 1:
+        num_requests = int(sys.argv[1])
+
+    num_points = 2000
+    if len(sys.argv) > 2:
+        num_points = int(sys.argv[2])
+
+    num_clients = 4
+    if len(sys.argv) > 3:
+        num_clients = int(sys.argv[3])
+
+    container = Process(target=run_container, args=(num_points,))
+    container.daemon = True
+    container.start()
+
+    # Until the container is up
+    for i in range(50):
+        try:
+            requests.get('http://127.0.0.1:%d/data/points/1000' % PORT, timeout=1)
+            break
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    app = make_controller()
+
+    results = []
+    for name, prefix in (('Decode', 'decode'), ('Stream', 'stream')):
+        # Warm up
+        run(app, prefix, num_clients * 5, num_clients)
+        results.append((name, ) + run(app, prefix, num_requests, num_clients))
+
+    container.terminate()
+
+    print
+    print '%-8s %14s %10s %10s %10s' % ('', 'CPU/request', 'p50', 'p99', 'Total')
+    for name, cpu, p50, p99, elapsed in results:
+        print '%-8s %12.2fms %8.1fms %8.1fms %9.2fs' % (name, cpu * 1000, p50 * 1000, p99 * 1000, elapsed)
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Time the per-day totals of a report over a large context tree with dense days.
+
+Each day is computed once by walking the graph from the root, rescanning the
+day's points for notes at every context, as compute_day_results did, and once
+with a ReportTree built for the report.
+
+    python bench_report.py [num_contexts] [points_per_day] [num_days] [db_dir]
+'''
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container'))
+
+from init_db import init_db
+from benome.sql_db import Graph
+from report import ReportTree, compute_day_results
+
+ROOT_CONTEXT_ID = 1004
+NOTE_RATIO = 0.3
+
+def generate_tree(db_path, num_contexts, anchor_time):
+    import sqlite3
+
+    init_db(db_path)
+    db = sqlite3.connect(db_path)
+
+    context_ids = [ROOT_CONTEXT_ID]
+    for context_id in range(3000, 3000 + num_contexts):
+        parent_id = random.choice(context_ids)
+        db.execute('INSERT INTO Nodes (ID, UserID, Type, Label, TimeStamp) VALUES (?, 1, \'Context\', ?, ?)',
+            (context_id, 'Context %d' % context_id, anchor_time))
+        db.execute('INSERT INTO Associations (UserID, SourceID, DestID, Key) VALUES (1, ?, ?, \'down\')', (parent_id, context_id))
+        db.execute('INSERT INTO Associations (UserID, SourceID, DestID, Key) VALUES (1, ?, ?, \'up\')', (context_id, parent_id))
+        context_ids.append(context_id)
+
+    db.commit()
+    db.close()
+
+    return context_ids
+
+def generate_days(context_ids, points_per_day, num_days):
+    'Points of each day, as gen_idx indexed them, and the same as day rollups and notes'
+    point_idx = {}
+    rollups = {}
+    notes = {}
+
+    point_id = 100000
+    for epoch_day in range(num_days):
+        day_points = point_idx[epoch_day] = []
+        day_rollups = rollups[epoch_day] = {}
+
+        for i in range(points_per_day):
+            point_id += 1
+            context_id = random.choice(context_ids)
+            timestamp = epoch_day * 86400 + i
+            duration = random.choice((0, 60, 600, 3600))
+            text = 'Note %d\nSecond line' % point_id if random.random() < NOTE_RATIO else ''
+
+            day_points.append({
+                'ContextID': context_id,
+                'CommonDetails': {
+                    'BeginTime': timestamp,
+                    'Duration': duration,
+                    'Text': text
+                }
+            })
+
+            total, count, note_ids = day_rollups.get(context_id, (0, 0, []))
+            if text:
+                note_ids.append(point_id)
+                notes[point_id] = (timestamp, duration, text)
+            day_rollups[context_id] = (total + duration, count + 1, note_ids)
+
+    return point_idx, rollups, notes
+
+def recursive_day_results(point_idx, epoch_day, context, structure, level=0):
+    # As compute_day_results was
+    context_id = context.get_id()
+    context_details = {
+        'Context': context,
+        'ContextID': context_id,
+        'TotalTime': 0,
+        'SelfTotalTime': 0,
+        'ChildTotalTime': 0,
+        'ProportionalTime': 0.0,
+        'RecordNotes': None,
+        'Children': []
+    }
+
+    self_total = 0
+    for child_rec in structure.get(context_id, []):
+        self_total += child_rec['CommonDetails']['Duration']
+    context_details['SelfTotalTime'] = self_total
+
+    child_total = 0
+    down_vertexes = context.outV('down')
+    if down_vertexes:
+        for child_vertex in down_vertexes:
+            child_details = recursive_day_results(point_idx, epoch_day, child_vertex, structure, level=level+1)
+            context_details['Children'] += child_details
+            child_total += sum([child_detail['TotalTime'] for child_detail in child_details])
+
+    record_notes = []
+    for point in point_idx.get(epoch_day, []):
+        if point.get('ContextID') != context_id:
+            continue
+
+        description = point['CommonDetails'].get('Text', None)
+        duration = point['CommonDetails'].get('Duration', 0)
+        if description:
+            record_notes.append((duration, map(str.strip, str(description.strip()).split('\n'))))
+
+    context_details['ChildTotalTime'] = child_total
+    context_details['TotalTime'] = child_total + self_total
+    context_details['RecordNotes'] = record_notes
+
+    if level == 0:
+        return context_details
+    else:
+        return [context_details]
+
+def run_recursive(root, point_idx, days):
+    total_time = 0
+    for epoch_day in days:
+        structure = {}
+        for point in point_idx[epoch_day]:
+            structure.setdefault(point['ContextID'], []).append(point)
+
+        total_time += recursive_day_results(point_idx, epoch_day, root, structure)['TotalTime']
+
+    return total_time
+
+def run_tree(root, rollups, notes, days):
+    tree = ReportTree(root)
+
+    total_time = 0
+    for epoch_day in days:
+        total_time += compute_day_results(rollups[epoch_day], notes, tree)['TotalTime']
+
+    return total_time
+
+if __name__ == '__main__':
+    num_contexts = 1000
+    if len(sys.argv) > 1:
+        num_contexts = int(sys.argv[1])
+
+    points_per_day = 2000
+    if len(sys.argv) > 2:
+        points_per_day = int(sys.argv[2])
+
+    num_days = 30
+    if len(sys.argv) > 3:
+        num_days = int(sys.argv[3])
+
+    db_dir = '/tmp'
+    if len(sys.argv) > 4:
+        db_dir = sys.argv[4]
+
+    db_path = os.path.join(db_dir, 'bench_report.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    random.seed(1)
+    context_ids = generate_tree(db_path, num_contexts, int(time.time()))
+    point_idx, rollups, notes = generate_days(context_ids, points_per_day, num_days)
+
+    g = Graph(root_context_id=1000, db_path=db_path)
+    g.load(1, ['1', '2001'])
+    root = g.get_context(ROOT_CONTEXT_ID)
+    days = range(num_days)
+
+    results = []
+    for name, run in (('Recursive', lambda: run_recursive(root, point_idx, days)),
+                      ('Tree', lambda: run_tree(root, rollups, notes, days))):
+        t = time.time()
+        total_time = run()
+        results.append((name, time.time() - t, total_time))
+
+    assert results[0][2] == results[1][2]
+
+    print
+    print '%d contexts, %d points a day, %d days' % (num_contexts, points_per_day, num_days)
+    print '%-10s %10s %10s' % ('', 'Total (s)', 'Day (ms)')
+    for name, elapsed, total_time in results:
+        print '%-10s %10.2f %10.1f' % (name, elapsed, elapsed * 1000 / num_days)
+
+    os.remove(db_path)
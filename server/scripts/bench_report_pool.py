@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Time the days of a synthetic month report, with leaf notes and note timing,
+generated in this process and by report pools of several sizes.
+
+    python bench_report_pool.py [pool_size,...] [num_contexts] [points_per_day] [db_dir]
+'''
+
+import sys
+import os
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container'))
+
+from benome.sql_db import Graph
+from bench_report import ROOT_CONTEXT_ID, generate_tree, generate_days
+import report
+
+NUM_DAYS = 30
+NUM_RUNS = 3
+
+def bench(root, day_idx, days, pool_size):
+    timings = []
+    for i in range(NUM_RUNS):
+        t = time.time()
+        day_sections = report.generate_report_days(root, day_idx, days, None, True, True, pool_size=pool_size)
+        timings.append(time.time() - t)
+
+    return day_sections, min(timings)
+
+if __name__ == '__main__':
+    pool_sizes = [2, 4]
+    if len(sys.argv) > 1:
+        pool_sizes = map(int, sys.argv[1].split(','))
+
+    num_contexts = 1000
+    if len(sys.argv) > 2:
+        num_contexts = int(sys.argv[2])
+
+    points_per_day = 2000
+    if len(sys.argv) > 3:
+        points_per_day = int(sys.argv[3])
+
+    db_dir = '/tmp'
+    if len(sys.argv) > 4:
+        db_dir = sys.argv[4]
+
+    db_path = os.path.join(db_dir, 'bench_report_pool.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    random.seed(1)
+    context_ids = generate_tree(db_path, num_contexts, int(time.time()))
+    point_idx, rollups, notes = generate_days(context_ids, points_per_day, NUM_DAYS)
+
+    g = Graph(root_context_id=1000, db_path=db_path)
+    g.load(1, ['1', '2001'])
+    root = g.get_context(ROOT_CONTEXT_ID)
+    days = range(NUM_DAYS)
+
+    print
+    print '%d contexts, %d points a day, %d days, %d CPUs' % (num_contexts, points_per_day, NUM_DAYS, os.sysconf('SC_NPROCESSORS_ONLN'))
+    print '%-10s %10s %10s' % ('Pool', 'Min (ms)', 'Speedup')
+
+    sequential_sections, sequential_time = bench(root, (rollups, notes), days, 0)
+    print '%-10s %10.1f %10.2f' % ('None', sequential_time * 1000, 1.0)
+
+    for pool_size in pool_sizes:
+        # A pool of each size in turn, started outside the timings
+        report.start_report_pool(pool_size)
+        day_sections, elapsed = bench(root, (rollups, notes), days, pool_size)
+        assert day_sections == sequential_sections
+
+        print '%-10d %10.1f %10.2f' % (pool_size, elapsed * 1000, sequential_time / elapsed)
+        report.stop_report_pool()
+
+    os.remove(db_path)
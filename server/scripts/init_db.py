@@ -311,6 +311,12 @@ def init_tables(db):
     db.execute('''CREATE INDEX IF NOT EXISTS 'Attributes_NodeID' ON 'Attributes' ('NodeID' ASC)''')
     db.execute('''CREATE INDEX IF NOT EXISTS 'Associations_DestID' ON 'Associations' ('DestID' ASC)''')
 
+    # Time-ordered point range scans
+    db.execute('''CREATE INDEX IF NOT EXISTS 'Nodes_UserID_Type_TimeStamp' ON
+                    'Nodes' ('UserID' ASC, 'Type' ASC, 'TimeStamp' ASC)''')
+    db.execute('''CREATE INDEX IF NOT EXISTS 'Associations_SourceID_Key_DestID' ON
+                    'Associations' ('SourceID' ASC, 'Key' ASC, 'DestID' ASC)''')
+
     # Required for REPLACE INTO to work
     db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS 'Attributes_NodeID_AttrName_NameSpaceID' ON 
                     'Attributes' ('NodeID' ASC, 'Name' ASC, 'NameSpaceID' ASC)''')
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# Copyright 2016 Steve Hazel
+#
+# This file is part of Benome.
+#
+# Benome is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License version 3
+# as published by the Free Software Foundation.
+#
+# Benome is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Benome. If not, see http://www.gnu.org/licenses/.
+
+'''Check that a multi-user container releases the graphs it unloads.
+
+Loads more users than max_tenants, from DBs under a temporary data root, and
+checks that each evicted user's DB connections are closed, that none of their
+threads are left running and that their load lock is dropped. A request still
+holding an evicted user's container is retried on the reloaded graph.
+
+    python test_tenants.py [db_dir]
+'''
+
+import sys
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'container'))
+
+from init_db import init_db
+
+MAX_TENANTS = 2
+NUM_USERS = 5
+
+def is_closed(db):
+    try:
+        db.execute('SELECT 1')
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+def exec_threads(container_exec):
+    return [container_exec] + container_exec.read_workers
+
+def bundle_timers():
+    'Live timers of exec bundles, which tenants should not have'
+    timers = []
+    for thread in threading.enumerate():
+        target = getattr(thread, 'function', None)
+        if getattr(target, '__self__', None) is not None:
+            timers.append(thread)
+    return timers
+
+def test_evicted_tenants_released(data_root=None):
+    from flask import Flask, g
+    from container import Tenants
+    from data import DataExec
+    from config import TENANT_READ_WORKERS
+
+    data_root = tempfile.mkdtemp(dir=data_root)
+    try:
+        user_ids = ['u%d' % i for i in range(NUM_USERS)]
+        for user_id in user_ids:
+            os.makedirs(os.path.join(data_root, user_id))
+            init_db(os.path.join(data_root, user_id, 'sql.db'))
+
+        app = Flask(__name__)
+        tenants = Tenants(app, data_root, max_tenants=MAX_TENANTS)
+        tenants.add_exec_bundle(DataExec)
+
+        containers = {}
+        for user_id in user_ids:
+            containers[user_id] = tenants.get(user_id)
+            assert containers[user_id].container_exec.data.db_path == os.path.join(data_root, user_id, 'sql.db')
+
+        # Stopped threads take a moment to end
+        time.sleep(0.2)
+
+        loaded = set(tenants.containers)
+        evicted = [user_id for user_id in user_ids if user_id not in loaded]
+        assert len(loaded) == MAX_TENANTS
+        assert len(evicted) == NUM_USERS - MAX_TENANTS
+
+        for user_id in evicted:
+            container_exec = containers[user_id].container_exec
+            connections = container_exec.data.connections
+            assert is_closed(connections.writer), user_id
+            assert all(is_closed(db) for db in list(connections.pool.queue) if db is not None), user_id
+            assert not any(thread.is_alive() for thread in exec_threads(container_exec)), user_id
+            assert user_id not in tenants.user_locks, user_id
+
+        for user_id in loaded:
+            container_exec = containers[user_id].container_exec
+            assert not is_closed(container_exec.data.connections.writer), user_id
+            assert len(container_exec.read_workers) == TENANT_READ_WORKERS
+            assert all(thread.is_alive() for thread in exec_threads(container_exec)), user_id
+
+            # As the shared timer does
+            container_exec.tick()
+
+        assert not bundle_timers()
+
+        # A request that got an evicted user's container before it was unloaded
+        stale_user_id = evicted[0]
+        stale = [containers[stale_user_id]]
+        get = tenants.get
+        tenants.get = lambda user_id: stale.pop() if stale else get(user_id)
+        try:
+            with app.test_request_context():
+                g.user_id = stale_user_id
+                assert tenants.exec_cmd('get-root-context-id') == 1000
+        finally:
+            tenants.get = get
+        assert stale_user_id in tenants.containers
+
+        tenants.onexit()
+        assert not tenants.user_locks
+    finally:
+        shutil.rmtree(data_root)
+
+if __name__ == '__main__':
+    data_root = None
+    if len(sys.argv) > 1:
+        data_root = sys.argv[1]
+
+    test_evicted_tenants_released(data_root)
+    print 'OK'